@@ -0,0 +1,18 @@
+# This is a script that moves old inactive orders and settled trades out of the
+# database and into the monthly archives (see website/archive.py). It can be
+# run by hand or once a day by a scheduled task, the number of days of history
+# to keep in the database defaults to 90.
+#
+#     python archiver.py 90
+
+import sys
+
+from website import create_app
+from website.archive import archive_old_rows
+
+days = int(sys.argv[1]) if len(sys.argv) > 1 else 90
+
+app = create_app()
+with app.app_context():
+    counts = archive_old_rows(days)
+print(f"Archived {counts['order']} orders and {counts['trade']} trades older than {days} days")
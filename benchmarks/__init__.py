@@ -0,0 +1,9 @@
+# This package holds our benchmarks. They run the real matching engine and bots
+# against a temporary SQLite database filled with synthetic accounts and orders
+# so that we can compare changes to the engine before they reach production.
+
+# backtest.py uses the same approach to try the bots' parameters on a recorded
+# or synthetic day of trading, rather than to time the engine.
+
+# Run them from the top folder of the project, for example:
+#     python -m benchmarks.engine --accounts 50 --resting 2000 --orders 5000
@@ -0,0 +1,423 @@
+# Backtests our market makers offline. The real bot classes run against the
+# real matching engine on an in-memory SQLite database, driven by a price path
+# and a stream of user orders read from CSV files, so that offsets, depths and
+# sizes can be tried without going near production.
+#
+#     python -m benchmarks.backtest synth --days 5 --price 0.92 --out data
+#     python -m benchmarks.backtest run --bot derivative --prices data/prices.csv --flow data/flow.csv --param offset=0.002
+#     python -m benchmarks.backtest sweep --bot fixed --prices data/prices.csv --flow data/flow.csv --grid offset_2=0.05,0.1 --grid depth=3,5
+#
+# The price file has a time and price on each line, the flow file a time,
+# side, quantity, price and time in force (GTC if left empty). Times are in
+# ISO format and each file is in time order. For every simulated day we report
+# the bot's profit and loss (marked to the last price of the day), its
+# inventory, its fills, its order churn and how long the day took to run.
+
+# The bots are run the way that production runs them. After every user order
+# that trades with anyone, the market's bot requotes as bot_triggers.py would
+# run it. Every interval seconds of simulated time, the derivative market
+# maker also requotes on the latest price and checks its sizes, as the bot
+# service would. A sweep runs each set of parameters in its own process, on
+# as many cores as we are given.
+
+import os
+import csv
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import itertools
+import datetime as dt
+import decimal as de
+import multiprocessing as mp
+from sqlalchemy import func
+
+from website import create_app, db
+from website.models import Account, Order, Trade
+from website.matching_engine import enter_order
+from website.bots import Deriviative_Market_Maker, Fixed_Interval_Market_Maker
+
+# The account of the users whose orders we replay.
+user_id = 2000000
+
+# The parameters of each bot with their defaults, those of bot_6000000 and
+# bot_6010000. A None mid starts the fixed interval bot at the first price.
+defaults = {
+    "fixed": {
+        "upper_limit": de.Decimal("27.5"), "lower_limit": de.Decimal("25.5"),
+        "offset_1": de.Decimal("0.25"), "offset_2": de.Decimal("0.05"),
+        "depth": 5, "size": de.Decimal("70"), "mid": None,
+        "funds": de.Decimal("100000")},
+    "derivative": {
+        "offset": de.Decimal("0.001"), "size": de.Decimal("300"),
+        "funds": de.Decimal("100000")},
+}
+
+# The market and account that each bot trades in.
+markets = {
+    "fixed": ("STN", "EUR", 6000000),
+    "derivative": ("EUR", "USD", 6010000),
+}
+
+class Backtest_Market_Maker(Deriviative_Market_Maker):
+    """
+    A derivative market maker whose source price is set by the backtest.
+    """
+    def __init__(self, price: de.Decimal, **kwargs):
+        self.price = price
+        super().__init__(source = "backtest", **kwargs)
+
+    def query_source(self):
+        return self.price
+
+class Backtest_Interval_Market_Maker(Fixed_Interval_Market_Maker):
+    """
+    A fixed interval market maker which starts at a midpoint set by the
+    backtest rather than our fixed one.
+    """
+    def __init__(self, mid: de.Decimal, **kwargs):
+        self.mid = mid
+        super().__init__(**kwargs)
+
+    def set_mid(self):
+        return self.mid
+
+def read_prices(path: str):
+    """
+    Returns:
+        -> prices: list, of (time, price) tuples.
+    """
+    with open(path, newline = "") as f:
+        return [(dt.datetime.fromisoformat(row["time"]), de.Decimal(row["price"])) for row in csv.DictReader(f)]
+
+def read_flow(path: str):
+    """
+    Returns:
+        -> flow: list, of (time, side, quantity, price, time_in_force) tuples.
+    """
+    with open(path, newline = "") as f:
+        return [(
+            dt.datetime.fromisoformat(row["time"]), row["side"], de.Decimal(row["quantity"]),
+            de.Decimal(row["price"]), row.get("time_in_force") or "GTC")
+            for row in csv.DictReader(f)]
+
+def synthesize(directory: str, start: dt.datetime, days: int, price: de.Decimal, volatility: float = 0.005, rate: float = 30, size: int = 100, spread: float = 0.003, seed_value: int = 0):
+    """
+    Writes a synthetic price path and user order flow to prices.csv and
+    flow.csv in a directory. The price is a random walk with one step a minute.
+    Users arrive at random, rate an hour on average. Most of them take liquidity
+    with an IOC order that reaches up to spread beyond the price, the rest rest
+    a GTC order on their own side of it.
+
+    Inputs:
+        -> volatility: float, the daily standard deviation of the price's
+           returns.
+        -> rate: float, the average number of user orders an hour.
+        -> size: int, the largest user order.
+        -> spread: float, how far user prices reach from the price, as a
+           fraction of it.
+    """
+    rng = random.Random(seed_value)
+    os.makedirs(directory, exist_ok = True)
+    end = start + dt.timedelta(days = days)
+    step = dt.timedelta(minutes = 1)
+    scale = volatility * math.sqrt(step / dt.timedelta(days = 1))
+
+    path = []
+    t, p = start, float(price)
+    while t < end:
+        path.append((t, de.Decimal(f"{p:.4f}")))
+        p *= math.exp(rng.gauss(0, scale))
+        t += step
+    with open(os.path.join(directory, "prices.csv"), "w", newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(["time", "price"])
+        writer.writerows((t.isoformat(), p) for t, p in path)
+
+    with open(os.path.join(directory, "flow.csv"), "w", newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(["time", "side", "quantity", "price", "time_in_force"])
+        t = start + dt.timedelta(hours = rng.expovariate(rate))
+        while t < end:
+            p = float(path[min(len(path) - 1, int((t - start) / step))][1])
+            side = rng.choice(["bid", "ask"])
+            taking = rng.random() < 0.8
+            # Takers reach across the price, makers stay on their own side.
+            reach = rng.uniform(0, spread) * (1 if taking else -1)
+            limit = p * (1 + reach) if side == "bid" else p * (1 - reach)
+            writer.writerow([
+                t.isoformat(), side, rng.randint(1, size), f"{max(limit, 0.01):.2f}",
+                "IOC" if taking else "GTC"])
+            t += dt.timedelta(hours = rng.expovariate(rate))
+
+class Backtest():
+    """
+    Replays a price path and user order flow against one of our market makers
+    and collects its results one simulated day at a time. Must be run inside
+    the app context of an app with its own empty database.
+    """
+    def __init__(self, bot: str, params: dict, prices: list, flow: list, interval: float = 60):
+        self.kind = bot
+        self.params = dict(defaults[bot], **params)
+        self.prices = prices
+        self.flow = flow
+        self.interval = dt.timedelta(seconds = interval)
+        self.asset_0, self.asset_1, self.account_id = markets[bot]
+        self.price = prices[0][1]
+        self.maker = None
+        self.bot_runs = 0
+        self.bot_time = 0
+
+    def create_accounts(self):
+        for account_id, funds in [(self.account_id, self.params["funds"]), (user_id, de.Decimal("1000000000"))]:
+            a = Account(account_id = account_id, name = f"Backtest {account_id}", hash = "")
+            setattr(a, self.asset_0, funds)
+            setattr(a, self.asset_1, funds)
+            db.session.add(a)
+        db.session.commit()
+
+    def run_bot(self, check_size: bool = False):
+        """
+        Runs our bot, creating it the first time.
+        """
+        start = time.perf_counter()
+        params = self.params
+        if self.maker is None:
+            if self.kind == "fixed":
+                mid = params["mid"]
+                if mid is None:
+                    mid = (self.price / params["offset_2"]).quantize(de.Decimal("1")) * params["offset_2"]
+                self.maker = Backtest_Interval_Market_Maker(
+                    mid, upper_limit = params["upper_limit"], lower_limit = params["lower_limit"],
+                    offset_1 = params["offset_1"], offset_2 = params["offset_2"],
+                    depth = int(params["depth"]), size = params["size"], user = self.account_id)
+            else:
+                self.maker = Backtest_Market_Maker(
+                    self.price, asset_0 = self.asset_0, asset_1 = self.asset_1,
+                    offset = params["offset"], size = params["size"], user = self.account_id)
+        elif self.kind == "fixed":
+            self.maker.main()
+        else:
+            self.maker.price = self.price
+            self.maker.main(self.price if check_size else None)
+        self.bot_runs += 1
+        self.bot_time += time.perf_counter() - start
+
+    def holdings(self):
+        """
+        Returns our bot's balances of asset_0 and asset_1.
+        """
+        a = Account.query.filter_by(account_id = self.account_id).first()
+        return getattr(a, self.asset_0), getattr(a, self.asset_1)
+
+    def events(self):
+        """
+        Yields ("price", time, price) and ("order", time, order) in time order,
+        a price comes before an order at the same time.
+        """
+        prices = (((t, 0), ("price", t, p)) for t, p in self.prices)
+        orders = (((t, 1), ("order", t, o)) for t, *o in self.flow)
+        for _, event in sorted(itertools.chain(prices, orders), key = lambda e: e[0]):
+            yield event
+
+    def run(self):
+        """
+        Returns:
+            -> days: list, of a dict of results for each simulated day.
+        """
+        self.create_accounts()
+        self.start_holdings = self.holdings()
+        self.last = {"order_id": 0, "trade_id": 0, "cancels": 0, "holdings": self.start_holdings, "bot_runs": 0, "bot_time": 0}
+        days = []
+        day, day_start = None, time.perf_counter()
+        next_requote = None
+        for kind, t, value in self.events():
+            if day is not None and t.date() != day:
+                days.append(self.report(day, time.perf_counter() - day_start))
+                day_start = time.perf_counter()
+            day = t.date()
+
+            if kind == "price":
+                self.price = value
+                if self.maker is None or (self.kind == "derivative" and t >= next_requote):
+                    next_requote = t + self.interval
+                    self.run_bot(check_size = True)
+            elif self.maker is not None:
+                side, quantity, price, time_in_force = value
+                result = enter_order(user_id, side, quantity, price, self.asset_0, self.asset_1, time_in_force = time_in_force)
+                if result.trades > 0:
+                    self.run_bot()
+        if day is not None:
+            days.append(self.report(day, time.perf_counter() - day_start))
+        return days
+
+    def report(self, day: dt.date, runtime: float):
+        """
+        Returns the results of the day that has just finished.
+        """
+        bot = self.account_id
+        placed, quoted = db.session.query(func.count(Order.order_id), func.sum(Order.quantity_og)).filter(
+            Order.account_id == bot, Order.order_id > self.last["order_id"]).one()
+        # An order that traded in full is left with nothing, one that still
+        # has a quantity but is no longer active was cancelled.
+        cancels = Order.query.filter(Order.account_id == bot, Order.active == False, Order.quantity > 0).count()
+        trades, volume = db.session.query(func.count(Trade.trade_id), func.sum(Trade.quantity)).filter(
+            Trade.trade_id > self.last["trade_id"], (Trade.buyer == bot) | (Trade.seller == bot)).one()
+        holdings = self.holdings()
+        quoted = quoted or de.Decimal("0")
+        volume = volume or de.Decimal("0")
+
+        def value(h):
+            return h[0] + h[1] * self.price
+        results = {
+            "day": day.isoformat(),
+            "price": self.price,
+            "pnl": value(holdings) - value(self.last["holdings"]),
+            "total_pnl": value(holdings) - value(self.start_holdings),
+            "inventory": holdings[1] - self.start_holdings[1],
+            "trades": trades,
+            "volume": volume,
+            "fill_rate": float(volume / quoted) if quoted else 0.0,
+            "orders": placed,
+            "cancels": cancels - self.last["cancels"],
+            "bot_runs": self.bot_runs - self.last["bot_runs"],
+            "bot_time": self.bot_time - self.last["bot_time"],
+            "runtime": runtime,
+        }
+        self.last = {
+            "order_id": db.session.query(func.max(Order.order_id)).scalar() or 0,
+            "trade_id": db.session.query(func.max(Trade.trade_id)).scalar() or 0,
+            "cancels": cancels, "holdings": holdings,
+            "bot_runs": self.bot_runs, "bot_time": self.bot_time}
+        db.session.rollback()
+        return results
+
+def run_backtest(config: dict):
+    """
+    Runs one backtest on a fresh in-memory database.
+
+    Inputs:
+        -> config: dict, with the bot ("fixed" or "derivative"), its params,
+           the paths of the prices and flow files and the requote interval.
+
+    Returns:
+        -> results: dict, the config with the results of each day and a total.
+    """
+    logging.getLogger("website").setLevel(logging.CRITICAL + 1)
+    app = create_app("sqlite://", journal = False, expiry = False, bots = False)
+    with app.app_context():
+        backtest = Backtest(
+            config["bot"], config.get("params", {}), read_prices(config["prices"]),
+            read_flow(config["flow"]), config.get("interval", 60))
+        days = backtest.run()
+        db.session.remove()
+    total = {
+        "pnl": sum((d["pnl"] for d in days), de.Decimal("0")),
+        "inventory": days[-1]["inventory"] if days else de.Decimal("0"),
+        "trades": sum(d["trades"] for d in days),
+        "volume": sum((d["volume"] for d in days), de.Decimal("0")),
+        "orders": sum(d["orders"] for d in days),
+        "cancels": sum(d["cancels"] for d in days),
+        "runtime": sum(d["runtime"] for d in days),
+    }
+    return dict(config, days = days, total = total)
+
+def sweep(config: dict, grid: dict, processes: int = None):
+    """
+    Runs a backtest for every combination of the parameters in a grid, each in
+    a fresh process so that nothing is shared between them.
+
+    Inputs:
+        -> config: dict, as for run_backtest, the grid's parameters are added
+           to its params.
+        -> grid: dict, of {parameter: list of values}.
+        -> processes: int, defaults to the number of cores.
+
+    Returns:
+        -> results: list, of run_backtest's results for each combination.
+    """
+    names = list(grid)
+    configs = [
+        dict(config, params = dict(config.get("params", {}), **dict(zip(names, values))))
+        for values in itertools.product(*(grid[name] for name in names))]
+    with mp.get_context("spawn").Pool(processes, maxtasksperchild = 1) as pool:
+        return pool.map(run_backtest, configs, chunksize = 1)
+
+def parse_value(bot: str, name: str, value: str):
+    """
+    Turns a parameter given on the command line into the type of its default.
+    """
+    if name not in defaults[bot]:
+        raise SystemExit(f"Unknown parameter {name} for the {bot} bot, try one of {', '.join(defaults[bot])}")
+    return int(value) if name == "depth" else de.Decimal(value)
+
+def print_days(days: list):
+    print(f"{'day':<12}{'price':>10}{'P&L':>12}{'inventory':>12}{'trades':>8}{'fill':>7}{'orders':>8}{'cancels':>8}{'bot runs':>9}{'seconds':>9}")
+    for d in days:
+        print(
+            f"{d['day']:<12}{d['price']:>10}{d['pnl']:>12.2f}{d['inventory']:>12.2f}{d['trades']:>8}"
+            f"{d['fill_rate']:>7.1%}{d['orders']:>8}{d['cancels']:>8}{d['bot_runs']:>9}{d['runtime']:>9.2f}")
+
+def write_json(path: str, results):
+    with open(path, "w") as f:
+        json.dump(results, f, indent = 1, default = str)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Backtest our market making bots offline.")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    synth = commands.add_parser("synth", help = "write a synthetic price path and order flow")
+    synth.add_argument("--out", default = "backtest_data", help = "folder for prices.csv and flow.csv")
+    synth.add_argument("--days", type = int, default = 5)
+    synth.add_argument("--price", default = "26.90", help = "starting price")
+    synth.add_argument("--volatility", type = float, default = 0.005, help = "daily standard deviation of returns")
+    synth.add_argument("--rate", type = float, default = 30, help = "user orders an hour")
+    synth.add_argument("--size", type = int, default = 100, help = "largest user order")
+    synth.add_argument("--spread", type = float, default = 0.003, help = "how far user prices reach, as a fraction")
+    synth.add_argument("--start", default = "2024-01-01T00:00:00")
+    synth.add_argument("--seed", type = int, default = 0)
+
+    for name in ["run", "sweep"]:
+        command = commands.add_parser(name, help = f"{name} a backtest" if name == "run" else "backtest a grid of parameters")
+        command.add_argument("--bot", choices = list(defaults), default = "fixed")
+        command.add_argument("--prices", required = True, help = "CSV of time, price")
+        command.add_argument("--flow", required = True, help = "CSV of time, side, quantity, price, time_in_force")
+        command.add_argument("--interval", type = float, default = 60, help = "seconds between requotes on fresh prices")
+        command.add_argument("--param", action = "append", default = [], help = "name=value, may be repeated")
+        command.add_argument("--json", help = "also write the results to this file")
+        if name == "sweep":
+            command.add_argument("--grid", action = "append", default = [], help = "name=value,value,..., may be repeated")
+            command.add_argument("--processes", type = int, default = None, help = "defaults to the number of cores")
+    args = parser.parse_args()
+
+    if args.command == "synth":
+        synthesize(
+            args.out, dt.datetime.fromisoformat(args.start), args.days, de.Decimal(args.price),
+            args.volatility, args.rate, args.size, args.spread, args.seed)
+        print(f"Wrote {args.out}/prices.csv and {args.out}/flow.csv")
+    else:
+        params = {}
+        for item in args.param:
+            name, value = item.split("=", 1)
+            params[name] = parse_value(args.bot, name, value)
+        config = {"bot": args.bot, "params": params, "prices": args.prices, "flow": args.flow, "interval": args.interval}
+        if args.command == "run":
+            results = run_backtest(config)
+            print_days(results["days"])
+        else:
+            grid = {}
+            for item in args.grid:
+                name, values = item.split("=", 1)
+                grid[name] = [parse_value(args.bot, name, v) for v in values.split(",")]
+            start = time.perf_counter()
+            results = sweep(config, grid, args.processes)
+            print(f"{len(results)} backtests in {time.perf_counter() - start:.1f} seconds")
+            print(f"{'params':<40}{'P&L':>12}{'inventory':>12}{'trades':>8}{'orders':>8}{'seconds':>9}")
+            for r in sorted(results, key = lambda r: r["total"]["pnl"], reverse = True):
+                shown = ", ".join(f"{k}={v}" for k, v in r["params"].items())
+                t = r["total"]
+                print(f"{shown:<40}{t['pnl']:>12.2f}{t['inventory']:>12.2f}{t['trades']:>8}{t['orders']:>8}{t['runtime']:>9.2f}")
+        if args.json:
+            write_json(args.json, results)
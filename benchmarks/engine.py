@@ -0,0 +1,157 @@
+# Replays a synthetic stream of orders, sweeps, cancellations, bot requotes and
+# book reads through the matching engine and reports how fast each of them is.
+#
+#     python -m benchmarks.engine --accounts 50 --resting 2000 --orders 5000
+#
+# For every kind of operation we report the number run, operations per second,
+# the 50th, 95th and 99th percentile latency and the number of SQL statements
+# sent to the database per operation.
+
+import argparse
+import random
+import time
+import decimal as de
+from sqlalchemy import event
+
+from website import db
+from website.matching_engine import enter_order, cancel_order_by_id
+from website.order_book import find_order_book
+from website.tables import get_book
+from website.bots import Deriviative_Market_Maker, bot_6000000
+from benchmarks.seed import create_bench_app, seed, random_price, mids
+
+# How often each kind of operation appears in the stream.
+mix = {
+    "limit": 60,
+    "sweep": 10,
+    "cancel": 20,
+    "requote": 5,
+    "book": 5,
+}
+
+class Bench_Market_Maker(Deriviative_Market_Maker):
+    """
+    The USD/EUR derivative bot with its source price supplied by the benchmark
+    instead of being fetched from the internet.
+    """
+    def __init__(self, price: de.Decimal):
+        self.price = price
+        super().__init__(
+            source = "EUR=X", asset_0 = "EUR", asset_1 = "USD",
+            offset = de.Decimal("0.001"), size = de.Decimal("300"),
+            user = 6010000)
+
+    def query_source(self):
+        return self.price
+
+class Statement_Counter():
+    """
+    Counts the SQL statements that the engine sends to the database.
+    """
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+def make_stream(rng: random.Random, account_ids: list, count: int):
+    """
+    Yields (kind, args) for each operation in the stream. Cancellations are
+    only decided when they run because they need a resting order to cancel.
+    """
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    markets = list(mids)
+    for _ in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        asset_0, asset_1 = rng.choice(markets)
+        side = rng.choice(["bid", "ask"])
+        if kind == "limit":
+            # Mostly resting orders with some that cross the spread.
+            price = random_price(rng, mids[(asset_0, asset_1)], side, crossing = rng.random() < 0.3)
+            quantity = de.Decimal(rng.randint(1, 50))
+            yield kind, (rng.choice(account_ids), side, quantity, price, asset_0, asset_1)
+        elif kind == "sweep":
+            # A large aggressive order that takes out several price levels.
+            price = random_price(rng, mids[(asset_0, asset_1)], side, crossing = True)
+            price = price + (de.Decimal("0.30") if side == "bid" else de.Decimal("-0.30"))
+            quantity = de.Decimal(rng.randint(200, 500))
+            yield kind, (rng.choice(account_ids), side, quantity, max(price, de.Decimal("0.01")), asset_0, asset_1)
+        elif kind == "cancel":
+            yield kind, (asset_0, asset_1)
+        elif kind == "requote":
+            yield kind, (mids[("EUR", "USD")] + de.Decimal(rng.randint(-5, 5)) / 100, )
+        else:
+            yield kind, (asset_0, asset_1)
+
+def run_operation(rng: random.Random, kind: str, args: tuple):
+    if kind in ["limit", "sweep"]:
+        enter_order(*args)
+    elif kind == "cancel":
+        book = find_order_book(*args)
+        if book.entries:
+            cancel_order_by_id(rng.choice(list(book.entries)))
+    elif kind == "requote":
+        Bench_Market_Maker(*args)
+    else:
+        get_book(*args)
+
+def percentile(ordered: list, p: float):
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+def report(results: dict):
+    """
+    Prints one line for each kind of operation and one for the whole stream.
+    """
+    print(f"{'operation':<10}{'count':>8}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'SQL/op':>9}")
+    total_latencies, total_statements = [], 0
+    for kind, (latencies, statements) in sorted(results.items()):
+        total_latencies += latencies
+        total_statements += statements
+        print_line(kind, latencies, statements)
+    print_line("total", total_latencies, total_statements)
+
+def print_line(kind: str, latencies: list, statements: int):
+    if not latencies:
+        return
+    ordered = sorted(latencies)
+    seconds = sum(ordered)
+    print(
+        f"{kind:<10}{len(ordered):>8}{len(ordered) / seconds:>10.0f}"
+        f"{1000 * percentile(ordered, 0.50):>10.2f}"
+        f"{1000 * percentile(ordered, 0.95):>10.2f}"
+        f"{1000 * percentile(ordered, 0.99):>10.2f}"
+        f"{statements / len(ordered):>9.1f}")
+
+def main(accounts: int = 50, resting: int = 2000, orders: int = 5000, seed_value: int = 0, log: bool = False):
+    rng = random.Random(seed_value)
+    app, path = create_bench_app(log = log)
+    print(f"Benchmark database: {path}")
+    with app.app_context():
+        account_ids = seed(accounts, resting, rng)
+        bot_6000000() # Puts the EUR/STN bot's ladder in the book.
+
+        counter = Statement_Counter(db.engine)
+        results = {}
+        for kind, args in make_stream(rng, account_ids, orders):
+            statements = counter.count
+            start = time.perf_counter()
+            run_operation(rng, kind, args)
+            latency = time.perf_counter() - start
+            latencies, total = results.get(kind, ([], 0))
+            latencies.append(latency)
+            results[kind] = (latencies, total + counter.count - statements)
+
+    report(results)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the matching engine with synthetic order flow.")
+    parser.add_argument("--accounts", type = int, default = 50, help = "number of user accounts")
+    parser.add_argument("--resting", type = int, default = 2000, help = "number of resting orders to seed")
+    parser.add_argument("--orders", type = int, default = 5000, help = "number of operations to replay")
+    parser.add_argument("--seed", type = int, default = 0, help = "random seed")
+    parser.add_argument("--log", action = "store_true", help = "keep writing database.log while running")
+    args = parser.parse_args()
+    main(args.accounts, args.resting, args.orders, args.seed, args.log)
@@ -0,0 +1,125 @@
+# Runs each of the queries that the site makes all the time (the books, the
+# market page, the bots, the ledger, the history pages and the admin pages)
+# against a seeded database, asks SQLite how it plans every statement with
+# EXPLAIN QUERY PLAN and fails if any of them scans a whole table.
+#
+#     python -m benchmarks.query_plans
+#
+# The statements are captured as they are sent, so a change to one of the
+# functions below is checked without having to copy its SQL here. Run it after
+# changing a query or the indexes in models.py.
+
+import sys
+import random
+import argparse
+import decimal as de
+from sqlalchemy import event, text
+
+from website import db
+from website.models import Order, Flow
+from website.matching_engine import enter_order
+from website.order_book import load_order_books
+from website.tables import get_book, book_cache, get_my_trades, get_transfers
+from website.market_feed import get_levels
+from website.ledger import get_reserved
+from website.expiry import expire_orders
+from website.flows import get_flow_table
+from benchmarks.seed import create_bench_app, seed, mids
+
+# Tables which only ever hold a handful of rows, scanning them is fine.
+small_tables = ["market", "instrument", "bot", "journal__sequence"]
+
+def hot_queries(account_id: int):
+    """
+    Returns (name, function) for each query that we check, every function is
+    run inside the app context.
+    """
+    asset_0, asset_1 = "STN", "EUR"
+    return [
+        ("order book", lambda: (book_cache.clear(), get_book(asset_0, asset_1))),
+        ("book levels", lambda: get_levels(asset_0, asset_1)),
+        ("load books", load_order_books),
+        ("my orders", lambda: Order.query.filter_by(account_id = account_id, asset_0 = asset_0, asset_1 = asset_1, active = True).all()),
+        ("my bids", lambda: Order.query.filter_by(account_id = account_id, asset_0 = asset_0, side = "bid", active = True).all()),
+        ("my asks", lambda: Order.query.filter_by(account_id = account_id, asset_1 = asset_1, side = "ask", active = True).all()),
+        ("expiring", lambda: Order.query.filter(Order.active == True, Order.expires != None).order_by(Order.expires).first()),
+        ("expire", lambda: expire_orders([1, 2, 3], commit = False)),
+        ("reserved", lambda: get_reserved(account_id)),
+        # The SQL of get_market_trades.
+        ("market trades", lambda: db.session.execute(text(f"""
+            SELECT * FROM Trade
+            WHERE asset_0="{asset_0}" AND asset_1="{asset_1}" AND buyer!=seller AND status=1
+            ORDER BY time DESC""")).fetchmany(7)),
+        ("my trades", lambda: get_my_trades(account_id, 5)),
+        ("my transfers", lambda: get_transfers(account_id, 5)),
+        ("pending flows", get_flow_table),
+        ("my flows", lambda: Flow.query.filter_by(paid_to_id = account_id).all()),
+        # The SQL of the review_interest page.
+        ("pending trades", lambda: db.session.execute(text("SELECT * FROM Trade WHERE status=0 ORDER BY time DESC")).all()),
+    ]
+
+def full_scans(plan: list):
+    """
+    Returns the tables that a query plan reads from start to end. SQLite writes
+    "SCAN <table>" for those, and "SCAN <table> USING ... INDEX" or "SEARCH"
+    when an index is used.
+    """
+    tables = {t.name for t in db.metadata.sorted_tables}
+    scans = []
+    for row in plan:
+        words = row.detail.split()
+        if words[0] == "SCAN" and "INDEX" not in words:
+            table = words[1].strip('"').lower() # Our raw SQL writes Trade for trade.
+            if table in tables:
+                scans.append(table)
+    return [t for t in scans if t not in small_tables]
+
+def check(account_id: int, verbose: bool = False):
+    """
+    Returns the number of queries that scanned a whole table.
+    """
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+
+    failures = 0
+    for name, function in hot_queries(account_id):
+        statements.clear()
+        function()
+        db.session.rollback()
+        captured = list(statements)
+        for statement, parameters in captured:
+            plan = db.session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+            scans = full_scans(plan)
+            if scans or verbose:
+                print(f"{'FULL SCAN' if scans else 'ok':<10}{name}: {' '.join(statement.split())}")
+                for row in plan:
+                    print(f"{'':<10}  {row.detail}")
+            failures += bool(scans)
+        db.session.rollback()
+    event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+    return failures
+
+def main(accounts: int = 20, resting: int = 500, verbose: bool = False):
+    rng = random.Random(0)
+    app, path = create_bench_app()
+    with app.app_context():
+        account_ids = seed(accounts, resting, rng)
+        # A few crossing orders so that there are trades to look up.
+        for (asset_0, asset_1), mid in mids.items():
+            for side in ["bid", "ask"]:
+                price = mid * (de.Decimal("1.1") if side == "bid" else de.Decimal("0.9"))
+                enter_order(account_ids[0], side, de.Decimal("20"), price.quantize(de.Decimal("0.01")), asset_0, asset_1)
+        failures = check(account_ids[0], verbose)
+    print(f"{failures} queries scan a whole table")
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Check that the hot queries use an index.")
+    parser.add_argument("--accounts", type = int, default = 20, help = "number of user accounts")
+    parser.add_argument("--resting", type = int, default = 500, help = "number of resting orders to seed")
+    parser.add_argument("--verbose", action = "store_true", help = "print every query plan")
+    args = parser.parse_args()
+    sys.exit(1 if main(args.accounts, args.resting, args.verbose) else 0)
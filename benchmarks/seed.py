@@ -0,0 +1,92 @@
+# Creates and fills the temporary database that the benchmarks run against.
+
+import os
+import random
+import tempfile
+import logging
+import decimal as de
+
+from website import create_app, db
+from website.models import Account, Order, Instrument
+from website.ledger import rebuild_reserves
+
+currencies = ["STN", "EUR", "USD", "GBP", "JPY", "CAD", "AUD", "CHF", "AOA"]
+
+# The markets that the benchmarks trade in, with a starting mid price.
+mids = {
+    ("STN", "EUR"): de.Decimal("26.90"),
+    ("EUR", "USD"): de.Decimal("0.92"),
+}
+
+def create_bench_app(path: str = None, log: bool = False):
+    """
+    Creates an app which uses a fresh SQLite database in a temporary folder.
+
+    Inputs:
+        -> path: str, where to put the database, defaults to a new temporary
+           folder.
+        -> log: bool, our logger writes a line to database.log for every
+           change, it is switched off unless we want to measure that as well.
+
+    The bots are not run on their markets' events, the benchmarks run them.
+    """
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix = "portal_bench_"), "bench.db")
+    if not log:
+        logging.getLogger("website").setLevel(logging.CRITICAL + 1)
+    app = create_app(f"sqlite:///{path}", bots = False)
+    return app, path
+
+def seed(accounts: int, resting: int, rng: random.Random):
+    """
+    Fills the database with funded accounts and resting orders spread over the
+    benchmark markets. Resting orders never cross, bids sit below the mid price
+    and asks above it. Must be called inside an app context.
+
+    Inputs:
+        -> accounts: int, the number of user accounts.
+        -> resting: int, the number of resting orders.
+        -> rng: random.Random, so runs with the same seed are identical.
+
+    Returns:
+        -> account_ids: list, of the accounts created.
+    """
+    account_ids = [2000000 + i for i in range(accounts)]
+    for account_id in account_ids + [6000000, 6010000]:
+        a = Account(account_id = account_id, name = f"Bench {account_id}", hash = "")
+        for currency in currencies:
+            setattr(a, currency, de.Decimal("1000000"))
+        a.SAVE_EUR = de.Decimal("0")
+        a.RAVE_EUR = de.Decimal("0")
+        db.session.add(a)
+    db.session.add(Instrument(name = "EUR_saving", interest = de.Decimal("0")))
+
+    markets = list(mids)
+    for _ in range(resting):
+        asset_0, asset_1 = rng.choice(markets)
+        side = rng.choice(["bid", "ask"])
+        quantity = de.Decimal(rng.randint(1, 50))
+        price = random_price(rng, mids[(asset_0, asset_1)], side, crossing = False)
+        db.session.add(Order(
+            asset_0 = asset_0, asset_1 = asset_1, side = side, price = price,
+            quantity = quantity, quantity_og = quantity,
+            account_id = rng.choice(account_ids), active = True))
+    db.session.flush()
+    rebuild_reserves()
+    db.session.commit()
+    return account_ids
+
+def random_price(rng: random.Random, mid: de.Decimal, side: str, crossing: bool):
+    """
+    Returns a price a few ticks away from the mid price. Resting prices sit on
+    their own side of the mid, crossing prices reach into the other side.
+    """
+    tick = de.Decimal("0.01")
+    ticks = rng.randint(1, 30)
+    if crossing:
+        ticks = - ticks
+    if side == "bid":
+        price = mid - ticks * tick
+    else:
+        price = mid + ticks * tick
+    return max(price, tick)
@@ -0,0 +1,26 @@
+# This is a script that runs the derivative market makers as a long lived
+# service (see website/bot_service.py), in place of running scheduler.py every
+# few minutes. The app is started once, then the bots requote on fresh prices
+# every interval seconds, the web process requotes them whenever their market
+# trades. It stops after the current run on SIGTERM or Ctrl+C.
+#
+#     python bot_service.py --interval 60 --timeout 30
+
+import signal
+import argparse
+
+from website.bot_service import Bot_Service
+from website import create_app
+
+parser = argparse.ArgumentParser(description = "Run the market making bots as a service.")
+parser.add_argument("--interval", type = float, default = 60, help = "seconds between requotes on fresh prices")
+parser.add_argument("--timeout", type = float, default = 30, help = "seconds that each bot has to finish a run")
+args = parser.parse_args()
+
+# The web process expires the orders.
+app = create_app(expiry = False)
+service = Bot_Service(app, interval = args.interval, timeout = args.timeout)
+signal.signal(signal.SIGTERM, lambda signum, frame: service.stop())
+signal.signal(signal.SIGINT, lambda signum, frame: service.stop())
+service.run()
+print("stop")
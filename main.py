@@ -4,7 +4,10 @@
 
 from website import create_app
 
-app = create_app()
+# The web process is the one that runs our bots when their markets trade and
+# that saves the journal's snapshots.
+app = create_app(bots = True, snapshots = True)
+# app = create_app(shards = True, bots = True, snapshots = True) # Each market's engine in its own process, see website/shards.py
 
 if __name__ == '__main__':
     app.run(host = "0.0.0.0", port = 5000, debug = True)
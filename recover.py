@@ -0,0 +1,27 @@
+# This is a script that rebuilds the database from the event journal, for use
+# after the database has been lost or damaged. It loads the newest snapshot in
+# the journal folder, replays every journal entry written after it and saves
+# the result to a NEW database file, which can be checked and then put in place
+# of instance/database.db.
+#
+#     python recover.py instance/journal instance/recovered.db
+
+import os
+import sys
+
+from website import create_app
+from website.journal import create_db_from_log
+
+if len(sys.argv) != 3:
+    print("Usage: python recover.py <journal folder> <new database file>")
+    sys.exit(1)
+
+journal_path, database_path = sys.argv[1], os.path.abspath(sys.argv[2])
+if os.path.exists(database_path):
+    print(f"{database_path} already exists, we only recover into a new file.")
+    sys.exit(1)
+
+app = create_app(f"sqlite:///{database_path}", journal = False)
+with app.app_context():
+    count = create_db_from_log(journal_path)
+print(f"Replayed {count} journal entries into {database_path}")
@@ -1,18 +1,22 @@
-# from apscheduler.schedulers.blocking import BlockingScheduler
-from website.bots import bot_6010000, bot_6010001, bot_6010002, bot_6010003, bot_6010004, bot_6010005
-from website import create_app
+# This is a script that requotes the derivative market makers, it is run every
+# few minutes by a scheduled task. The prices of all six markets are fetched in
+# one batch and the bots then requote at the same time, each in its own market's
+# sequencer (see run_bots in website/bots.py).
+#
+#     python scheduler.py 30
+#
+# The optional argument is the number of seconds that each bot has to finish.
+# bot_service.py runs the same bots as a long lived process instead.
 
-app = create_app()
+import sys
 
-def bot_601000x_wrapper(app):
-    with app.app_context():
-        # bot_6010000()
-        # bot_6010001()
-        bot_6010002()
-        # bot_6010003()
-        # bot_6010004()
-        # bot_6010005()
+from website.bots import run_bots
+from website import create_app
 
-bot_601000x_wrapper(app)
+timeout = float(sys.argv[1]) if len(sys.argv) > 1 else 30
 
-print("stop")
\ No newline at end of file
+app = create_app()
+with app.app_context():
+    results = run_bots(timeout = timeout)
+for name, result in results.items():
+    print(f"{name}: {result}")
@@ -26,16 +26,38 @@ logging.getLogger('website').setLevel(logging.DEBUG)
 
 logger.info("Initial message to test our logger")
 
-def create_app():
+def create_app(database_uri: str = None, journal: bool = True, shards: bool = False, expiry: bool = True, bots: bool = False, snapshots: bool = False, config: dict = None):
     """
     This function initialises our app to run a website, it was mostly copied
     from this tutorial: https://www.youtube.com/watch?v=dam0GPOAvVI&t=4228s
+
+    Inputs:
+        -> database_uri: str, lets tools such as the benchmarks run the app
+           against a different database, defaults to our database.db.
+        -> journal: bool, whether changes are written to the event journal,
+           recover.py turns this off while it rebuilds a database.
+        -> shards: bool, runs the matching engine of each market in its own
+           worker process, see shards.py.
+        -> expiry: bool, whether this process expires good till time orders,
+           long running helpers such as the bot service leave it to the web
+           process.
+        -> bots: bool, whether our bots requote on their markets' events (see
+           bot_triggers.py). Only the web process (main.py) turns this on, so
+           that each bot is run by one process.
+        -> snapshots: bool, whether this process saves the journal's snapshots
+           of the whole database (see journal.py), only the web process does.
+        -> config: dict, settings such as PRICE_FILE or JOURNAL_PATH, set
+           before anything is started. The shards get theirs this way.
     """
     app = fl.Flask(__name__)
     app.config["SECRET_KEY"] = "keyyy"
 
     # This tells flask the location where the database is stored 
-    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_name}"
+    if database_uri is None:
+        database_uri = f"sqlite:///{db_name}"
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
+    if config is not None:
+        app.config.update(config)
     db.init_app(app)
 
     from website.views import views
@@ -45,19 +67,47 @@ def create_app():
     app.register_blueprint(auth, url_prefix = "/")
 
     from website.models import Order, Account, Payment, Flow, Bot, Trade
-    from website.bots import bot_6000000, bot_6010000
+    from website.matching_engine import cancel_order_by_id
+    from website.order_book import load_order_books
+    from website.ledger import create_reserves
+    from website.candles import create_candles
+    from website.sequencer import get_sequencer
+    from website.journal import start_journal
+    from website.shards import start_shards, Shard_Stopped
+    from website.migrations import migrate
+    from website.expiry import start_expiry
+    from website.bot_triggers import start_bot_triggers
+    from website.users import load_user
 
     create_database(app)
 
+    with app.app_context():
+        # create_all only adds the tables that are missing (such as Market) and
+        # leaves existing tables alone.
+        db.create_all()
+        migrated = migrate()
+        create_reserves()
+        create_candles()
+        load_order_books()
+    if journal:
+        start_journal(app, snapshot = migrated, snapshots = snapshots)
+    if shards:
+        start_shards(app)
+    if expiry:
+        start_expiry(app)
+    if bots:
+        start_bot_triggers(app)
+
     login_manager = fo.LoginManager()
     # login_view tells the manager where to send people who try to access a page 
     # that requires a login auth is the file and login is the function name.
     login_manager.login_view = "auth.login"
     login_manager.init_app(app)
 
+    # A small cached User rather than the whole Account, see users.py.
     @login_manager.user_loader
-    def load_user(id):
-        return Account.query.get(int(id))
+    def user_loader(id):
+        return load_user(int(id))
     
     @app.route("/cancel/<int:id>")
     def cancel_order(id, return_path = None):
@@ -72,20 +122,21 @@ def create_app():
                cancelled from).
         """
         o = Order.query.get_or_404(id) # order to cancel
-
-        o.active = False
-        o.time_cancelled = dt.datetime.now()
-        logger.info(f"OA order_id = {o.order_id}, active = False, time_cancelled = {o.time_cancelled}")
-
-        # db.session.delete(o)
-        db.session.commit()
-        logger.info(f"Database Commit")
-        fl.flash("Pedido cancelado")
-
-        if o.asset_0 == "STN" and o.asset_1 == "EUR" and fo.current_user.account_id != 6000000:
-            bot_6000000()
+        asset_0, asset_1 = o.asset_0, o.asset_1
+
+        # The cancellation is made by the market's sequencer.
+        sequencer = get_sequencer(asset_0, asset_1)
+        try:
+            sequencer.submit(cancel_order_by_id, id, commit = False).result()
+            fl.flash("Pedido cancelado")
+        except Shard_Stopped:
+            # The market's shard died with our job, see shards.py.
+            fl.flash("Erro no mercado, verifique os seus pedidos", category = "e")
+
+        # The market's bot requotes after the cancellation commits, see
+        # bot_triggers.py.
         if return_path is None:
-            return fl.redirect(f"/markets/{o.asset_1}{o.asset_0}")
+            return fl.redirect(f"/markets/{asset_1}{asset_0}")
         else:
             return fl.redirect(return_path)
     
@@ -0,0 +1,150 @@
+# This file moves old history out of the Order and Trade tables. The bots cancel
+# and replace their quotes all day so most of the Order table is inactive
+# orders that nobody looks at again, and every query on it (the market pages,
+# the bots) pays for them. Inactive orders and settled trades older than a
+# given age are moved to one archive database per month, archive-YYYY-MM.db,
+# which keeps the hot tables proportional to what is live.
+
+# The archives are plain SQLite files with the same tables, so the history
+# pages can run the query that they run on the hot table against each archive
+# as well, see query_archives(). Rows are copied with the untyped tables of
+# journal.py, so their times stay as the text that SQLite stored.
+
+# An archive is written and committed before its rows are deleted from the hot
+# tables, the deletes are journaled like any other change. If we stop in
+# between, the next run copies the same rows again, replacing the copies.
+
+import os
+import glob
+import threading
+import datetime as dt
+import flask as fl
+import sqlalchemy as sa
+from sqlalchemy import select, delete, func, text
+
+from website.models import Order, Trade, Bot, Bot_Order
+from website.journal import replay_tables, journal_deletes
+from website.migrations import store_minor_units
+from website.util import utc_now
+from website import db, logger
+
+archived = {"order": Order.__table__, "trade": Trade.__table__}
+
+engines = {} # The engine of each archive file that we have opened.
+engines_lock = threading.Lock()
+
+def get_archive_path():
+    """
+    The archives live in an "archive" folder next to the database unless
+    ARCHIVE_PATH is configured.
+    """
+    directory = fl.current_app.config.get("ARCHIVE_PATH")
+    if directory is None:
+        database = db.engine.url.database
+        base = os.path.dirname(database) if database else fl.current_app.instance_path
+        directory = os.path.join(base, "archive")
+    return directory
+
+def open_archive(path: str):
+    """
+    Returns an engine for an archive file, creating its tables the first time
+    and adding any columns that were added to models.py since it was written.
+    Archives written before we stored amounts as minor units are converted.
+    """
+    with engines_lock:
+        engine = engines.get(path)
+        if engine is None:
+            engine = sa.create_engine(f"sqlite:///{path}")
+            with engine.begin() as connection:
+                for table in archived.values():
+                    table.create(connection, checkfirst = True)
+                    existing = [row[1] for row in connection.execute(text(f'PRAGMA table_info("{table.name}")'))]
+                    for column in table.columns:
+                        if column.name not in existing:
+                            connection.execute(text(
+                                f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(engine.dialect)}'))
+                store_minor_units(connection, archived.values())
+            engines[path] = engine
+    return engine
+
+def query_archives(query, newest_first: bool = True):
+    """
+    Runs a query against every archive in turn and yields the rows. This is a
+    generator, so callers that stop after a few rows never open the older
+    archives.
+
+    Inputs:
+        -> query: str or a select(), the same SQL that is run on the hot
+           tables.
+        -> newest_first: bool, the order in which the months are read.
+    """
+    if isinstance(query, str):
+        query = text(query)
+    paths = sorted(glob.glob(os.path.join(get_archive_path(), "archive-*.db")), reverse = newest_first)
+    for path in paths:
+        with open_archive(path).connect() as connection:
+            for row in connection.execute(query):
+                yield row
+
+def bot_order_ids():
+    """
+    Returns the orders that the bots keep track of, their quotes in the Bot row
+    and their banks in Bot_Order, which we leave in the hot table for the bots
+    to find.
+    """
+    order_ids = set()
+    for bot in Bot.query:
+        for value in [bot.v1, bot.v2]:
+            if value is not None and value > 0:
+                order_ids.add(int(value))
+    order_ids.update(order_id for (order_id,) in db.session.query(Bot_Order.order_id))
+    return order_ids
+
+def archive_old_rows(days: int = 90, batch_size: int = 1000):
+    """
+    Moves the inactive orders and settled trades that are older than a number
+    of days to the monthly archives, a batch at a time.
+
+    Inputs:
+        -> days: int, orders that were cancelled or filled, and trades that
+           were settled, longer ago than this are archived.
+        -> batch_size: int, the number of rows moved in each transaction.
+
+    Returns:
+        -> counts: dict, of {table: rows archived}.
+    """
+    directory = get_archive_path()
+    os.makedirs(directory, exist_ok = True)
+    cutoff = utc_now() - dt.timedelta(days = days)
+    conditions = {
+        # Pending trades (status 0) are still waiting on the administrator.
+        "trade": [Trade.status != 0, Trade.time < cutoff],
+        "order": [
+            Order.active == False,
+            func.max(Order.time_cancelled, Order.time_traded) < cutoff,
+            Order.order_id.not_in(bot_order_ids())],
+    }
+
+    counts = {}
+    for name, where in conditions.items():
+        table, untyped = archived[name], replay_tables[name]
+        key = table.primary_key.columns[0]
+        counts[name] = 0
+        while True:
+            keys = db.session.execute(select(key).where(*where).order_by(key).limit(batch_size)).scalars().all()
+            if not keys:
+                break
+            months = {}
+            for row in db.session.execute(select(untyped).where(untyped.c[key.name].in_(keys))).mappings():
+                months.setdefault(str(row["time"])[:7], []).append(dict(row))
+            for month, rows in months.items():
+                with open_archive(os.path.join(directory, f"archive-{month}.db")).begin() as connection:
+                    connection.execute(untyped.insert().prefix_with("OR REPLACE"), rows)
+
+            db.session.execute(delete(table).where(key.in_(keys)))
+            journal_deletes(db.session(), name, keys)
+            db.session.commit()
+            logger.info(f"Archived {len(keys)} rows of {name}")
+            logger.info(f"Database Commit")
+            counts[name] += len(keys)
+    return counts
@@ -0,0 +1,79 @@
+# This file keeps the derivative market makers running in one long lived
+# process, see bot_service.py at the top of the repository. scheduler.py starts
+# the whole app for every requote, which takes seconds before the bots have
+# done anything. The service starts the app once and keeps each bot between
+# runs, so a requote only costs the bot's own queries.
+
+# Every interval seconds all of the bots requote on freshly fetched prices,
+# checking the size of their quotes as well as their price. Requoting after
+# their markets trade is left to the process that makes the trades, which
+# hears of them on its event bus (see bot_triggers.py).
+
+import time
+import functools
+import threading
+
+from website.bots import derivative_bots, run_bots
+from website import db, logger
+
+class Bot_Service():
+    """
+    Runs a list of bots (see derivative_bots) until stop() is called. Each bot
+    is created on its first run and kept, later runs call its requote().
+    """
+    def __init__(self, app, bots: list = derivative_bots, interval: float = 60, timeout: float = 30):
+        self.app = app
+        self.bots = bots
+        self.interval = interval
+        self.timeout = timeout
+        self.makers = {} # {bot name: the bot's object}, only used by its market's sequencer.
+        self.stopping = threading.Event()
+
+    def stop(self):
+        """
+        Asks the service to stop once the current run has finished, this is
+        safe to call from a signal handler.
+        """
+        self.stopping.set()
+
+    def job(self, bot, check_size: bool):
+        """
+        Returns the job that runs a bot in its market's sequencer, creating the
+        bot the first time. The job returns the bot, see run_bots.
+        """
+        @functools.wraps(bot)
+        def run(source_price = None):
+            maker = self.makers.get(bot.__name__)
+            if maker is None:
+                maker = self.makers[bot.__name__] = bot(source_price)
+            else:
+                maker.requote(check_size, source_price)
+            return maker
+        return run
+
+    def requote(self):
+        """
+        Requotes every bot on freshly fetched prices.
+        """
+        bots = [(self.job(bot, True), source, asset_0, asset_1) for bot, source, asset_0, asset_1 in self.bots]
+        results = run_bots(bots, self.timeout)
+        failed = {name: result for name, result in results.items() if result != "ok"}
+        if failed:
+            logger.error(f"Bot service requote failed for {failed}")
+
+    def run(self):
+        """
+        Runs the service in the calling thread until stop() is called.
+        """
+        with self.app.app_context():
+            logger.info(f"Bot service started with {len(self.bots)} bots")
+            while not self.stopping.is_set():
+                next_requote = time.monotonic() + self.interval
+                try:
+                    self.requote()
+                except Exception as e:
+                    logger.error(f"Bot service run failed: {e!r}")
+                    db.session.rollback()
+                self.stopping.wait(max(0, next_requote - time.monotonic()))
+            db.session.remove()
+            logger.info(f"Bot service stopped")
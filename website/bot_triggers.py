@@ -0,0 +1,98 @@
+# This file runs our market makers in response to their markets. A bot used to
+# be run inside the request of every user who entered or cancelled an order, so
+# the user waited on the bot's whole requote, and every FX order woke the
+# USD/EUR bot whichever market it was in. Instead the matching engine publishes
+# a market's fills and cancellations on the event bus once they commit (see
+# note_market_event in matching_engine.py) and each bot listens to its own
+# market only.
+
+# Every bot has a thread that waits for its market's events. A burst of events
+# is coalesced into a single run: when the thread wakes it waits a moment for
+# the rest of the burst, takes every event in its queue and runs the bot once
+# through the market's sequencer. Events that arrive while the bot runs are all
+# handled by one further run. Events made by the bot itself, such as the
+# cancellations of its own requote, are ignored or a bot would keep waking
+# itself up.
+
+# The triggers only run in the web process, see create_app(bots = True). With
+# shards the fills are made in the shard processes, which forward their events
+# to the web process (see forward_events in shards.py), and the bot's run is
+# sent back to the market's shard like any other job.
+
+import time
+import queue
+import threading
+
+from website.matching_engine import engine_topic
+from website.sequencer import get_sequencer
+from website.events import bus
+from website.bots import bot_6000000, derivative_bots
+from website import logger
+
+# The bots that requote on their market's events, as (bot, account_id, asset_0,
+# asset_1). The bot service (see bot_service.py) requotes the derivative market
+# makers on fresh prices in between.
+triggered_bots = [(bot_6000000, 6000000, "STN", "EUR")] + [
+    (bot, int(bot.__name__[4:]), asset_0, asset_1) for bot, _, asset_0, asset_1 in derivative_bots]
+
+class Bot_Trigger():
+    """
+    Runs a bot in its market's sequencer whenever someone else trades or
+    cancels an order in that market, one run per burst of events.
+    """
+    def __init__(self, app, bot, account_id: int, asset_0: str, asset_1: str, delay: float = 0.05, timeout: float = 30):
+        self.app = app
+        self.bot = bot
+        self.account_id = account_id
+        self.asset_0 = asset_0
+        self.asset_1 = asset_1
+        self.delay = delay # Seconds that we wait for the rest of a burst.
+        self.timeout = timeout
+        self.runs = 0
+        self.subscription = bus.subscribe(engine_topic(asset_0, asset_1))
+        self.thread = threading.Thread(target = self.run, name = f"bot-{bot.__name__}", daemon = True)
+        self.thread.start()
+
+    def wait(self):
+        """
+        Waits for the next events of our market and returns all of them that
+        have queued up. A subscription that was closed because we fell behind
+        is replaced and counts as an event, since we may have missed some.
+        """
+        while True:
+            try:
+                events = [self.subscription.get(timeout = 1)]
+                break
+            except queue.Empty:
+                if self.subscription.closed:
+                    self.subscription = bus.subscribe(self.subscription.topic)
+                    return [{"type": "missed", "account_id": None}]
+        time.sleep(self.delay)
+        while True:
+            try:
+                events.append(self.subscription.queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                events = self.wait()
+                if all(e["account_id"] == self.account_id for e in events):
+                    continue
+                try:
+                    get_sequencer(self.asset_0, self.asset_1).submit_alone(self.bot).result(timeout = self.timeout)
+                    self.runs += 1
+                except Exception as e:
+                    logger.error(f"Bot {self.bot.__name__} failed after {len(events)} events: {e!r}")
+
+triggers = {} # {bot name: Bot_Trigger} of this process, see start_bot_triggers().
+
+def start_bot_triggers(app):
+    """
+    Starts the trigger of every bot in triggered_bots.
+    """
+    for bot, account_id, asset_0, asset_1 in triggered_bots:
+        if bot.__name__ not in triggers:
+            triggers[bot.__name__] = Bot_Trigger(app, bot, account_id, asset_0, asset_1)
+    return triggers
@@ -1,16 +1,17 @@
 # This page has received basic logging.
 
-import yfinance as yf
 import decimal as de
 import flask as fl
 import math
 import time
 
-from website.models import Account, Payment, Flow, Order, Trade, Bot, Instrument
-from website.matching_engine import enter_order
+from website.models import Account, Payment, Flow, Order, Trade, Bot, Bot_Order, Instrument
+from website.matching_engine import enter_order, enter_orders_bulk, apply_ladder
+from website.sequencer import get_sequencer
+from website.prices import get_price_cache
 from website import db, logger, executor
 
-def bot_order(user, side: str, quantity: de.Decimal, price: de.Decimal, asset_0: str, asset_1: str):
+def bot_order(user, side: str, quantity: de.Decimal, price: de.Decimal, asset_0: str, asset_1: str, commit: bool = True, time_in_force: str = "GTC", expires = None):
     """
     The bot order puts enters out order into the market and runs it past the
     matching engine. It differs from the enter_order function in views.py in
@@ -22,61 +23,26 @@ def bot_order(user, side: str, quantity: de.Decimal, price: de.Decimal, asset_0:
         -> side: str,
         -> quantity: de.Decimal
         -> price: de.Decimal
+        -> commit: bool, set to False when the caller will commit.
+        -> time_in_force: str, see enter_order, "IOC" for a bot that only
+           wants to take liquidity and "POST" for one that only wants to add it.
+        -> expires: dt.datetime, in UTC, when the order should leave the book
+           if it has not traded, see expiry.py.
+
+    Returns:
+        -> order_id: int, of the order resting in the book, or False if nothing
+           rests because we had no funds, the order traded in full or it was
+           turned away.
     """
-    # Next, we will check that the user has enough funds to submit this new 
-    # order even after considering any orders they already have in this
-    # market. Note, once we expand to having more than one market this 
-    # function will need to be changed to consider all the user's orders.
-    my_orders = Order.query.filter_by(
-        account_id = user.account_id, asset_0 = asset_0, asset_1 = asset_1, 
-        side = side, active = True)
-
-    if side == "bid":
-        balance_used = sum([o.quantity * o.price for o in my_orders])
-        if asset_0 == "STN":
-            quantity = math.floor(min(quantity, (user.STN - balance_used) / price))
-        elif asset_0 == "EUR":
-            quantity = math.floor(min(quantity, (user.EUR - balance_used) / price))
-        elif asset_0 == "USD":
-            quantity = math.floor(min(quantity, (user.USD - balance_used) / price))
-        elif asset_0 == "GBP":
-            quantity = math.floor(min(quantity, (user.GBP - balance_used) / price))
-        elif asset_0 == "JPY":
-            quantity = math.floor(min(quantity, (user.JPY - balance_used) / price))
-        elif asset_0 == "CAD":
-            quantity = math.floor(min(quantity, (user.CAD - balance_used) / price))
-        elif asset_0 == "AUD":
-            quantity = math.floor(min(quantity, (user.AUD - balance_used) / price))
-        elif asset_0 == "CHF":
-            quantity = math.floor(min(quantity, (user.CHF - balance_used) / price))
-    else: # side == "ask"
-        balance_used = sum([o.quantity for o in my_orders])
-        if asset_0 == "STN":
-            quantity = math.floor(min(quantity, user.STN - balance_used))
-        elif asset_1 == "EUR":
-            quantity = math.floor(min(quantity, user.EUR - balance_used))
-        elif asset_1 == "USD":
-            quantity = math.floor(min(quantity, user.USD - balance_used))
-        elif asset_1 == "GBP":
-            quantity = math.floor(min(quantity, user.GBP - balance_used))
-        elif asset_1 == "JPY":
-            quantity = math.floor(min(quantity, user.JPY - balance_used))
-        elif asset_1 == "CAD":
-            quantity = math.floor(min(quantity, user.CAD - balance_used))
-        elif asset_1 == "AUD":
-            quantity = math.floor(min(quantity, user.AUD - balance_used))
-        elif asset_1 == "CHF":
-            quantity = math.floor(min(quantity, user.CHF - balance_used))
-
-    if quantity == de.Decimal("0"): # We have no funds available for this order.
+    # The funds check, which considers all of the user's active orders, is
+    # made by enter_orders_bulk.
+    result = enter_orders_bulk(
+        user.account_id, [(side, quantity, price)], asset_0, asset_1, commit,
+        time_in_force = time_in_force, expires = expires)[0]
+    if result is None or result.order_id is None:
         return False
 
-    enter_order(user, side, quantity, price, asset_0, asset_1, False)
-
-    # Now we will need to figure out what order we just entered.
-    order = user.orders[-1]
-
-    return order.order_id
+    return result.order_id
 
 class Deriviative_Market_Maker():
     """
@@ -105,13 +71,16 @@ class Deriviative_Market_Maker():
         asset_1: str,
         offset: de.Decimal,
         size: de.Decimal,
-        user: int
+        user: int,
+        source_price: de.Decimal = None
     ):
         self.source = source
         self.asset_0 = asset_0
         self.asset_1 = asset_1
         self.offset = offset
         self.size = size
+        self.user_id = user
+        self.requoted = False # Whether our last run moved our quotes, see main().
         self.user = Account.query.filter_by(account_id = user).first()
 
         self.bot = Bot.query.filter_by(user_id = user).first()
@@ -120,19 +89,36 @@ class Deriviative_Market_Maker():
             db.session.commit()
             self.bot = Bot.query.filter_by(user_id = user).first()
             
-        self.main()
+        self.main(source_price)
+
+    def requote(self, check_size: bool = False, source_price: de.Decimal = None):
+        """
+        Runs the bot again, for a bot that is kept between runs (see
+        bot_service.py). Our Account and Bot rows are loaded again because the
+        session that loaded them has been closed since.
+
+        Inputs:
+            -> check_size: bool, True for the requote every x minutes, which
+               checks the size of our quotes as well as their price, False
+               after a trade.
+            -> source_price: de.Decimal, the price to requote on when checking
+               sizes, None to take it from our price cache.
+        """
+        self.user = Account.query.filter_by(account_id = self.user_id).first()
+        self.bot = Bot.query.filter_by(user_id = self.user_id).first()
+        if check_size and source_price is None:
+            source_price = self.query_source()
+        self.main(source_price if check_size else None)
 
     def query_source(self):
-        data = yf.Ticker(self.source)
-        price = (data.info["bid"] + data.info["ask"]) / 2
-        # A patch because our API normalises Yen in a weird way.
-        if self.source[:3] == "JPY" and price > 0.05:
-            price = price / 100
-        return de.Decimal(price)
+        """
+        Returns the latest price of our source from the shared price cache (see
+        prices.py), which is refreshed in the background so that we never wait
+        on the network. None if the cache has no recent price.
+        """
+        return get_price_cache().get(self.source)
 
     def main(self, source_price = None):
-        orders = Order.query.filter_by(account_id = self.user.account_id, active = True)
-
         # If we did not get given a source price then this check must be caused
         # by a trade, in which case we do not need to check the size of our 
         # orders.
@@ -140,6 +126,11 @@ class Deriviative_Market_Maker():
         if source_price is None:
             check_size = False
             source_price = self.query_source()
+            if source_price is None:
+                # Our quotes stay where they are until we have a fresh price.
+                self.requoted = False
+                logger.warning(f"No recent price for {self.source}, bot {self.user.account_id} did not requote")
+                return
 
         ask_price = (source_price * (1 + self.offset)).quantize(de.Decimal("0.01"), rounding = de.ROUND_UP)
         bid_price = (source_price * (1 - self.offset)).quantize(de.Decimal("0.01"), rounding = de.ROUND_DOWN)
@@ -157,31 +148,18 @@ class Deriviative_Market_Maker():
             ask_size = de.Decimal(math.floor(min(self.size, self.user.CHF)))
         bid_size = de.Decimal(math.floor(min(self.size, self.user.EUR / bid_price)))
         
-        if self.bot.v1 in [-1, 0]:
-            self.bot.v1 = bot_order(self.user, "ask", ask_size, ask_price, asset_0 = self.asset_0, asset_1 = self.asset_1)
-            db.session.commit()
-        else:
-            o = Order.query.get(int(self.bot.v1))
-            if not o.active or o.price != ask_price or (check_size and ask_size != o.quantity):
-                o.active = False
-                logger.info(f"OA order_id = {o.order_id}, active = False")
-                db.session.commit()
-                logger.info(f"Database Commit")
-                self.bot.v1 = bot_order(self.user, "ask", ask_size, ask_price, asset_0 = self.asset_0, asset_1 = self.asset_1)
-                db.session.commit()
-        
-        if self.bot.v2 in [-1, 0]:
-            self.bot.v2 = bot_order(self.user, "bid", bid_size, bid_price, asset_0 = self.asset_0, asset_1 = self.asset_1)
-            db.session.commit()
-        else:
-            o = Order.query.get(int(self.bot.v2))
-            if not o.active or o.price != bid_price or (check_size and bid_size != o.quantity):
-                o.active = False
-                logger.info(f"OA order_id = {o.order_id}, active = False")
-                db.session.commit()
-                logger.info(f"Database Commit")
-                self.bot.v2 = bot_order(self.user, "bid", bid_size, bid_price, asset_0 = self.asset_0, asset_1 = self.asset_1)
-                db.session.commit()
+        # Our quotes are moved to the two that we want in one transaction, a
+        # quote at the right price is left alone unless we are checking sizes.
+        live = Order.query.filter_by(
+            account_id = self.user.account_id, asset_0 = self.asset_0, asset_1 = self.asset_1, active = True).all()
+        target = [("ask", ask_size, ask_price), ("bid", bid_size, bid_price)]
+        keep_size = set() if check_size else {("ask", ask_price), ("bid", bid_price)}
+        self.bot.v1, self.bot.v2 = apply_ladder(
+            self.user.account_id, live, target, self.asset_0, self.asset_1, keep_size, commit = False)
+
+        db.session.commit()
+        logger.info(f"Database Commit")
+        self.requoted = True
         
 class Fixed_Interval_Market_Maker():
     """
@@ -203,6 +181,9 @@ class Fixed_Interval_Market_Maker():
 
     If a whole bank of quotes is taken then the banks will be reestablished with
     a new midpoint one place behind where the last quote used to stand.
+
+    So the ladder that we want only depends on the midpoint. Each run works out
+    the new midpoint and moves our quotes to its ladder in one transaction.
     """
     def __init__(
         self,
@@ -230,72 +211,56 @@ class Fixed_Interval_Market_Maker():
             
         self.main()
 
-    def main(self):
-        orders = Order.query.filter_by(account_id = self.user.account_id)
-
-        # If the banks are empty then we should fill them. In this section we 
-        # have a few checks that the quantities of the last orders are positive
-        # this ensures that they were cancelled rather than traded against. If
-        # They were traded with then we have a different method for changing the
-        # midpoint.
+    def load_banks(self):
+        """
+        Loads our banks, and every order in them, in a single query. The orders
+        are kept in self.orders for the rest of the run.
+
+        Returns:
+            -> bids: list, of the order ids of our bid bank, front first.
+            -> asks: list, of the order ids of our ask bank, front first.
+        """
+        rows = db.session.query(Bot_Order, Order).join(
+            Order, Order.order_id == Bot_Order.order_id
+            ).filter(Bot_Order.bot_id == self.bot.bot_id
+            ).order_by(Bot_Order.side, Bot_Order.position).all()
+        self.rows = {"bid": [], "ask": []}
+        self.orders = {}
+        for row, o in rows:
+            self.rows[row.side].append(row)
+            self.orders[o.order_id] = o
+        bids = [row.order_id for row in self.rows["bid"]]
+        asks = [row.order_id for row in self.rows["ask"]]
+        return bids, asks
 
-        if len(self.bot.bids) == 2: 
-            bids = [] # Empty bank that the split function would handle poorly.
-        else:
-            bids = [int(i) for i in self.bot.bids[1:-1].split(", ")]
-            bid = Order.query.get(bids[-1])
-        if len(self.bot.asks) == 2:
-            asks = [] # Empty bank that the split function would handle poorly.
-        else:
-            asks = [int(i) for i in self.bot.asks[1:-1].split(", ")]
-            ask = Order.query.get(asks[-1])
+    def order(self, order_id: int):
+        """
+        Returns one of our orders, those entered during this run are not in
+        self.orders and come from the session.
+        """
+        o = self.orders.get(order_id)
+        if o is None:
+            o = db.session.get(Order, order_id)
+            self.orders[order_id] = o
+        return o
+
+    def save_bank(self, side: str, order_ids: list):
+        """
+        Writes one of our banks, reusing its Bot_Order rows so that only the
+        positions that changed are updated.
+        """
+        rows = self.rows[side]
+        for position, order_id in enumerate(order_ids):
+            if position < len(rows):
+                rows[position].order_id = order_id
+            else:
+                row = Bot_Order(bot_id = self.bot.bot_id, side = side, position = position, order_id = order_id)
+                db.session.add(row)
+                rows.append(row)
+        for row in rows[len(order_ids):]:
+            db.session.delete(row)
+        del rows[len(order_ids):]
 
-        # Are both banks blank requiring a relaunch?
-        if (len(bids) == 0 and len(asks) == 0) or (len(bids) == 0 and len(asks) > 0 and not ask.active) or (len(bids) > 0 and not bid.active and len(asks) == 0) or (len(asks) > 0 and not ask.active and len(bids) > 0 and not bid.active):
-            self.cancel_all(orders.filter_by(active = True))
-            bids, asks = [], []
-            self.bot.v1 = self.set_mid()
-            self.establish_banks(bids, asks)
-            return
-                
-        # Was our last bid taken?
-        if len(bids) > 0 and not bid.active:
-            self.cancel_all(orders.filter_by(active = True))
-            bids, asks = [], []
-            self.bot.v1 = bid.price - self.offset_2
-            self.establish_banks(bids, asks)
-            return
-        
-        # Was our last ask taken?
-        if len(asks) > 0 and not ask.active:
-            self.cancel_all(orders.filter_by(active = True))
-            bids, asks = [], []
-            self.bot.v1 = ask.price + self.offset_2
-            self.establish_banks(bids, asks)
-            return
-        
-        if len(bids) > 0:
-            bid = Order.query.get(bids[0])
-            while not bid.active:
-                # Our first bid has been taken out, we will adjust both banks.
-                bids, asks = self.check_bid_bank(bid, bids, asks)
-                if len(bids) == 0:
-                    break
-                else:
-                    bid = Order.query.get(bids[0])
-
-        if len(asks) > 0:
-            ask = Order.query.get(asks[0])
-            while not ask.active:
-                # Our first ask has been taken out, we will adjust both banks.
-                bids, asks = self.check_ask_bank(ask, bids, asks)
-                if len(asks) == 0:
-                    break
-                else:
-                    ask = Order.query.get(asks[0])
-        
-        return
-        
     def set_mid(self):
         # p = (self.upper_limit + self.lower_limit) / 2
         # floor = self.upper_limit - self.offset_1 - self.depth * self.offset_2
@@ -305,224 +270,90 @@ class Fixed_Interval_Market_Maker():
         # return str(mid)
         return de.Decimal("26.90")
 
-    def establish_banks(self, bids, asks):
-        mid = self.bot.v1
-
+    def ladder(self, mid: de.Decimal):
+        """
+        Returns the quotes that we want around a midpoint as (side, quantity,
+        price) tuples, the front of each bank first. Quotes outside of our
+        limits are left out.
+        """
+        orders = []
         for i in range(self.depth):
 
             price = mid - self.offset_1 - i * self.offset_2
             if price >= self.lower_limit:
-                id = bot_order(self.user, "bid", self.size, price, asset_0 = "STN", asset_1 = "EUR")
-                if id != False:
-                    bids.append(id)
+                orders.append(("bid", self.size, price))
 
             price = mid + self.offset_1 + i * self.offset_2
             if price <= self.upper_limit:
-                id = bot_order(self.user, "ask", self.size, price, asset_0 = "STN", asset_1 = "EUR")
-                if id != False:
-                    asks.append(id)
-        
-        self.bot.bids = str(bids)
-        self.bot.asks = str(asks)
-        db.session.commit()
-        logger.info(f"Database Commit")
-    
-    def cancel_all(self, orders):
-        for o in orders:
-            o.active = False
-            logger.info(f"OA order_id = {o.order_id}, active = False")
-        self.bot.bids = "[]"
-        self.bot.asks = "[]"
+                orders.append(("ask", self.size, price))
+        return orders
+
+    def requote(self, mid: de.Decimal, keep_front: bool = False):
+        """
+        Moves our quotes to the ladder around a midpoint and saves our banks,
+        all in one transaction (see apply_ladder).
+
+        Inputs:
+            -> mid: de.Decimal, the new midpoint.
+            -> keep_front: bool, True to leave the front quote of each bank at
+               whatever size it has been taken down to, the others are
+               restored to full size.
+        """
+        self.bot.v1 = mid
+        target = self.ladder(mid)
+        live = Order.query.filter_by(account_id = self.user.account_id, asset_0 = "STN", asset_1 = "EUR", active = True).all()
+        keep_size = set()
+        if keep_front:
+            for side in ["bid", "ask"]:
+                front = next((price for s, _, price in target if s == side), None)
+                if front is not None:
+                    keep_size.add((side, front))
+
+        order_ids = apply_ladder(self.user.account_id, live, target, "STN", "EUR", keep_size, commit = False)
+        self.save_bank("bid", [i for (side, _, _), i in zip(target, order_ids) if side == "bid" and i])
+        self.save_bank("ask", [i for (side, _, _), i in zip(target, order_ids) if side == "ask" and i])
         db.session.commit()
         logger.info(f"Database Commit")
 
     def main(self):
-        orders = Order.query.filter_by(account_id = self.user.account_id)
-
         # If the banks are empty then we should fill them. In this section we 
         # have a few checks that the quantities of the last orders are positive
         # this ensures that they were cancelled rather than traded against. If
         # They were traded with then we have a different method for changing the
         # midpoint.
 
-        if len(self.bot.bids) == 2: 
-            bids = [] # Empty bank that the split function would handle poorly.
-        else:
-            bids = [int(i) for i in self.bot.bids[1:-1].split(", ")]
-            bid = Order.query.get(bids[-1])
-        if len(self.bot.asks) == 2:
-            asks = [] # Empty bank that the split function would handle poorly.
-        else:
-            asks = [int(i) for i in self.bot.asks[1:-1].split(", ")]
-            ask = Order.query.get(asks[-1])
+        bids, asks = self.load_banks()
+        if len(bids) > 0:
+            bid = self.order(bids[-1])
+        if len(asks) > 0:
+            ask = self.order(asks[-1])
 
         # Are both banks blank requiring a relaunch?
         if (len(bids) == 0 and len(asks) == 0) or (len(bids) == 0 and len(asks) > 0 and not ask.active) or (len(bids) > 0 and not bid.active and len(asks) == 0) or (len(asks) > 0 and not ask.active and len(bids) > 0 and not bid.active):
-            self.cancel_all(orders.filter_by(active = True))
-            bids, asks = [], []
-            self.bot.v1 = self.set_mid()
-            self.establish_banks(bids, asks)
+            self.requote(self.set_mid())
             return
                 
         # Was our last bid taken?
         if len(bids) > 0 and not bid.active:
-            self.cancel_all(orders.filter_by(active = True))
-            bids, asks = [], []
-            self.bot.v1 = bid.price - self.offset_2
-            self.establish_banks(bids, asks)
+            self.requote(bid.price - self.offset_2)
             return
         
         # Was our last ask taken?
         if len(asks) > 0 and not ask.active:
-            self.cancel_all(orders.filter_by(active = True))
-            bids, asks = [], []
-            self.bot.v1 = ask.price + self.offset_2
-            self.establish_banks(bids, asks)
+            self.requote(ask.price + self.offset_2)
             return
-        
-        if len(bids) > 0:
-            bid = Order.query.get(bids[0])
-            while not bid.active:
-                # Our first bid has been taken out, we will adjust both banks.
-                bids, asks = self.check_bid_bank(bid, bids, asks)
-                if len(bids) == 0:
-                    break
-                else:
-                    bid = Order.query.get(bids[0])
-
-        if len(asks) > 0:
-            ask = Order.query.get(asks[0])
-            while not ask.active:
-                # Our first ask has been taken out, we will adjust both banks.
-                bids, asks = self.check_ask_bank(ask, bids, asks)
-                if len(asks) == 0:
-                    break
-                else:
-                    ask = Order.query.get(asks[0])
-        
-        return
-
-    def check_bid_bank(self, bid, bids, asks):
-        # First, we will put a new bid at the back of the bank.
-        last_bid = Order.query.get(bids[-1])
-        price = last_bid.price - self.offset_2
-        id = False
-        if price >= self.lower_limit and price <= self.upper_limit:
-            id = bot_order(self.user, "bid", self.size, price, asset_0 = "STN", asset_1 = "EUR")
-        if id != False:
-            bids = bids[1:] + [id]
-        else: 
-            # If we didn't try to enter an order, or tried and failed.
-            bids = bids[1:]
-        self.bot.bids = str(bids)
-        db.session.commit()
-        logger.info(f"Database Commit")
-
-        # Second, if we have a full bank of asks then cancel the last one.
-        if len(asks) == self.depth:
-            last_ask = Order.query.get(asks[-1])
-            last_ask.active = False
-            logger.info(f"OA order_id = {last_ask.order_id}, active = False")
-            asks = asks[:-1]
-            self.bot.asks = str(asks)
-            db.session.commit()
-            logger.info(f"Database Commit")
-
-        if len(asks) > 0:
-            ask = Order.query.get(asks[0])
-            
-            # Thirdly, If our top ask is depleted then we will restore it.
-            if ask.quantity != ask.quantity_og:
-                id = bot_order(self.user, "ask", self.size, ask.price, asset_0 = "STN", asset_1 = "EUR")
-                if id != False:
-                    ask.active = False
-                    logger.info(f"OA order_id = {ask.order_id}, active = False")
-                    asks[0] = id
-                    self.bot.asks = str(asks)
-                    db.session.commit()
-                    logger.info(f"Database Commit")
-
-            # Next we will place a new ask at the front of the bank.
-            id = bot_order(self.user, "ask", self.size, ask.price - self.offset_2, asset_0 = "STN", asset_1 = "EUR")
-            if id != False:
-                asks = [id] + asks
-                self.bot.asks = str(asks)
-                db.session.commit()
-                logger.info(f"Database Commit")
-                
-        else:
-            # We will now start the ask bank.
-            price = bid.price + 2 * self.offset_1
-            if price >= self.lower_limit and price <= self.upper_limit:
-                id = bot_order(self.user, "ask", self.size, price, asset_0 = "STN", asset_1 = "EUR")
-                if id != False:
-                    asks = [id]
-                    self.bot.asks = str(asks)
-                    db.session.commit()
-                    logger.info(f"Database Commit")
-    
-        return bids, asks
-    
-    def check_ask_bank(self, ask, bids, asks):
-        # First, we will put a new ask at the back of the bank.
-        last_ask = Order.query.get(asks[-1])
-        price = last_ask.price + self.offset_2
-        id = False
-        if price >= self.lower_limit and price <= self.upper_limit:
-            id = bot_order(self.user, "ask", self.size, price, asset_0 = "STN", asset_1 = "EUR")
-        if id != False:
-            asks = asks[1:] + [id]
-        else: 
-            # If we didn't try to enter an order, or tried and failed.
-            asks = asks[1:]
-        self.bot.asks = str(asks)
-        db.session.commit()
-        logger.info(f"Database Commit")
-
-        # Second, if we have a full bank of bids then cancel the last one.
-        if len(bids) == self.depth:
-            last_bid = Order.query.get(bids[-1])
-            last_bid.active = False
-            logger.info(f"OA order_id = {last_bid.order_id}, active = False")
-            bids = bids[:-1]
-            self.bot.bids = str(bids)
-            db.session.commit()
-            logger.info(f"Database Commit")
 
+        # Every quote taken from the front of a bank moves the whole ladder
+        # one place towards it.
+        taken_bids = next((i for i, order_id in enumerate(bids) if self.order(order_id).active), len(bids))
+        taken_asks = next((i for i, order_id in enumerate(asks) if self.order(order_id).active), len(asks))
+        if taken_bids == 0 and taken_asks == 0:
+            return
         if len(bids) > 0:
-            bid = Order.query.get(bids[0])
-            
-            # Thirdly, If our top bid is depleted then we will restore it.
-            if bid.quantity != bid.quantity_og:
-                id = bot_order(self.user, "bid", self.size, bid.price, asset_0 = "STN", asset_1 = "EUR")
-                if id != False:
-                    bid.active = False
-                    logger.info(f"OA order_id = {bid.order_id}, active = False")
-                    bids[0] = id
-                    self.bot.bids = str(bids)
-                    db.session.commit()
-                    logger.info(f"Database Commit")
-
-            # Next we will place a new bid at the front of the bank.
-            id = bot_order(self.user, "bid", self.size, bid.price + self.offset_2, asset_0 = "STN", asset_1 = "EUR")
-            if id != False:
-                bids = [id] + bids
-                self.bot.bids = str(bids)
-                db.session.commit()
-                logger.info(f"Database Commit")
-                
+            mid = self.order(bids[0]).price + self.offset_1
         else:
-            # We will now start the bid bank.
-            price = ask.price - 2 * self.offset_1
-            if price >= self.lower_limit and price <= self.upper_limit:
-                id = bot_order(self.user, "bid", self.size, price, asset_0 = "STN", asset_1 = "EUR")
-                if id != False:
-                    bids = [id]
-                    self.bot.asks = str(bids)
-                    db.session.commit()
-                    logger.info(f"Database Commit")
-
-        return bids, asks
+            mid = self.order(asks[0]).price - self.offset_1
+        self.requote(mid + (taken_asks - taken_bids) * self.offset_2, keep_front = True)
 
 def bot_6000000():
     """
@@ -539,7 +370,7 @@ def bot_6000000():
     )
 
 # @app.route("/start/6010000")
-def bot_6010000():
+def bot_6010000(source_price: de.Decimal = None):
     """
     Runs the derivative market making bot in the USD/EUR market.
     """
@@ -549,10 +380,11 @@ def bot_6010000():
         asset_1 = "USD",
         offset = de.Decimal("0.001"),
         size = de.Decimal("300"),
-        user = 6010000
+        user = 6010000,
+        source_price = source_price
     )
 
-def bot_6010001():
+def bot_6010001(source_price: de.Decimal = None):
     """
     Runs the derivative market making bot in the GBP/EUR market.
     """
@@ -562,10 +394,11 @@ def bot_6010001():
         asset_1 = "GBP",
         offset = de.Decimal("0.001"),
         size = de.Decimal("300"),
-        user = 6010001
+        user = 6010001,
+        source_price = source_price
     )
 
-def bot_6010002():
+def bot_6010002(source_price: de.Decimal = None):
     """
     Runs the derivative market making bot in the JPY/EUR market.
     """
@@ -575,10 +408,11 @@ def bot_6010002():
         asset_1 = "JPY",
         offset = de.Decimal("0.001"),
         size = de.Decimal("300"),
-        user = 6010002
+        user = 6010002,
+        source_price = source_price
     )
 
-def bot_6010003():
+def bot_6010003(source_price: de.Decimal = None):
     """
     Runs the derivative market making bot in the CAD/EUR market.
     """
@@ -588,10 +422,11 @@ def bot_6010003():
         asset_1 = "CAD",
         offset = de.Decimal("0.001"),
         size = de.Decimal("300"),
-        user = 6010003
+        user = 6010003,
+        source_price = source_price
     )
 
-def bot_6010004():
+def bot_6010004(source_price: de.Decimal = None):
     """
     Runs the derivative market making bot in the AUD/EUR market.
     """
@@ -601,10 +436,11 @@ def bot_6010004():
         asset_1 = "AUD",
         offset = de.Decimal("0.001"),
         size = de.Decimal("300"),
-        user = 6010004
+        user = 6010004,
+        source_price = source_price
     )
 
-def bot_6010005():
+def bot_6010005(source_price: de.Decimal = None):
     """
     Runs the derivative market making bot in the CHF/EUR market.
     """
@@ -614,5 +450,63 @@ def bot_6010005():
         asset_1 = "CHF",
         offset = de.Decimal("0.001"),
         size = de.Decimal("300"),
-        user = 6010005
-    )
\ No newline at end of file
+        user = 6010005,
+        source_price = source_price
+    )
+
+# The derivative market makers as (bot, source, asset_0, asset_1).
+derivative_bots = [
+    (bot_6010000, "EUR=X", "EUR", "USD"),
+    (bot_6010001, "GBPEUR=X", "EUR", "GBP"),
+    (bot_6010002, "JPYEUR=X", "EUR", "JPY"),
+    (bot_6010003, "CADEUR=X", "EUR", "CAD"),
+    (bot_6010004, "AUDEUR=X", "EUR", "AUD"),
+    (bot_6010005, "CHFEUR=X", "EUR", "CHF"),
+]
+
+def run_bots(bots: list = derivative_bots, timeout: float = 30, refresh: bool = True):
+    """
+    Requotes several derivative market makers at once. The prices of all their
+    sources are fetched in one batch first, then each bot runs in the
+    sequencer of its own market, which gives it its own thread, app context and
+    database session. A full requote takes about as long as one fetch.
+
+    Each bot is handed its price from this process's cache, the bot may run in
+    a shard (see shards.py) whose own cache has not fetched it.
+
+    A bot that fails or takes longer than the timeout is reported and does not
+    hold up the others. Must be called inside an app context.
+
+    Inputs:
+        -> bots: list, of (bot, source, asset_0, asset_1) like derivative_bots.
+        -> timeout: float, the seconds that each bot has to finish.
+        -> refresh: bool, whether to fetch the prices first, False for bots
+           reacting to trades which quote on the cached prices.
+
+    Returns:
+        -> results: dict, of {bot name: "ok", "no price", "timeout" or the
+           error}, "no price" for a bot that kept its quotes because it had
+           no recent price.
+    """
+    cache = get_price_cache()
+    if refresh:
+        cache.refresh([source for _, source, _, _ in bots])
+    # Without a refresh the bots react to trades, on the prices that they have.
+    futures = [
+        (bot.__name__, get_sequencer(asset_0, asset_1).submit_alone(
+            bot, source_price = cache.get(source) if refresh else None))
+        for bot, source, asset_0, asset_1 in bots]
+
+    # The bots all start together, so they share a deadline.
+    deadline = time.monotonic() + timeout
+    results = {}
+    for name, future in futures:
+        try:
+            maker = future.result(timeout = max(deadline - time.monotonic(), 0))
+            results[name] = "ok" if maker.requoted else "no price"
+        except TimeoutError:
+            logger.error(f"Bot {name} did not finish within {timeout} seconds")
+            results[name] = "timeout"
+        except Exception as e: # Already logged by the sequencer.
+            results[name] = repr(e)
+    return results
@@ -0,0 +1,157 @@
+# This file keeps the candles of each market, the open, high, low and close
+# price and the volume traded over every minute, hour and day. The matching
+# engine adds its trades to the candles as it records them, so charts and price
+# histories read a handful of Candle rows instead of scanning every Trade.
+
+# Candles are worked out from the trades and are not journaled, they can always
+# be built again from the Trade table with backfill_candles().
+
+import datetime as dt
+import itertools
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert
+
+from website.models import Trade, Candle
+from website.order_book import markets
+from website.util import utc_now
+from website import db
+
+# The length of each kind of candle in seconds.
+intervals = {"1m": 60, "1h": 3600, "1d": 86400}
+
+def candle_start(time: dt.datetime, interval: str):
+    """
+    Returns the start of the candle that a time falls in.
+    """
+    seconds = intervals[interval]
+    epoch = dt.datetime(1970, 1, 1)
+    return epoch + dt.timedelta(seconds = (time - epoch) // dt.timedelta(seconds = 1) // seconds * seconds)
+
+def upsert_candles():
+    """
+    Returns an insert statement which merges a candle into the row of the same
+    market, interval and start if there is one.
+    """
+    stmt = insert(Candle)
+    return stmt.on_conflict_do_update(
+        index_elements = ["asset_0", "asset_1", "interval", "start"],
+        set_ = {
+            "high": func.max(Candle.high, stmt.excluded.high),
+            "low": func.min(Candle.low, stmt.excluded.low),
+            "close": stmt.excluded.close,
+            "volume": Candle.volume + stmt.excluded.volume,
+            "trades": Candle.trades + stmt.excluded.trades,
+        })
+
+def make_candle(asset_0: str, asset_1: str, interval: str, start: dt.datetime, price, quantity):
+    return {
+        "asset_0": asset_0, "asset_1": asset_1, "interval": interval,
+        "start": start, "open": price, "high": price, "low": price,
+        "close": price, "volume": quantity, "trades": 1}
+
+def add_to_candle(candle: dict, price, quantity):
+    candle["high"] = max(candle["high"], price)
+    candle["low"] = min(candle["low"], price)
+    candle["close"] = price
+    candle["volume"] += quantity
+    candle["trades"] += 1
+
+def record_trades(asset_0: str, asset_1: str, trades: list, time: dt.datetime = None):
+    """
+    Adds trades that have just happened to the candles of their market, every
+    interval is updated in a single statement.
+
+    Inputs:
+        -> trades: list, of (price, quantity) in the order that they traded.
+        -> time: dt.datetime, when the trades happened in UTC, defaults to now.
+    """
+    if not trades:
+        return
+    if time is None:
+        # Trade.time comes from the database's clock which counts in whole
+        # seconds.
+        time = utc_now().replace(microsecond = 0)
+    candles = []
+    for interval in intervals:
+        candle = None
+        for price, quantity in trades:
+            if candle is None:
+                candle = make_candle(asset_0, asset_1, interval, candle_start(time, interval), price, quantity)
+            else:
+                add_to_candle(candle, price, quantity)
+        candles.append(candle)
+    db.session.execute(upsert_candles().values(candles))
+
+def backfill_candles(batch_size: int = 1000):
+    """
+    Builds every candle again from the Trade table, and the trades archived
+    before it, in one pass. Trades are read in order and only the candle
+    currently open for each market and interval is kept in memory, finished
+    candles are written out in batches.
+
+    Returns:
+        -> count: int, the number of trades added to candles.
+    """
+    from website.archive import query_archives
+
+    db.session.execute(Candle.__table__.delete())
+    query = (
+        select(Trade.asset_0, Trade.asset_1, Trade.time, Trade.price, Trade.quantity)
+        .where(Trade.status == 1, Trade.buyer != Trade.seller)
+        .order_by(Trade.trade_id)
+        .execution_options(yield_per = batch_size))
+    rows = itertools.chain(query_archives(query, newest_first = False), db.session.execute(query))
+
+    open_candles, finished, count = {}, [], 0
+    for asset_0, asset_1, time, price, quantity in rows:
+        if (asset_0, asset_1) not in markets:
+            continue # Such as savings withdrawals.
+        count += 1
+        for interval in intervals:
+            start = candle_start(time, interval)
+            candle = open_candles.get((asset_0, asset_1, interval))
+            if candle is not None and candle["start"] == start:
+                add_to_candle(candle, price, quantity)
+                continue
+            if candle is not None:
+                finished.append(candle)
+            open_candles[(asset_0, asset_1, interval)] = make_candle(asset_0, asset_1, interval, start, price, quantity)
+        if len(finished) >= batch_size:
+            db.session.execute(upsert_candles(), finished)
+            finished = []
+    finished += open_candles.values()
+    if finished:
+        db.session.execute(upsert_candles(), finished)
+    return count
+
+def create_candles():
+    """
+    Builds the candles the first time the app runs against a database which has
+    trades but no candles.
+    """
+    if Candle.query.first() is None and Trade.query.filter_by(status = 1).first() is not None:
+        backfill_candles()
+        db.session.commit()
+
+def get_candles(asset_0: str, asset_1: str, interval: str, start: dt.datetime = None, end: dt.datetime = None, limit: int = 500):
+    """
+    Returns the candles of a market between two times, oldest first. Without a
+    start we return the latest candles.
+
+    Returns:
+        -> candles: list, of [start, open, high, low, close, volume, trades]
+           with the times in ISO format and the amounts as strings.
+    """
+    query = Candle.query.filter_by(asset_0 = asset_0, asset_1 = asset_1, interval = interval)
+    if start is not None:
+        query = query.filter(Candle.start >= start).order_by(Candle.start)
+    else:
+        query = query.order_by(Candle.start.desc())
+    if end is not None:
+        query = query.filter(Candle.start < end)
+    candles = query.limit(limit).all()
+    if start is None:
+        candles.reverse()
+    return [
+        [c.start.isoformat(), str(c.open), str(c.high), str(c.low), str(c.close), str(c.volume), c.trades]
+        for c in candles]
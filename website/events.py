@@ -0,0 +1,63 @@
+# This file is a small publish/subscribe bus that lets one part of the app tell
+# any number of listeners that something happened, for example the market feed
+# telling every open market page that the book has changed. Messages are
+# grouped by topic and each subscriber gets its own queue.
+
+# The bus only reaches listeners inside this process.
+
+import queue
+import threading
+
+class Subscription():
+    """
+    One listener's queue of messages for a topic. If the listener falls too far
+    behind then the subscription is closed rather than letting it hold up
+    everyone else, the listener should start again from a fresh snapshot.
+    """
+    def __init__(self, topic: str, maxsize: int = 1000):
+        self.topic = topic
+        self.queue = queue.Queue(maxsize)
+        self.closed = False
+
+    def get(self, timeout: float = None):
+        """
+        Waits for the next message, raises queue.Empty after timeout seconds.
+        """
+        return self.queue.get(timeout = timeout)
+
+class Event_Bus():
+    def __init__(self):
+        self.topics = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, topic: str, maxsize: int = 1000):
+        subscription = Subscription(topic, maxsize)
+        with self.lock:
+            self.topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            subscriptions = self.topics.get(subscription.topic, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.topics.pop(subscription.topic, None)
+
+    def has_subscribers(self, topic: str):
+        return topic in self.topics
+
+    def publish(self, topic: str, message):
+        """
+        Hands a message to every subscriber of a topic without waiting on any
+        of them.
+        """
+        with self.lock:
+            subscriptions = list(self.topics.get(topic, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                subscription.closed = True
+                self.unsubscribe(subscription)
+
+bus = Event_Bus()
@@ -0,0 +1,135 @@
+# This file expires good till time orders, orders that were entered with an
+# expiry time and should leave the book once it passes. Rather than searching
+# the Order table for expired orders every so often, we keep a heap of the
+# resting orders that have an expiry, ordered by expiry time, and a thread that
+# sleeps until the first of them is due.
+
+# Expired orders are cancelled through each market's sequencer with
+# deactivate_order, the same path as a user's cancellation, so the book, the
+# reserved funds and the market version (which the cached books depend on) are
+# all updated together.
+
+import heapq
+import time
+import threading
+import multiprocessing as mp
+from sqlalchemy import event, func
+
+from website.models import Order
+from website.matching_engine import deactivate_order
+from website.sequencer import get_sequencer
+from website.util import utc_now
+from website import db, logger
+
+def expire_orders(order_ids: list, commit: bool = True):
+    """
+    Cancels those of the given orders that are still active and whose expiry
+    time has passed, the others are left alone.
+
+    Returns:
+        -> count: int, the number of orders expired.
+    """
+    orders = Order.query.filter(
+        Order.order_id.in_(order_ids), Order.active == True,
+        Order.expires <= utc_now()).all()
+    for o in orders:
+        deactivate_order(o)
+    if commit:
+        db.session.commit()
+        logger.info(f"Database Commit")
+    return len(orders)
+
+class Expiry_Scheduler():
+    """
+    A heap of (expires, order_id, asset_0, asset_1) for the resting orders that
+    have an expiry. Orders entered in this process are added when their
+    transaction commits, orders entered by other processes (such as
+    scheduler.py) are picked up every resync_interval seconds by loading the
+    orders that we have not seen yet. Entries for orders that have since traded
+    or been cancelled are simply skipped by expire_orders.
+    """
+    def __init__(self, app, resync_interval: float = 300):
+        self.app = app
+        self.resync_interval = resync_interval
+        self.heap = []
+        self.last_order_id = 0 # We have loaded every order up to this one.
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target = self.run, name = "expiry", daemon = True)
+        self.thread.start()
+
+    def add(self, entries: list):
+        with self.condition:
+            for entry in entries:
+                heapq.heappush(self.heap, entry)
+            self.condition.notify()
+
+    def load(self):
+        last_order_id = db.session.query(func.max(Order.order_id)).scalar() or 0
+        rows = db.session.query(
+            Order.expires, Order.order_id, Order.asset_0, Order.asset_1
+            ).filter(
+                Order.order_id > self.last_order_id, Order.order_id <= last_order_id,
+                Order.active == True, Order.expires != None)
+        self.add([tuple(row) for row in rows])
+        self.last_order_id = last_order_id
+
+    def run(self):
+        with self.app.app_context():
+            next_load = 0
+            while True:
+                if time.monotonic() >= next_load:
+                    try:
+                        self.load()
+                    except Exception as e:
+                        logger.error(f"Expiry load failed: {e!r}")
+                    finally:
+                        db.session.remove()
+                    next_load = time.monotonic() + self.resync_interval
+
+                with self.condition:
+                    now = utc_now()
+                    due = []
+                    while self.heap and self.heap[0][0] <= now:
+                        due.append(heapq.heappop(self.heap))
+                    if not due:
+                        timeout = next_load - time.monotonic()
+                        if self.heap:
+                            timeout = min(timeout, (self.heap[0][0] - now).total_seconds())
+                        self.condition.wait(max(timeout, 0))
+                        continue
+                self.expire(due)
+
+    def expire(self, due: list):
+        # Each market's orders are expired together by its sequencer.
+        markets = {}
+        for expires, order_id, asset_0, asset_1 in due:
+            markets.setdefault((asset_0, asset_1), []).append(order_id)
+        for (asset_0, asset_1), order_ids in markets.items():
+            try:
+                count = get_sequencer(asset_0, asset_1).submit(expire_orders, order_ids, commit = False).result()
+                if count:
+                    logger.info(f"Expired {count} orders in {asset_1}/{asset_0}")
+            except Exception as e:
+                logger.error(f"Expiry of {asset_1}/{asset_0} orders {order_ids} failed: {e!r}")
+
+scheduler = None # The expiry scheduler of this process, set by start_expiry().
+
+def start_expiry(app):
+    global scheduler
+    if mp.current_process().name.startswith("shard-"):
+        # Orders entered in a shard are expired by the web process, which sends
+        # the job back to the shard through its Shard_Client.
+        return None
+    scheduler = Expiry_Scheduler(app)
+    return scheduler
+
+@event.listens_for(db.session, "after_commit")
+def expiring_orders_committed(session):
+    entries = session.info.pop("expiring_orders", None)
+    if entries and scheduler is not None:
+        scheduler.add(entries)
+
+@event.listens_for(db.session, "after_transaction_end")
+def expiring_orders_abandoned(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("expiring_orders", None)
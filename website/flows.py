@@ -10,7 +10,11 @@ import hashlib as hl
 import datetime as dt
 
 from website.models import Account, Payment, Flow, Order, Trade, Instrument
+from website.matching_engine import deactivate_order
+from website.ledger import get_reserved
 from website.util import format_de
+from website.users import load_account
+from website.units import PLACES, scales, has_places
 from website import db, logger
 
 def admin_checks(account, password):
@@ -51,6 +55,11 @@ def cancel_orders(account, currency, quantity):
     """
     balance_used = de.Decimal("0")
     balance_available = getattr(account, currency) + quantity
+
+    # The ledger tells us straight away if the remaining balance still covers
+    # every order, in which case there is nothing to cancel.
+    if get_reserved(account.account_id).get(currency, de.Decimal("0")) <= balance_available:
+        return
     
     # Bid, orders that are using the currency to purchase something else.
     my_orders = Order.query.filter_by(
@@ -60,8 +69,7 @@ def cancel_orders(account, currency, quantity):
         if o.quantity * o.price + balance_used > balance_available:
             # Cancelling the order because the user no longer has funds for it.
             fl.flash(f"Pedido {o.order_id} cancelado, fundos retirados", category = "s")
-            o.active = False
-            logger.info(f"OA order_id = {o.order_id}, active = False")
+            deactivate_order(o)
         else:
             balance_used += o.quantity * o.price
     
@@ -73,8 +81,7 @@ def cancel_orders(account, currency, quantity):
         if o.quantity + balance_used > balance_available:
             # Cancelling the order because the user no longer has funds for it.
             fl.flash(f"Pedido {o.order_id} cancelado, fundos retirados", category = "s")
-            o.active = False
-            logger.info(f"OA order_id = {o.order_id}, active = False")
+            deactivate_order(o)
         else:
             balance_used += o.quantity
     
@@ -104,11 +111,15 @@ def make_flow(admin: bool, currency: str, quantity: de.Decimal, account_id: int,
     if admin:
         account = Account.query.filter_by(account_id = account_id).first()
     else:
-        account = fo.current_user
+        account = load_account()
     
     # Next we will preform some basic checks on the withdrawal, these will be
     # different based on whether or not this is an admin flow.
-    if admin and not admin_checks(account, password):
+    if not has_places(quantity, scales.get(currency, PLACES)):
+        # Nothing smaller than the currency's minor unit, see units.py.
+        fl.flash(f"O valor de {currency} tem casas decimais demais", category = "e")
+        return
+    elif admin and not admin_checks(account, password):
         return # checks failed
     elif not admin and not user_checks(currency, quantity, password, account):
         return # checks failed
@@ -0,0 +1,339 @@
+# This file keeps the event journal, an append-only record of every change to
+# our accounts, orders, trades, payments, flows, bots and instruments. Each
+# line of the journal is one JSON event with a sequence number, which is given
+# out inside the transaction that made the change, so the sequence follows the
+# order in which changes were committed even across processes.
+
+# Events are collected as the session flushes and handed to a writer thread
+# once their transaction commits. The writer groups everything that arrived
+# together into a single write and fsync (group commit). Now and then the
+# writer also saves a snapshot of the whole database, recovery loads the newest
+# snapshot and replays the journal entries that came after it, see
+# create_db_from_log() and recover.py.
+
+# Every process that changes the database journals its own changes, but only
+# the web process (main.py) takes snapshots, see create_app(snapshots = True).
+# The shards and the scripts would otherwise each save a copy of the whole
+# database every hour. Migrations are run by the first process to start after
+# an upgrade, so start main.py first to get a snapshot of the migrated tables.
+
+# Market and Candle are not journaled, they are worked out again from the
+# orders and trades after a recovery.
+
+import os
+import glob
+import gzip
+import json
+import time
+import atexit
+import threading
+import datetime as dt
+import decimal as de
+import sqlalchemy as sa
+from sqlalchemy import event, inspect, insert, select, update
+
+from website.models import Account, Balance, Order, Trade, Payment, Flow, Bot, Bot_Order, Instrument, Journal_Sequence
+from website.ledger import rebuild_reserves
+from website.candles import backfill_candles
+from website.units import Minor_Units
+from website.util import utc_now
+from website import db, logger
+
+journaled = (Account, Balance, Order, Trade, Payment, Flow, Bot, Bot_Order, Instrument)
+journaled_tables = {m.__table__.name: m.__table__ for m in journaled}
+
+# The same tables with untyped time columns for replaying. SQLite keeps times
+# as text and the times it makes (func.now()) have no microseconds, pages such
+# as the market trades parse them that way, so we write back the exact text.
+replay_tables = {
+    name: sa.table(name, *[
+        sa.column(c.name, None if isinstance(c.type, sa.DateTime) else c.type)
+        for c in table.columns])
+    for name, table in journaled_tables.items()}
+
+journal = None # The journal of this process, set by start_journal().
+
+def encode(value):
+    if isinstance(value, de.Decimal):
+        return str(value)
+    elif isinstance(value, (dt.datetime, dt.date)):
+        return value.isoformat()
+    return value
+
+def decode(table, data: dict):
+    """
+    Turns the values of a journaled row back into the types of its columns,
+    times stay as the text that SQLite stores (see replay_tables).
+    """
+    values = {}
+    for key, value in data.items():
+        if key not in table.columns:
+            continue # A column that we no longer have, such as Account.STN.
+        column = table.columns[key]
+        if value is None:
+            values[key] = None
+        elif isinstance(column.type, (db.Numeric, Minor_Units)):
+            values[key] = de.Decimal(value)
+        elif isinstance(column.type, db.DateTime):
+            values[key] = value.replace("T", " ")
+        else:
+            values[key] = value
+    return values
+
+def row_event(op: str, obj):
+    """
+    Describes the change to one object as a journal event. Inserts record the
+    whole row, updates only the columns that changed and deletes only the key.
+    Returns None if nothing in the row changed.
+    """
+    state = inspect(obj)
+    mapper = state.mapper
+    data = {}
+    if op == "insert":
+        for attr in mapper.column_attrs:
+            if attr.key in state.dict:
+                data[attr.key] = encode(state.dict[attr.key])
+            elif isinstance(attr.columns[0].type, db.DateTime) and attr.columns[0].default is not None:
+                # Defaults made by the database (func.now()) are not loaded
+                # back after the insert, we record the time ourselves.
+                data[attr.key] = encode(utc_now().replace(microsecond = 0))
+    elif op == "update":
+        for attr in mapper.column_attrs:
+            history = state.attrs[attr.key].history
+            if history.added:
+                data[attr.key] = encode(history.added[0])
+        if not data:
+            return None
+    else:
+        data = None
+    return {
+        "table": mapper.local_table.name, "op": op,
+        "key": [encode(v) for v in mapper.primary_key_from_instance(obj)],
+        "data": data
+    }
+
+@event.listens_for(db.session, "after_flush")
+def journal_flush(session, flush_context):
+    if journal is None:
+        return
+    events = session.info.setdefault("journal_events", [])
+    for op, objects in [("insert", session.new), ("update", session.dirty), ("delete", session.deleted)]:
+        for obj in objects:
+            if isinstance(obj, journaled):
+                e = row_event(op, obj)
+                if e is not None:
+                    events.append(e)
+
+def journal_deletes(session, table: str, keys: list):
+    """
+    Journals rows removed by a bulk delete, which journal_flush never sees
+    because no objects are involved, such as the rows moved out to the archive
+    (see archive.py).
+
+    Inputs:
+        -> table: str, the name of a journaled table.
+        -> keys: list, the primary keys of the rows deleted.
+    """
+    if journal is None:
+        return
+    session.info.setdefault("journal_events", []).extend(
+        {"table": table, "op": "delete", "key": [encode(key)], "data": None}
+        for key in keys)
+
+@event.listens_for(db.session, "before_commit")
+def journal_before_commit(session):
+    if journal is None:
+        return
+    session.flush() # Makes sure every change has passed through journal_flush.
+    events = session.info.get("journal_events")
+    if not events:
+        return
+    # We hold SQLite's write lock at this point, so no other transaction can
+    # be given sequence numbers until we commit.
+    last = session.execute(
+        update(Journal_Sequence).values(seq = Journal_Sequence.seq + len(events))
+        .returning(Journal_Sequence.seq)).scalar()
+    if last is None:
+        session.execute(insert(Journal_Sequence).values(journal_sequence_id = 1, seq = len(events)))
+        last = len(events)
+    time = encode(utc_now())
+    for i, e in enumerate(events):
+        e["seq"] = last - len(events) + 1 + i
+        e["time"] = time
+
+@event.listens_for(db.session, "after_commit")
+def journal_after_commit(session):
+    events = session.info.pop("journal_events", None)
+    if events and journal is not None:
+        journal.append(events)
+
+@event.listens_for(db.session, "after_transaction_end")
+def journal_abandoned(session, transaction):
+    # Events from a transaction that was rolled back never happened.
+    if transaction.parent is None:
+        session.info.pop("journal_events", None)
+
+class Journal():
+    """
+    Writes committed events to the journal files of a directory. There is one
+    file per (UTC) day, journal-YYYYMMDD.jsonl, and snapshots are saved beside
+    them as snapshot-<seq>.json.gz by the journal that takes snapshots.
+    """
+    def __init__(self, app, directory: str, flush_interval: float = 0.05, snapshot_interval: float = 3600, snapshot: bool = False, snapshots: bool = True):
+        self.app = app
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshots = snapshots
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        os.makedirs(directory, exist_ok = True)
+
+        # Recovery needs a snapshot to start from, and a new one after the
+        # tables have been migrated.
+        self.last_snapshot = time.monotonic()
+        if snapshots and (snapshot or not glob.glob(os.path.join(directory, "snapshot-*.json.gz"))):
+            take_snapshot(directory)
+
+        atexit.register(self.flush)
+        self.thread = threading.Thread(target = self.run, name = "journal", daemon = True)
+        self.thread.start()
+
+    def append(self, events: list):
+        lines = [json.dumps(e) for e in events]
+        with self.lock:
+            self.pending.extend(lines)
+        self.wake.set()
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                self.wake.wait(self.snapshot_interval)
+                self.wake.clear()
+                # Commits that arrive while we wait join this group.
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                    if self.snapshots and time.monotonic() - self.last_snapshot > self.snapshot_interval:
+                        take_snapshot(self.directory)
+                        self.last_snapshot = time.monotonic()
+                except Exception as e:
+                    logger.error(f"Journal write failed: {e!r}")
+                finally:
+                    db.session.remove()
+
+    def flush(self):
+        """
+        Writes every pending event with one write and one fsync.
+        """
+        with self.lock:
+            lines, self.pending = self.pending, []
+            if not lines:
+                return
+            path = os.path.join(self.directory, f"journal-{utc_now():%Y%m%d}.jsonl")
+            with open(path, "a") as f:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+def start_journal(app, snapshot: bool = False, snapshots: bool = True):
+    """
+    Starts journaling for an app. The journal lives in a "journal" folder next
+    to the database unless JOURNAL_PATH is configured.
+
+    Inputs:
+        -> snapshot: bool, take a snapshot now even if there is one already.
+        -> snapshots: bool, whether this process takes snapshots at all.
+    """
+    global journal
+    with app.app_context():
+        directory = app.config.get("JOURNAL_PATH")
+        if directory is None:
+            database = db.engine.url.database
+            base = os.path.dirname(database) if database else app.instance_path
+            directory = os.path.join(base, "journal")
+        journal = Journal(app, directory, snapshot = snapshot, snapshots = snapshots)
+    return journal
+
+def take_snapshot(directory: str):
+    """
+    Saves every journaled table to snapshot-<seq>.json.gz, where seq is the
+    last sequence number committed before we started reading. Changes that
+    commit while we read get higher numbers and are replayed on top, which is
+    safe because replaying an event sets a row rather than adding to it.
+    """
+    started = utc_now()
+    seq = db.session.execute(select(Journal_Sequence.seq)).scalar() or 0
+    tables = {}
+    for name, table in journaled_tables.items():
+        tables[name] = [
+            {k: encode(v) for k, v in row._mapping.items()}
+            for row in db.session.execute(table.select())]
+    db.session.rollback()
+
+    path = os.path.join(directory, f"snapshot-{seq:012d}.json.gz")
+    with gzip.open(path + ".tmp", "wt") as f:
+        json.dump({"seq": seq, "time": encode(started), "tables": tables}, f)
+    os.replace(path + ".tmp", path)
+    return path
+
+def apply_event(e: dict):
+    table = journaled_tables[e["table"]]
+    replay = replay_tables[e["table"]]
+    where = [replay.c[c.name] == v for c, v in zip(table.primary_key.columns, e["key"])]
+    if e["op"] == "insert":
+        db.session.execute(replay.delete().where(*where))
+        db.session.execute(replay.insert().values(**decode(table, e["data"])))
+    elif e["op"] == "update":
+        db.session.execute(replay.update().where(*where).values(**decode(table, e["data"])))
+    else:
+        db.session.execute(replay.delete().where(*where))
+
+def create_db_from_log(directory: str):
+    """
+    Rebuilds the database from a journal directory: the newest snapshot is
+    loaded and every journal entry after it is replayed in sequence order.
+    Must be run inside the app context of an empty database, see recover.py.
+
+    Returns:
+        -> count: int, the number of journal entries replayed.
+    """
+    seq, started = 0, None
+    snapshots = sorted(glob.glob(os.path.join(directory, "snapshot-*.json.gz")))
+    if snapshots:
+        with gzip.open(snapshots[-1], "rt") as f:
+            snapshot = json.load(f)
+        seq, started = snapshot["seq"], dt.datetime.fromisoformat(snapshot["time"])
+        for name, rows in snapshot["tables"].items():
+            table = journaled_tables[name]
+            db.session.execute(table.delete())
+            if rows:
+                db.session.execute(replay_tables[name].insert(), [decode(table, row) for row in rows])
+
+    # Entries after the snapshot can only be in the files of the day that it
+    # was taken or later.
+    events = []
+    for path in sorted(glob.glob(os.path.join(directory, "journal-*.jsonl"))):
+        day = os.path.basename(path)[8:16]
+        if started is not None and day < f"{started:%Y%m%d}":
+            continue
+        with open(path) as f:
+            for line in f:
+                try:
+                    e = json.loads(line)
+                except ValueError: # A line cut short by a crash.
+                    continue
+                if e["seq"] > seq:
+                    events.append(e)
+    events.sort(key = lambda e: e["seq"])
+    for e in events:
+        apply_event(e)
+
+    last = events[-1]["seq"] if events else seq
+    db.session.execute(Journal_Sequence.__table__.delete())
+    db.session.execute(insert(Journal_Sequence).values(journal_sequence_id = 1, seq = last))
+    rebuild_reserves()
+    backfill_candles()
+    db.session.commit()
+    return len(events)
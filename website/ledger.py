@@ -0,0 +1,117 @@
+# This file keeps the ledger of reserved funds, how much of each currency every
+# account has locked in its active orders, in the reserved column of Balance.
+# Bids lock the currency that they pay with (quantity * price of asset_0) and
+# asks lock the asset that they sell (quantity of asset_1).
+
+# Rather than adding up an account's orders every time we need to know its
+# available balance, the matching engine updates the ledger whenever an order
+# rests, trades or is cancelled, in the same transaction as the order itself.
+
+# Like the engine, the ledger works out its changes in minor units (see
+# units.py) and only turns them back into Decimals as it writes them.
+
+import decimal as de
+from sqlalchemy import update
+
+from website.models import Order, Balance
+from website.units import to_minor, from_minor, order_cost
+from website import db
+
+def get_reserved(account_id: int):
+    """
+    Returns the funds reserved by an account's active orders.
+
+    Returns:
+        -> reserved: dict, of {currency: amount}, currencies with nothing
+           reserved may be missing.
+    """
+    return {b.currency: b.reserved for b in Balance.query.filter_by(account_id = account_id)}
+
+def get_available(account_id: int, currency: str):
+    """
+    Returns the part of an account's balance that is not locked in orders.
+
+    Inputs:
+        -> account_id: int,
+        -> currency: str,
+    """
+    b = Balance.query.filter_by(account_id = account_id, currency = currency).first()
+    return de.Decimal("0") if b is None else b.amount - b.reserved
+
+def load_balances(changes: dict):
+    """
+    Loads the Balance rows that a map of changes touches in one query, rows are
+    created the first time an account holds a currency.
+
+    Inputs:
+        -> changes: dict, of {account_id: {currency: change}}.
+
+    Returns:
+        -> balances: dict, of {(account_id, currency): Balance}.
+    """
+    currencies = {c for account_changes in changes.values() for c in account_changes}
+    balances = {(b.account_id, b.currency): b for b in Balance.query.filter(
+        Balance.account_id.in_(list(changes)), Balance.currency.in_(list(currencies)))}
+    for account_id, account_changes in changes.items():
+        for currency in account_changes:
+            if (account_id, currency) not in balances:
+                b = Balance(account_id = account_id, currency = currency, amount = de.Decimal("0"), reserved = de.Decimal("0"))
+                db.session.add(b)
+                balances[(account_id, currency)] = b
+    return balances
+
+def apply_reserve_changes(changes: dict):
+    """
+    Applies a map of netted changes to the reserved funds, only the Balance
+    rows that change are written.
+
+    Inputs:
+        -> changes: dict, of {account_id: {currency: change}} with the
+           changes in minor units, a positive change locks more funds.
+    """
+    if not changes:
+        return
+    balances = load_balances(changes)
+    for account_id, account_changes in changes.items():
+        for currency, change in account_changes.items():
+            if change == 0:
+                continue
+            balances[(account_id, currency)].reserved += from_minor(change)
+
+def order_reserve(side: str, quantity: int, price: int, asset_0: str, asset_1: str):
+    """
+    Returns the (currency, amount) that an order of this size locks, the
+    quantity, price and amount are all in minor units.
+    """
+    if side == "bid":
+        return asset_0, order_cost(quantity, price)
+    else:
+        return asset_1, quantity
+
+def rebuild_reserves():
+    """
+    Works the whole ledger out again from the active orders. This is run when
+    the balances are first moved to the Balance table and can be run by hand
+    if the ledger is ever suspected to be wrong. The caller is responsible for
+    committing.
+    """
+    db.session.execute(update(Balance).values(reserved = de.Decimal("0")))
+    changes = {}
+    orders = db.session.query(
+        Order.account_id, Order.side, Order.asset_0, Order.asset_1, 
+        Order.price, Order.quantity).filter_by(active = True)
+    for o in orders:
+        currency, amount = order_reserve(o.side, to_minor(o.quantity), to_minor(o.price), o.asset_0, o.asset_1)
+        account_changes = changes.setdefault(o.account_id, {})
+        account_changes[currency] = account_changes.get(currency, 0) + amount
+    db.session.flush()
+    apply_reserve_changes(changes)
+
+def create_reserves():
+    """
+    Builds the ledger the first time the app runs against a database which has
+    active orders but nothing reserved.
+    """
+    if Balance.query.filter(Balance.reserved != 0).first() is None and Order.query.filter_by(active = True).first() is not None:
+        rebuild_reserves()
+        db.session.commit()
@@ -20,4 +20,6 @@
 
 # Where possible we want to log something right AFTER we did the thing.
 
-# create_db_from_log()
\ No newline at end of file
+# The database log above is for people to read. The event journal in
+# website/journal.py records every change as JSON and can rebuild the database,
+# see create_db_from_log() and recover.py.
\ No newline at end of file
@@ -0,0 +1,169 @@
+# This file pushes live market data to the market pages. Each page opens a
+# stream (see market_stream in views.py) and is sent a snapshot of the book and
+# the recent trades, followed by the changes to the book's price levels and the
+# new trades as they happen. Every message carries a sequence number so that a
+# page which misses a message knows to reconnect for a fresh snapshot.
+
+# One feed thread per process does the work for every watcher. It wakes up when
+# a transaction commits (or once a second, to catch changes made by other
+# processes such as scheduler.py), checks the version of each watched market
+# and only reads the database for the markets that have changed. The messages
+# are then handed out through the event bus.
+
+import time
+import threading
+import flask as fl
+from sqlalchemy import event, func
+
+from website.models import Order, Trade, Market
+from website.tables import get_market_trades
+from website.events import bus
+from website.util import format_de
+from website import db, logger
+
+def market_topic(asset_0: str, asset_1: str):
+    return f"market:{asset_1}{asset_0}"
+
+def get_levels(asset_0: str, asset_1: str):
+    """
+    Returns the quantity resting at every price of a market's book as
+    {"bid": {price: quantity}, "ask": {price: quantity}} with both as strings.
+    """
+    levels = {"bid": {}, "ask": {}}
+    rows = db.session.query(
+        Order.side, Order.price, func.sum(Order.quantity)
+        ).filter_by(asset_0 = asset_0, asset_1 = asset_1, active = True
+        ).group_by(Order.side, Order.price)
+    for side, price, quantity in rows:
+        levels[side][str(price)] = str(quantity)
+    return levels
+
+def format_trade(t: Trade):
+    # The same columns as get_market_trades.
+    return [t.time.strftime("%d/%m/%y %H:%M:%S"), format_de(t.quantity), format_de(t.price)]
+
+class Market_State():
+    """
+    What the feed last published for one market.
+    """
+    def __init__(self, asset_0: str, asset_1: str):
+        self.asset_0 = asset_0
+        self.asset_1 = asset_1
+        self.topic = market_topic(asset_0, asset_1)
+        self.seq = 0
+        self.version = None
+        self.levels = {"bid": {}, "ask": {}}
+        self.last_trade_id = db.session.query(func.max(Trade.trade_id)).scalar() or 0
+
+class Market_Feed():
+    def __init__(self, app, poll_interval: float = 1.0, min_interval: float = 0.1):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.min_interval = min_interval # Commits closer together than this share one update.
+        self.states = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target = self.run, name = "market-feed", daemon = True)
+        self.thread.start()
+
+    def subscribe(self, asset_0: str, asset_1: str):
+        """
+        Starts watching a market.
+
+        Returns:
+            -> subscription: Subscription, which will receive the "book" and
+               "trades" messages of the market.
+            -> snapshot: dict, the state of the market that those messages
+               follow on from.
+        """
+        with self.lock:
+            state = self.states.get((asset_0, asset_1))
+            if state is None:
+                state = self.states[(asset_0, asset_1)] = Market_State(asset_0, asset_1)
+            self.update(state)
+            subscription = bus.subscribe(state.topic)
+            snapshot = {
+                "type": "snapshot", "seq": state.seq,
+                "bids": sorted(state.levels["bid"].items(), key = lambda l: -float(l[0])),
+                "asks": sorted(state.levels["ask"].items(), key = lambda l: float(l[0])),
+                "trades": get_market_trades(asset_0, asset_1)
+            }
+        return subscription, snapshot
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                self.wake.wait(self.poll_interval)
+                self.wake.clear()
+                try:
+                    with self.lock:
+                        for key, state in list(self.states.items()):
+                            if bus.has_subscribers(state.topic):
+                                self.update(state)
+                            else:
+                                # Nobody is watching, the next watcher starts
+                                # from a new snapshot.
+                                del self.states[key]
+                except Exception as e:
+                    logger.error(f"Market feed update failed: {e!r}")
+                finally:
+                    db.session.remove()
+                time.sleep(self.min_interval)
+
+    def update(self, state: Market_State):
+        """
+        Publishes what has changed in a market since we last looked. Must be
+        called holding self.lock.
+        """
+        version = db.session.query(Market.version).filter_by(
+            asset_0 = state.asset_0, asset_1 = state.asset_1).scalar() or 0
+        if version == state.version:
+            return
+        state.version = version
+
+        # Every price whose quantity changed, a quantity of "0" means that the
+        # price level is gone.
+        levels = get_levels(state.asset_0, state.asset_1)
+        changes = {}
+        for side in ["bid", "ask"]:
+            old, new = state.levels[side], levels[side]
+            changes[side] = [(p, q) for p, q in new.items() if old.get(p) != q]
+            changes[side] += [(p, "0") for p in old if p not in new]
+        state.levels = levels
+        if changes["bid"] or changes["ask"]:
+            state.seq += 1
+            bus.publish(state.topic, {
+                "type": "book", "seq": state.seq,
+                "bids": changes["bid"], "asks": changes["ask"]})
+
+        trades = Trade.query.filter(
+            Trade.trade_id > state.last_trade_id, Trade.asset_0 == state.asset_0,
+            Trade.asset_1 == state.asset_1).order_by(Trade.trade_id).all()
+        if trades:
+            state.last_trade_id = trades[-1].trade_id
+            # get_market_trades leaves out cancelled trades and trades between
+            # an account and itself, so do we.
+            shown = [format_trade(t) for t in reversed(trades) if t.status == 1 and t.buyer != t.seller]
+            if shown:
+                state.seq += 1
+                bus.publish(state.topic, {"type": "trades", "seq": state.seq, "trades": shown})
+
+feed = None
+feed_lock = threading.Lock()
+
+def get_market_feed():
+    """
+    Returns this process's market feed, starting it the first time it is
+    needed. Must be called inside an app context.
+    """
+    global feed
+    if feed is None:
+        with feed_lock:
+            if feed is None:
+                feed = Market_Feed(fl.current_app._get_current_object())
+    return feed
+
+@event.listens_for(db.session, "after_commit")
+def market_feed_committed(session):
+    if feed is not None:
+        feed.wake.set()
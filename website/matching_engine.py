@@ -3,135 +3,473 @@
 import flask as fl
 import decimal as de
 import datetime as dt
+import math
+from sqlalchemy import event
 
 from website.models import Account, Payment, Flow, Order, Trade, Instrument
+from website.order_book import claim_order_book
+from website.ledger import get_reserved, get_available, load_balances, apply_reserve_changes, order_reserve
+from website.candles import record_trades
+from website.units import PLACES, to_minor, from_minor, order_cost, has_places
+from website.events import bus
 from website import db, logger
 
-def enter_order(user, side: str, quantity: de.Decimal, price: de.Decimal, asset_0: str, asset_1: str, messages: bool = False):
+# The time in force options of an order. "GTC" (good till cancelled) rests
+# whatever does not trade, "IOC" (immediate or cancel) drops whatever does not
+# trade at once, "FOK" (fill or kill) trades the whole quantity at once or not
+# at all and "POST" (post only) rests the whole order and is turned away if it
+# would trade.
+time_in_force_options = ["GTC", "IOC", "FOK", "POST"]
+
+def engine_topic(asset_0: str, asset_1: str):
+    """
+    The topic of the event bus on which a market's fills and cancellations are
+    published once they commit, see bot_triggers.py.
+    """
+    return f"engine:{asset_1}{asset_0}"
+
+def note_market_event(asset_0: str, asset_1: str, kind: str, account_id: int):
+    """
+    Notes a "fill" or "cancel" in a market, made by (or for) an account, to be
+    published when the current transaction commits.
+    """
+    db.session().info.setdefault("market_events", set()).add((asset_0, asset_1, kind, account_id))
+
+class Order_Result():
+    """
+    What happened to an order in the matching engine. This holds plain values
+    rather than database objects so that it can be handed back to a caller in
+    another thread (see sequencer.py).
+    """
+    __slots__ = ("order_id", "trades", "quantity")
+
+    def __init__(self, order_id: int, trades: int, quantity: de.Decimal):
+        self.order_id = order_id # id of the new Order row, None if nothing rests.
+        self.trades = trades # number of resting orders that we traded with.
+        self.quantity = quantity # quantity left resting in the book.
+
+def enter_order(account_id: int, side: str, quantity: de.Decimal, price: de.Decimal, asset_0: str, asset_1: str, messages: bool = False, commit: bool = True, time_in_force: str = "GTC", expires: dt.datetime = None):
     """
     An order comes here once it has already passed all its validation checks.
     This function inserts it into the matching engine to check if it matches
     with other products.
 
+    Matching happens against the market's in memory order book (see
+    order_book.py) and every change is then written through to the database.
+    Only an order that rests in the book gets an Order row, an order that
+    trades in full leaves nothing but its trades.
+
+    The quantity and price are turned into minor units (see units.py) as they
+    come in, matching and the balance changes are worked out in ints and only
+    the rows that we write hold Decimals. They must already be a whole
+    quantity and a price in cents, we raise a ValueError rather than round
+    them into an order that nobody entered.
+
     Inputs:
-        -> user,
+        -> account_id: int, the account entering the order.
         -> side: str, either "bid" or "ask"
-        -> quantity: de.Decimal, 
-        -> price: de.Decimal, 
+        -> quantity: de.Decimal, a whole number of units of asset_1.
+        -> price: de.Decimal, with at most PLACES decimal places.
         -> messages: bool, controls if we will display flash messages if the
            order matches, generally, manual orders should have messages while 
            bot orders should not.
+        -> commit: bool, set to False when the caller commits for us, such as
+           the sequencer which commits a batch of orders together.
+        -> time_in_force: str, one of time_in_force_options.
+        -> expires: dt.datetime, in UTC, when whatever rests of the order
+           should be cancelled (see expiry.py), None to keep it until it is
+           cancelled.
+
+    Returns:
+        -> result: Order_Result
     """
     quantity_og = de.Decimal(quantity)
+    if not has_places(quantity_og, 0):
+        raise ValueError(f"Order quantity {quantity} is not a whole number")
+    if not has_places(de.Decimal(price), PLACES):
+        raise ValueError(f"Order price {price} has more than {PLACES} decimal places")
+    units, price_units = to_minor(quantity), to_minor(price)
+    price = from_minor(price_units)
 
-    # Okay, we are satisfied that this is a valid order. Now we will check 
-    # if it matches with any current orders, or will be entered as a quote.
-    if side == "bid": # Bid order
-        opp_orders = Order.query.filter_by(
-            asset_0 = asset_0, asset_1 = asset_1, side = "ask", active = True
-            ).order_by(Order.price)
-        for o in opp_orders:
-            if o.price > price:
-                # There is no more price overlap.
-                break
-            quantity_traded = min(quantity, o.quantity)
-            quantity -= quantity_traded
-            o.quantity -= quantity_traded
-            logger.info(f"OA order_id = {o.order_id}, quantity = {o.quantity}")
-                
-            # Now we will record the new trade
-            if messages:
-                fl.flash("Pedido negociado", category = "s")
-            db.session.add(Trade(
-                asset_0 = asset_0, asset_1 = asset_1, 
-                quantity = quantity_traded, price = o.price, 
-                buyer = user.account_id, seller = o.account_id, status = 1
-                ))
-            logger.info(f"TC asset_0 = {asset_0}, asset_1 = {asset_1}, quantity = {quantity_traded}, price = {o.price}, buyer = {user.account_id}, seller = {o.account_id}")
+    book = claim_order_book(asset_0, asset_1)
+    with book.lock:
+        if (time_in_force == "POST" and book.crosses(side, price_units)) or \
+            (time_in_force == "FOK" and not book.can_fill(side, units, price_units)):
+            # The order is turned away without touching the book.
+            if commit:
+                db.session.commit() # Releases the market that we claimed.
+            return Order_Result(None, 0, quantity_og)
 
-            # Now we update the balances of both traders.
-            buyer = Account.query.filter_by(account_id = user.account_id).first()
-            seller = Account.query.filter_by(account_id = o.account_id).first()
+        # Okay, we are satisfied that this is a valid order. Now we will check 
+        # if it matches with any current orders, or will be entered as a quote.
+        fills = book.match(side, units, price_units)
 
-            # buyer.CUR -= quantity_traded * o.price
-            setattr(buyer, asset_0, getattr(buyer, asset_0) - quantity_traded * o.price)
-            setattr(seller, asset_0, getattr(seller, asset_0) + quantity_traded * o.price)
-            logger.info(f"AA account_id = {buyer.account_id}, STN = {getattr(buyer, asset_0)}")
-            logger.info(f"AA account_id = {seller.account_id}, STN = {getattr(seller, asset_0)}")
-            
-            # buyer.CUR += quantity_traded
-            setattr(buyer, asset_1, getattr(buyer, asset_1) + quantity_traded)
-            setattr(seller, asset_1, getattr(seller, asset_1) - quantity_traded)
-            logger.info(f"AA account_id = {buyer.account_id}, STN = {getattr(buyer, asset_1)}")
-            logger.info(f"AA account_id = {seller.account_id}, STN = {getattr(seller, asset_1)}")
-
-            if o.quantity == de.Decimal("0"):
-                o.active = False
-                o.time_traded = dt.datetime.now()
-                logger.info(f"OA order_id = {o.order_id}, active = False, time_traded = {o.time_traded}")
+        # The book has already been updated, now we write the fills through to
+        # the database. All the resting orders that we traded with are loaded
+        # in a single query.
+        resting, changes, reserve_changes, trades = {}, {}, {}, []
+        if fills:
+            resting = {o.order_id: o for o in Order.query.filter(
+                Order.order_id.in_([entry.order_id for entry, _ in fills]))}
 
-            if quantity == de.Decimal("0"):
-                # The new order has fully matched with existing orders so we
-                # will stop looping and record the order.
-                break
-
-    else: # Ask order
-        opp_orders = Order.query.filter_by(
-            asset_0 = asset_0, asset_1 = asset_1, side = "bid", active = True
-            ).order_by(Order.price.desc())
-        for o in opp_orders:
-            if o.price < price:
-                # There is no more price overlap.
-                break
-            quantity_traded = min(quantity, o.quantity)
-            quantity -= quantity_traded
-            o.quantity -= quantity_traded
+        for entry, units_traded in fills:
+            o = resting[entry.order_id]
+            units -= units_traded
+            quantity_traded = from_minor(units_traded)
+            o.quantity = from_minor(entry.quantity)
             logger.info(f"OA order_id = {o.order_id}, quantity = {o.quantity}")
 
+            if side == "bid":
+                buyer_id, seller_id = account_id, o.account_id
+            else:
+                buyer_id, seller_id = o.account_id, account_id
+
             # Now we will record the new trade
             if messages:
                 fl.flash("Pedido negociado", category = "s")
             db.session.add(Trade(
                 asset_0 = asset_0, asset_1 = asset_1, 
                 quantity = quantity_traded, price = o.price, 
-                buyer = o.account_id, seller = user.account_id, status = 1
+                buyer = buyer_id, seller = seller_id, status = 1
                 ))
-            logger.info(f"TC asset_0 = {asset_0}, asset_1 = {asset_1}, quantity = {quantity_traded}, price = {o.price}, buyer = {user.account_id}, seller = {o.account_id}")
-
-            # Now we update the balances of both traders.
-            seller = Account.query.filter_by(account_id = user.account_id).first()
-            buyer = Account.query.filter_by(account_id = o.account_id).first()
+            logger.info(f"TC asset_0 = {asset_0}, asset_1 = {asset_1}, quantity = {quantity_traded}, price = {o.price}, buyer = {buyer_id}, seller = {seller_id}")
+            if buyer_id != seller_id:
+                trades.append((o.price, quantity_traded))
 
+            # Now we note the changes to the balances of both traders, these
+            # are netted across all the fills of this order and applied once.
             # buyer.CUR -= quantity_traded * o.price
-            setattr(buyer, asset_0, getattr(buyer, asset_0) - quantity_traded * o.price)
-            setattr(seller, asset_0, getattr(seller, asset_0) + quantity_traded * o.price)
-            logger.info(f"AA account_id = {buyer.account_id}, STN = {getattr(buyer, asset_0)}")
-            logger.info(f"AA account_id = {seller.account_id}, STN = {getattr(seller, asset_0)}")
-            
+            cost = order_cost(units_traded, entry.price)
+            add_balance_change(changes, buyer_id, asset_0, - cost)
+            add_balance_change(changes, seller_id, asset_0, cost)
             # buyer.CUR += quantity_traded
-            setattr(buyer, asset_1, getattr(buyer, asset_1) + quantity_traded)
-            setattr(seller, asset_1, getattr(seller, asset_1) - quantity_traded)
-            logger.info(f"AA account_id = {buyer.account_id}, STN = {getattr(buyer, asset_1)}")
-            logger.info(f"AA account_id = {seller.account_id}, STN = {getattr(seller, asset_1)}")
+            add_balance_change(changes, buyer_id, asset_1, units_traded)
+            add_balance_change(changes, seller_id, asset_1, - units_traded)
+
+            # The funds that the resting order had reserved are released.
+            currency, amount = order_reserve(o.side, units_traded, entry.price, asset_0, asset_1)
+            add_balance_change(reserve_changes, o.account_id, currency, - amount)
 
-            if o.quantity == de.Decimal("0"):
+            if entry.quantity == 0:
                 o.active = False
                 o.time_traded = dt.datetime.now()
                 logger.info(f"OA order_id = {o.order_id}, active = False, time_traded = {o.time_traded}")
 
-            if quantity == de.Decimal("0"):
-                # The new order has fully matched with existing orders so we
-                # will stop looping and record the order.
-                break
-
-    active = (quantity > de.Decimal("0"))        
-    db.session.add(Order(
-        asset_0 = asset_0, asset_1 = asset_1, side = side, price = price, 
-        quantity = quantity, quantity_og = quantity_og, 
-        account_id = user.account_id, active = active))
-    logger.info(f"TC asset_0 = {asset_0}, asset_1 = {asset_1}, side = {side}, price = {price}, quantity = {quantity}, quantity_og = {quantity_og}, account_id = {user.account_id}, active = {active}")
-    db.session.commit()
-    logger.info(f"Database Commit")
+        apply_balance_changes(changes)
+        record_trades(asset_0, asset_1, trades)
+        if fills:
+            note_market_event(asset_0, asset_1, "fill", account_id)
+
+        order_id = None
+        quantity = from_minor(units)
+        if units > 0 and time_in_force in ["GTC", "POST"]:
+            # The remainder rests in the book and reserves its funds.
+            order = Order(
+                asset_0 = asset_0, asset_1 = asset_1, side = side, price = price, 
+                quantity = quantity, quantity_og = quantity_og, 
+                account_id = account_id, active = True, expires = expires)
+            db.session.add(order)
+            db.session.flush() # This gives us the new order_id.
+            order_id = order.order_id
+            if expires is not None:
+                # Handed to the expiry scheduler once we commit.
+                db.session().info.setdefault("expiring_orders", []).append(
+                    (expires, order_id, asset_0, asset_1))
+            book.add(order_id, account_id, side, price_units, units)
+            currency, amount = order_reserve(side, units, price_units, asset_0, asset_1)
+            add_balance_change(reserve_changes, account_id, currency, amount)
+            logger.info(f"OC asset_0 = {asset_0}, asset_1 = {asset_1}, side = {side}, price = {price}, quantity = {quantity}, quantity_og = {quantity_og}, account_id = {account_id}, active = True")
+        apply_reserve_changes(reserve_changes)
+        if commit:
+            db.session.commit()
+            logger.info(f"Database Commit")
     if messages:
         fl.flash("Pedido enviado", category = "s")
-    return
\ No newline at end of file
+    return Order_Result(order_id, len(fills), quantity)
+
+def enter_order_checked(account_id: int, side: str, quantity: de.Decimal, price: de.Decimal, asset_0: str, asset_1: str, commit: bool = True, time_in_force: str = "GTC", expires: dt.datetime = None):
+    """
+    Enters an order only if the account can still afford it. The market is
+    claimed before we read the account's funds, this gives us SQLite's write
+    lock so that no other thread or process (such as an engine shard, see
+    shards.py) can reserve the same funds between our check and our order.
+
+    Inputs:
+        -> the same as enter_order.
+
+    Returns:
+        -> result: Order_Result, or None if the account did not have the funds.
+    """
+    claim_order_book(asset_0, asset_1)
+    currency, amount = order_reserve(side, to_minor(quantity), to_minor(price), asset_0, asset_1)
+    if amount > to_minor(get_available(account_id, currency)):
+        return None
+    return enter_order(
+        account_id, side, quantity, price, asset_0, asset_1, commit = commit,
+        time_in_force = time_in_force, expires = expires)
+
+def enter_orders_bulk(account_id: int, orders: list, asset_0: str, asset_1: str, commit: bool = True, time_in_force: str = "GTC", expires: dt.datetime = None):
+    """
+    Enters several orders for one account in one market, such as a bot's
+    ladder. The account's available funds are worked out once for the whole
+    list from the ledger of reserved funds, the orders are then matched in the
+    order given and committed in a single transaction.
+
+    Like bot_order, each quantity is cut down to the whole units that the 
+    account can still afford and orders that cannot be afforded at all are
+    skipped.
+
+    Inputs:
+        -> account_id: int,
+        -> orders: list, of (side, quantity, price) tuples.
+        -> commit: bool, set to False when the caller will commit.
+        -> time_in_force: str, used for every order, see enter_order.
+        -> expires: dt.datetime, used for every order, see enter_order.
+
+    Returns:
+        -> results: list, with an Order_Result for each order entered or None
+           for each order skipped, in the same order as the input.
+    """
+    # Claiming the market first means that the funds we read cannot be
+    # reserved by anyone else before our orders are in, see enter_order_checked.
+    claim_order_book(asset_0, asset_1)
+    available = {
+        asset_0: to_minor(get_available(account_id, asset_0)),
+        asset_1: to_minor(get_available(account_id, asset_1))
+    }
+
+    results = []
+    for side, quantity, price in orders:
+        # Funds are counted in minor units, one whole unit of asset_1 costs
+        # the price in minor units of asset_0.
+        if side == "bid":
+            quantity = min(math.floor(quantity), available[asset_0] // to_minor(price))
+        else:
+            quantity = min(math.floor(quantity), available[asset_1] // to_minor(1))
+        if quantity <= 0: # We have no funds available for this order.
+            results.append(None)
+            continue
+
+        if side == "bid":
+            available[asset_0] -= quantity * to_minor(price)
+        else:
+            available[asset_1] -= to_minor(quantity)
+        results.append(enter_order(
+            account_id, side, de.Decimal(quantity), price, asset_0, asset_1,
+            commit = False, time_in_force = time_in_force, expires = expires))
+
+    if commit:
+        db.session.commit()
+        logger.info(f"Database Commit")
+    return results
+
+def add_balance_change(changes: dict, account_id: int, currency: str, change: de.Decimal):
+    """
+    Adds a change to an account's balance into a map of netted changes.
+
+    Inputs:
+        -> changes: dict, of {account_id: {currency: change}}.
+        -> account_id: int,
+        -> currency: str,
+        -> change: int, in minor units, positive when the account receives
+           funds.
+    """
+    account_changes = changes.setdefault(account_id, {})
+    account_changes[currency] = account_changes.get(currency, 0) + change
+
+def apply_balance_changes(changes: dict):
+    """
+    Applies a map of netted balance changes. Every Balance row involved is
+    loaded in a single query and each one is written once, however many fills
+    contributed to it. Changes that net to zero, such as the two sides of a
+    wash trade, are skipped.
+
+    Inputs:
+        -> changes: dict, of {account_id: {currency: change}} with the
+           changes in minor units.
+    """
+    if not changes:
+        return
+    balances = load_balances(changes)
+    for account_id, account_changes in changes.items():
+        for currency, change in account_changes.items():
+            if change == 0:
+                continue
+            # account.CUR += change
+            b = balances[(account_id, currency)]
+            b.amount += from_minor(change)
+            logger.info(f"AA account_id = {account_id}, {currency} = {b.amount}")
+
+def deactivate_order(o):
+    """
+    Takes a resting order out of its market's book, releases the funds that it
+    reserved and marks it inactive. Every cancellation goes through here so
+    that the book, the ledger and the database agree. The caller is 
+    responsible for committing.
+
+    Inputs:
+        -> o: Order, the order to cancel.
+    """
+    book = claim_order_book(o.asset_0, o.asset_1)
+    with book.lock:
+        book.remove(o.order_id)
+        if o.active:
+            currency, amount = order_reserve(o.side, to_minor(o.quantity), to_minor(o.price), o.asset_0, o.asset_1)
+            apply_reserve_changes({o.account_id: {currency: - amount}})
+            note_market_event(o.asset_0, o.asset_1, "cancel", o.account_id)
+        o.active = False
+        o.time_cancelled = dt.datetime.now()
+        logger.info(f"OA order_id = {o.order_id}, active = False, time_cancelled = {o.time_cancelled}")
+
+def amend_order(order_id: int, price: de.Decimal = None, quantity: de.Decimal = None, commit: bool = True):
+    """
+    Cancels and replaces an order in a single transaction, so the book is never
+    left without the order in between. If only the size goes down the order is
+    changed in place and keeps its place in the queue. Otherwise the old order
+    is cancelled and the new one goes through enter_orders_bulk, which checks
+    the funds (after the old order's funds have been freed) and may match.
+    Like enter_order we raise a ValueError for a quantity that is not whole or
+    a price that is not in cents.
+
+    Inputs:
+        -> order_id: int, the order to amend.
+        -> price: de.Decimal, the new price, None keeps the current price.
+        -> quantity: de.Decimal, the new quantity, None keeps the current 
+           quantity and zero cancels the order.
+        -> commit: bool, set to False when the caller will commit.
+
+    Returns:
+        -> order_id: int, of the order now standing in its place, which is the
+           same order_id if it was amended in place. False if no order stands,
+           because the order was not active, could not be afforded or traded
+           in full.
+    """
+    if quantity is not None and not has_places(de.Decimal(quantity), 0):
+        raise ValueError(f"Order quantity {quantity} is not a whole number")
+    if price is not None and not has_places(de.Decimal(price), PLACES):
+        raise ValueError(f"Order price {price} has more than {PLACES} decimal places")
+
+    o = db.session.get(Order, order_id)
+    if o is None or not o.active:
+        return False
+    if price is None:
+        price = o.price
+    if quantity is None:
+        quantity = o.quantity
+
+    if quantity <= de.Decimal("0"):
+        deactivate_order(o)
+        new_order_id = False
+    elif price == o.price and quantity <= o.quantity:
+        # Only the size is going down so the order keeps its queue priority.
+        book = claim_order_book(o.asset_0, o.asset_1)
+        with book.lock:
+            book.reduce(o.order_id, to_minor(quantity))
+            currency, amount = order_reserve(o.side, to_minor(o.quantity - quantity), to_minor(o.price), o.asset_0, o.asset_1)
+            apply_reserve_changes({o.account_id: {currency: - amount}})
+            o.quantity = quantity
+            logger.info(f"OA order_id = {o.order_id}, quantity = {o.quantity}")
+        new_order_id = o.order_id
+    else:
+        deactivate_order(o)
+        result = enter_orders_bulk(
+            o.account_id, [(o.side, quantity, price)], o.asset_0, o.asset_1,
+            commit = False, expires = o.expires)[0]
+        new_order_id = False if result is None or result.order_id is None else result.order_id
+
+    if commit:
+        db.session.commit()
+        logger.info(f"Database Commit")
+    return new_order_id
+
+def apply_ladder(account_id: int, live: list, target: list, asset_0: str, asset_1: str, keep_size: set = (), commit: bool = True):
+    """
+    Moves an account's quotes in one market to a target ladder with as few
+    changes as we can, in a single transaction. A market maker works out the
+    quotes that it wants and we diff them against the ones that it has, so
+    users never see a ladder that is half way through being rebuilt.
+
+    Live orders at a price and side that the ladder does not want are
+    cancelled first, which frees their funds. Orders at a wanted level keep
+    their place in the queue if they are the right size or only need to get
+    smaller, otherwise they are cancelled and entered again. The missing levels
+    are then entered together through enter_orders_bulk.
+
+    Inputs:
+        -> account_id: int,
+        -> live: list, of the account's active Orders in the market.
+        -> target: list, of (side, quantity, price) tuples, at most one for
+           each side and price.
+        -> keep_size: set, of (side, price) levels where a live order of any
+           size is kept, such as the front of a ladder that is trading.
+        -> commit: bool, set to False when the caller will commit.
+
+    Returns:
+        -> order_ids: list, with the order_id quoting each level of the
+           target, or False where nothing rests because we had no funds or it
+           traded, in the same order as the target.
+    """
+    claim_order_book(asset_0, asset_1)
+    wanted = {(side, price) for side, _, price in target}
+    resting = {}
+    for o in live:
+        if not o.active:
+            continue
+        if (o.side, o.price) in wanted and (o.side, o.price) not in resting:
+            resting[(o.side, o.price)] = o
+        else:
+            deactivate_order(o)
+
+    order_ids = [False] * len(target)
+    missing = [] # The positions in target of the levels that need a new order.
+    for i, (side, quantity, price) in enumerate(target):
+        o = resting.get((side, price))
+        if o is None:
+            missing.append(i)
+        elif o.quantity == quantity or (side, price) in keep_size:
+            order_ids[i] = o.order_id
+        elif quantity < o.quantity:
+            order_ids[i] = amend_order(o.order_id, quantity = quantity, commit = False)
+        else:
+            deactivate_order(o)
+            missing.append(i)
+
+    results = []
+    if missing:
+        results = enter_orders_bulk(account_id, [target[i] for i in missing], asset_0, asset_1, commit = False)
+    for i, result in zip(missing, results):
+        if result is not None and result.order_id is not None:
+            order_ids[i] = result.order_id
+
+    if commit:
+        db.session.commit()
+        logger.info(f"Database Commit")
+    return order_ids
+
+def cancel_order_by_id(order_id: int, commit: bool = True):
+    """
+    Cancels an order given only its id, for callers that do not share our
+    database session (such as the sequencer). Orders that are no longer active
+    are left alone.
+
+    Returns:
+        -> cancelled: bool, True if the order was active and is now cancelled.
+    """
+    o = db.session.get(Order, order_id)
+    cancelled = o is not None and o.active
+    if cancelled:
+        deactivate_order(o)
+    if commit:
+        db.session.commit()
+        logger.info(f"Database Commit")
+    return cancelled
+
+@event.listens_for(db.session, "after_commit")
+def market_events_committed(session):
+    for asset_0, asset_1, kind, account_id in session.info.pop("market_events", ()):
+        bus.publish(engine_topic(asset_0, asset_1), {"type": kind, "account_id": account_id})
+
+@event.listens_for(db.session, "after_transaction_end")
+def market_events_abandoned(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("market_events", None)
@@ -0,0 +1,129 @@
+# This file brings an existing database up to date with models.py. db.create_all
+# adds the tables that are missing but never changes a table that already
+# exists, so the columns and indexes that we add to old tables are added here
+# instead.
+
+import json
+from sqlalchemy import text
+
+from website.models import Balance, Bot, Bot_Order, currencies
+from website.units import Minor_Units
+from website import db, logger
+
+# The columns added to existing tables as (table, column, SQL type), in the
+# order that they were added.
+columns = [
+    ("order", "expires", "DATETIME"),
+]
+
+def move_balances():
+    """
+    Balances used to be a column for each currency on Account. The first time
+    that we run against such a database every balance is copied to a Balance
+    row, the old columns are left in place but are no longer used. The
+    reserved funds are worked out again afterwards by create_reserves.
+
+    Returns:
+        -> moved: bool, whether there was anything to move.
+    """
+    existing = [row[1] for row in db.session.execute(text('PRAGMA table_info("account")'))]
+    if "STN" not in existing or Balance.query.first() is not None:
+        return False
+    for currency in currencies:
+        db.session.execute(text(f"""
+            INSERT INTO balance (account_id, currency, amount, reserved)
+            SELECT account_id, :currency, COALESCE("{currency}", 0), 0
+            FROM account"""), {"currency": currency})
+    logger.info(f"Migration: moved balances to the balance table")
+    return True
+
+def move_bot_banks():
+    """
+    The banks of the fixed interval market maker used to be kept as text in
+    Bot.bids and Bot.asks. The first time that we run against such a database
+    they are copied to Bot_Order rows and the old columns are emptied, so that
+    they are not copied again once the banks are empty.
+
+    Returns:
+        -> moved: bool, whether there was anything to move.
+    """
+    moved = False
+    for bot in Bot.query.filter((Bot.bids != "[]") | (Bot.asks != "[]")):
+        for side, bank in [("bid", bot.bids), ("ask", bot.asks)]:
+            try:
+                order_ids = json.loads(bank or "[]")
+            except ValueError:
+                # A bank that outgrew its column, the bot will start again.
+                logger.warning(f"Migration: could not read the {side} bank of bot {bot.bot_id}")
+                continue
+            for position, order_id in enumerate(order_ids):
+                db.session.add(Bot_Order(bot_id = bot.bot_id, side = side, position = position, order_id = order_id))
+        bot.bids, bot.asks = "[]", "[]"
+        moved = True
+    if moved:
+        logger.info(f"Migration: moved the bot banks to the bot_order table")
+    return moved
+
+def store_minor_units(connection, tables):
+    """
+    Amounts used to be stored as floating point numbers, the first time that
+    we run against such a database every Minor_Units column is turned into
+    whole minor units (see units.py). SQLite's user_version records that a
+    database, or an archive, has been converted so that it is only done once.
+
+    Inputs:
+        -> connection: the connection of the database, or archive, to convert.
+        -> tables: list, of the tables to convert.
+
+    Returns:
+        -> converted: bool, whether there were any rows to convert.
+    """
+    if connection.execute(text("PRAGMA user_version")).scalar() >= 1:
+        return False
+    converted = False
+    for table in tables:
+        columns = [c for c in table.columns if isinstance(c.type, Minor_Units)]
+        if not columns:
+            continue
+        values = ", ".join(
+            f'"{c.name}" = CAST(ROUND("{c.name}" * {10 ** c.type.places}) AS INTEGER)'
+            for c in columns)
+        result = connection.execute(text(f'UPDATE "{table.name}" SET {values}'))
+        converted = converted or result.rowcount > 0
+    connection.execute(text("PRAGMA user_version = 1"))
+    if converted:
+        logger.info(f"Migration: stored amounts as minor units")
+    return converted
+
+def migrate():
+    """
+    Adds any of the columns above, and any of the indexes declared in
+    models.py, that the database does not have yet, moves the balances to
+    their own table, the bot banks to theirs and stores the amounts as minor
+    units. This is run every time the app starts, after db.create_all.
+
+    Returns:
+        -> changed: bool, whether anything was migrated, the journal takes a
+           new snapshot if so because older entries describe the old tables.
+    """
+    changed = False
+    for table, column, sql_type in columns:
+        existing = [row[1] for row in db.session.execute(text(f'PRAGMA table_info("{table}")'))]
+        if existing and column not in existing:
+            db.session.execute(text(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {sql_type}'))
+            logger.info(f"Migration: added {table}.{column}")
+            changed = True
+
+    connection = db.session.connection()
+    for table in db.metadata.sorted_tables:
+        existing = [row[1] for row in db.session.execute(text(f'PRAGMA index_list("{table.name}")'))]
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+                logger.info(f"Migration: added index {index.name}")
+
+    changed = move_balances() or changed
+    changed = move_bot_banks() or changed
+    changed = store_minor_units(connection, db.metadata.sorted_tables) or changed
+    db.session.commit()
+    return changed
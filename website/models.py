@@ -1,8 +1,11 @@
 import flask_login as fo
 from sqlalchemy.sql import func
+from sqlalchemy import inspect
+from sqlalchemy.orm import attribute_keyed_dict
 import decimal as de
 # import datetime as dt
 # b[1:-1].split(", ")
+from website.units import Minor_Units
 from website import db
 
 class Order(db.Model):
@@ -13,21 +16,33 @@ class Order(db.Model):
     asset_0 = db.Column(db.String(6)) # asset used as a currency
     asset_1 = db.Column(db.String(6)) # asset being bought/sold
     side = db.Column(db.String(6)) # "buy" or "sell"
-    price = db.Column(db.Numeric(9, 2))
-    quantity = db.Column(db.Numeric(9, 2))
-    quantity_og = db.Column(db.Numeric(9, 2))
+    price = db.Column(Minor_Units())
+    quantity = db.Column(Minor_Units())
+    quantity_og = db.Column(Minor_Units())
     active = db.Column(db.Boolean, default = True)
     account_id = db.Column(db.Integer, db.ForeignKey("account.account_id"))
+    expires = db.Column(db.DateTime(timezone = False)) # UTC, None means the order is good till cancelled
+    # Only active orders are looked up by market or by account, so these
+    # indexes leave out the inactive orders which are most of the table.
+    __table_args__ = (
+        db.Index("ix_order_book", "asset_0", "asset_1", "side", "price", "quantity", sqlite_where = db.text("active = 1")),
+        db.Index("ix_order_account", "account_id", "asset_0", "asset_1", sqlite_where = db.text("active = 1")),
+        db.Index("ix_order_expires", "expires", sqlite_where = db.text("active = 1 AND expires IS NOT NULL")),
+    )
 
 class Payment(db.Model):
     payment_id = db.Column(db.Integer, primary_key = True)
     time = db.Column(db.DateTime(timezone = False), default = func.now())
     currency = db.Column(db.String(6))
-    quantity = db.Column(db.Numeric(9, 2))
+    quantity = db.Column(Minor_Units())
     paid_from_id = db.Column(db.Integer, db.ForeignKey("account.account_id"))
     paid_to_id = db.Column(db.Integer, db.ForeignKey("account.account_id"))
     status = db.Column(db.Integer, default = 1) # Options are 0 (Pending), 1 (Approved) and 2 (Cancelled)
     message = db.Column(db.String(100))
+    __table_args__ = (
+        db.Index("ix_payment_paid_from", "paid_from_id", "time"),
+        db.Index("ix_payment_paid_to", "paid_to_id", "time"),
+    )
 
 class Flow(db.Model): # Deposit or withdrawal
     flow_id = db.Column(db.Integer, primary_key = True)
@@ -35,10 +50,14 @@ class Flow(db.Model): # Deposit or withdrawal
     time_executed = db.Column(db.DateTime(timezone = False))
     time_cancelled = db.Column(db.DateTime(timezone = False))
     currency = db.Column(db.String(6))
-    quantity = db.Column(db.Numeric(9, 2)) # Negative quantity indicate a withdrawal
+    quantity = db.Column(Minor_Units()) # Negative quantity indicate a withdrawal
     paid_to_id = db.Column(db.Integer, db.ForeignKey("account.account_id"))
     status = db.Column(db.Integer, default = 0) # Options are 0 (Pending), 1 (Approved) and 2 (Cancelled)
     message = db.Column(db.String(100))
+    __table_args__ = (
+        db.Index("ix_flow_status", "status"),
+        db.Index("ix_flow_paid_to", "paid_to_id", "time"),
+    )
 
 class Account(db.Model, fo.UserMixin):
     id = db.Column(db.Integer, primary_key = True)
@@ -49,15 +68,12 @@ class Account(db.Model, fo.UserMixin):
     photo = db.Column(db.String(15))
     password = db.Column(db.String(100))
     hash = db.Column(db.String(200))
-    STN = db.Column(db.Numeric(9, 2), default = de.Decimal("0"))
-    EUR = db.Column(db.Numeric(9, 2), default = de.Decimal("0"))
-    USD = db.Column(db.Numeric(9, 2), default = de.Decimal("0"))
-    GBP = db.Column(db.Numeric(9, 2), default = de.Decimal("0"))
-    JPY = db.Column(db.Numeric(9, 2), default = de.Decimal("0"))
-    CAD = db.Column(db.Numeric(9, 2), default = de.Decimal("0"))
-    AUD = db.Column(db.Numeric(9, 2), default = de.Decimal("0"))
-    CHF = db.Column(db.Numeric(9, 2), default = de.Decimal("0"))
-    AOA = db.Column(db.Numeric(9, 2), default = de.Decimal("0"))
+    # The balances are Balance rows, one for each currency that the account
+    # has held. account.EUR and the others (see balance_property) still read
+    # and write them for the templates and the older code.
+    balances = db.relationship(
+        "Balance", primaryjoin = "Account.account_id == foreign(Balance.account_id)",
+        collection_class = attribute_keyed_dict("currency"))
     orders = db.relationship("Order")
     # orders = db.relationship("Deposit")
     name_STN = db.Column(db.String(50))
@@ -80,33 +96,118 @@ class Account(db.Model, fo.UserMixin):
     IBAN_AOA = db.Column(db.String(100))
     account_AOA = db.Column(db.String(50))
     bank_AOA = db.Column(db.String(50))
-    SAVE_EUR = db.Column(db.Numeric(9, 2), default = de.Decimal("0"))
-    RAVE_EUR = db.Column(db.Numeric(9, 2), default = de.Decimal("0"))
+
+    def get_balance(self, currency: str):
+        """
+        Returns the account's Balance row for a currency, None if the account
+        has never held it.
+        """
+        b = self.balances.get(currency)
+        if b is None and inspect(self).has_identity:
+            # Rows added by the ledger in this transaction are not in the
+            # collection until it is loaded again.
+            b = Balance.query.filter_by(account_id = self.account_id, currency = currency).first()
+            if b is not None:
+                self.balances[currency] = b
+        return b
+
+def balance_property(currency: str):
+    """
+    Makes account.CUR read and write the amount of the account's Balance row
+    for that currency, a row is added the first time that it is written.
+    """
+    def get_amount(account):
+        b = account.get_balance(currency)
+        # A currency without a row shows as 0.00 like the amounts of the rows.
+        return de.Decimal("0.00") if b is None else b.amount
+
+    def set_amount(account, amount):
+        b = account.get_balance(currency)
+        if b is None:
+            account.balances[currency] = Balance(currency = currency, amount = amount, reserved = de.Decimal("0"))
+        else:
+            b.amount = amount
+    return property(get_amount, set_amount)
+
+# SAVE_EUR is the savings account and RAVE_EUR what has been asked to be
+# withdrawn from it.
+currencies = ["STN", "EUR", "USD", "GBP", "JPY", "CAD", "AUD", "CHF", "AOA", "SAVE_EUR", "RAVE_EUR"]
+for currency in currencies:
+    setattr(Account, currency, balance_property(currency))
+
+class Balance(db.Model): # How much of one currency an account holds
+    balance_id = db.Column(db.Integer, primary_key = True)
+    account_id = db.Column(db.Integer, db.ForeignKey("account.account_id"))
+    currency = db.Column(db.String(8))
+    amount = db.Column(Minor_Units(), default = de.Decimal("0"))
+    reserved = db.Column(Minor_Units(), default = de.Decimal("0")) # Locked by active orders.
+    __table_args__ = (db.UniqueConstraint("account_id", "currency"),)
 
 class Trade(db.Model):
     trade_id = db.Column(db.Integer, primary_key = True)
     time = db.Column(db.DateTime(timezone = False), default = func.now())
     asset_0 = db.Column(db.String(6)) # asset used as a currency
     asset_1 = db.Column(db.String(6)) # asset being bought/sold
-    quantity = db.Column(db.Numeric(9, 2))
-    price = db.Column(db.Numeric(9, 2))
+    quantity = db.Column(Minor_Units())
+    price = db.Column(Minor_Units())
     buyer = db.Column(db.Integer, db.ForeignKey("account.account_id"))
     seller = db.Column(db.Integer, db.ForeignKey("account.account_id"))
     side = db.Column(db.String(6)) # Indicates if the order that took the quote was a bid or an ask order.
     status = db.Column(db.Integer, default = 0) # Options are 0 (Pending), 1 (Approved) and 2 (Cancelled)
+    __table_args__ = (
+        db.Index("ix_trade_market", "asset_0", "asset_1", "status", "time"),
+        db.Index("ix_trade_buyer", "buyer", "time"),
+        db.Index("ix_trade_seller", "seller", "time"),
+        db.Index("ix_trade_pending", "time", sqlite_where = db.text("status = 0")), # Waiting for the administrator
+    )
 
 class Bot(db.Model):
     bot_id = db.Column(db.Integer, primary_key = True)
     user_id = db.Column(db.Integer, db.ForeignKey("account.account_id"))
+    # The banks used to be kept here as text, they are Bot_Order rows now and
+    # these two are emptied by migrate().
     bids = db.Column(db.String(100), default = "[]")
     asks = db.Column(db.String(100), default = "[]")
     v1 = db.Column(db.Numeric(9, 2))
     v2 = db.Column(db.Numeric(9, 2))
     v3 = db.Column(db.Numeric(9, 2))
 
+class Bot_Order(db.Model): # An order in one of a bot's banks of quotes
+    bot_order_id = db.Column(db.Integer, primary_key = True)
+    bot_id = db.Column(db.Integer, db.ForeignKey("bot.bot_id"))
+    side = db.Column(db.String(6))
+    position = db.Column(db.Integer) # 0 is the front of the bank, nearest the mid.
+    order_id = db.Column(db.Integer, db.ForeignKey("order.order_id"))
+    __table_args__ = (db.Index("ix_bot_order_bot", "bot_id", "side", "position"),)
+
 class Instrument(db.Model):
     instrument_id = db.Column(db.Integer, primary_key = True)
     name = db.Column(db.String(100))
     interest = db.Column(db.Numeric(9, 4))
     interest_next = db.Column(db.Numeric(9, 4))
-    currency = db.Column(db.String(6))
\ No newline at end of file
+    currency = db.Column(db.String(6))
+
+class Market(db.Model):
+    market_id = db.Column(db.Integer, primary_key = True)
+    asset_0 = db.Column(db.String(6)) # asset used as a currency
+    asset_1 = db.Column(db.String(6)) # asset being bought/sold
+    version = db.Column(db.Integer, default = 0) # Goes up by one every time the book changes.
+
+
+class Journal_Sequence(db.Model): # The last sequence number given out by the event journal
+    journal_sequence_id = db.Column(db.Integer, primary_key = True)
+    seq = db.Column(db.Integer, default = 0)
+
+class Candle(db.Model): # Open, high, low, close and volume of a market's trades over one interval
+    candle_id = db.Column(db.Integer, primary_key = True)
+    asset_0 = db.Column(db.String(6)) # asset used as a currency
+    asset_1 = db.Column(db.String(6)) # asset being bought/sold
+    interval = db.Column(db.String(3)) # "1m", "1h" or "1d"
+    start = db.Column(db.DateTime(timezone = False)) # UTC, like Trade.time
+    open = db.Column(Minor_Units())
+    high = db.Column(Minor_Units())
+    low = db.Column(Minor_Units())
+    close = db.Column(Minor_Units())
+    volume = db.Column(Minor_Units()) # quantity of asset_1 traded
+    trades = db.Column(db.Integer)
+    __table_args__ = (db.UniqueConstraint("asset_0", "asset_1", "interval", "start"),)
@@ -0,0 +1,257 @@
+# This file holds the in memory order books that the matching engine trades
+# against. Each market keeps its resting orders sorted into price levels and the
+# orders at each level queue up in the order that they arrived, this gives us
+# price-time priority without going back to the database for every order.
+
+# The database is still our record of truth. The books are built from the
+# active orders when the app starts and the matching engine writes every change
+# through to the database. Each market has a version number in the Market table
+# which goes up by one with every change, if the version in the database is not
+# the one our book expects then another process (such as scheduler.py) has
+# changed the market and we rebuild the book before using it.
+
+# Prices and quantities in the book are ints, in minor units (see units.py), so
+# matching compares and subtracts plain ints.
+
+import bisect
+import collections
+import threading
+from sqlalchemy import event, update
+
+from website.models import Order, Market
+from website.units import to_minor
+from website import db
+
+# Every market on the Portal as (asset_0, asset_1), these are the books that we
+# build when the app starts.
+markets = [
+    ("STN", "EUR"), ("EUR", "USD"), ("EUR", "GBP"), ("EUR", "JPY"),
+    ("EUR", "CAD"), ("EUR", "AUD"), ("EUR", "CHF"), ("EUR", "AOA")
+]
+
+class Book_Entry():
+    """
+    A compact copy of a resting order which holds only what we need to match
+    against it.
+    """
+    __slots__ = ("order_id", "account_id", "side", "price", "quantity")
+
+    def __init__(self, order_id, account_id, side, price, quantity):
+        self.order_id = order_id
+        self.account_id = account_id
+        self.side = side
+        self.price = price
+        self.quantity = quantity
+
+class Order_Book():
+    """
+    The resting orders of one market. Prices on each side are kept in a sorted
+    list and every price maps to a queue of the entries resting at that price,
+    oldest first. The best bid is the last bid price and the best ask is the
+    first ask price.
+    """
+    def __init__(self, asset_0: str, asset_1: str):
+        self.asset_0 = asset_0
+        self.asset_1 = asset_1
+        self.version = None # None means that the book must be rebuilt.
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self.prices = {"bid": [], "ask": []}
+        self.levels = {"bid": {}, "ask": {}}
+        self.entries = {}
+
+    def load(self):
+        """
+        Rebuilds the book from the active orders in the database. Ordering by
+        order_id puts every price level back into the order of arrival.
+        """
+        self.clear()
+        orders = db.session.query(
+            Order.order_id, Order.account_id, Order.side, Order.price,
+            Order.quantity
+            ).filter_by(
+                asset_0 = self.asset_0, asset_1 = self.asset_1, active = True
+            ).order_by(Order.order_id)
+        for o in orders:
+            self.add(o.order_id, o.account_id, o.side, to_minor(o.price), to_minor(o.quantity))
+
+    def add(self, order_id: int, account_id: int, side: str, price: int, quantity: int):
+        """
+        Puts an order at the back of the queue for its price level.
+        """
+        entry = Book_Entry(order_id, account_id, side, price, quantity)
+        level = self.levels[side].get(price)
+        if level is None:
+            level = self.levels[side][price] = collections.deque()
+            bisect.insort(self.prices[side], price)
+        level.append(entry)
+        self.entries[order_id] = entry
+        return entry
+
+    def remove(self, order_id: int):
+        """
+        Takes an order out of the book, returns its entry or None if the order
+        was not resting in this book.
+        """
+        entry = self.entries.pop(order_id, None)
+        if entry is None:
+            return None
+        level = self.levels[entry.side][entry.price]
+        level.remove(entry)
+        if not level:
+            self.drop_level(entry.side, entry.price)
+        return entry
+
+    def reduce(self, order_id: int, quantity: int):
+        """
+        Lowers the quantity of a resting order without moving it in its queue.
+        """
+        self.entries[order_id].quantity = quantity
+
+    def drop_level(self, side: str, price: int):
+        del self.levels[side][price]
+        prices = self.prices[side]
+        del prices[bisect.bisect_left(prices, price)]
+
+    def crosses(self, side: str, price: int):
+        """
+        Returns True if an order at this price would trade with the book.
+        """
+        if side == "bid":
+            return bool(self.prices["ask"]) and self.prices["ask"][0] <= price
+        return bool(self.prices["bid"]) and self.prices["bid"][-1] >= price
+
+    def can_fill(self, side: str, quantity: int, price: int):
+        """
+        Returns True if the book holds enough at this price or better to fill
+        the whole quantity of an incoming order.
+        """
+        opp_side = "ask" if side == "bid" else "bid"
+        prices = self.prices[opp_side]
+        if opp_side == "bid":
+            prices = reversed(prices)
+        for best in prices:
+            if (side == "bid" and best > price) or (side == "ask" and best < price):
+                break
+            for entry in self.levels[opp_side][best]:
+                quantity -= entry.quantity
+                if quantity <= 0:
+                    return True
+        return False
+
+    def match(self, side: str, quantity: int, price: int):
+        """
+        Matches an incoming order against the opposite side of the book, taking
+        the best price first and the oldest order first within a price. Filled
+        entries are removed from the book and partially filled entries keep
+        their place in the queue.
+
+        Inputs:
+            -> side: str, the side of the incoming order, "bid" or "ask".
+            -> quantity: int, the quantity of the incoming order in minor
+               units.
+            -> price: int, the limit price of the incoming order in minor
+               units.
+
+        Returns:
+            -> fills: list, of (entry, quantity_traded) in the order that the
+               trades happened, quantity_traded in minor units.
+        """
+        opp_side = "ask" if side == "bid" else "bid"
+        prices = self.prices[opp_side]
+        levels = self.levels[opp_side]
+
+        fills = []
+        while quantity > 0 and prices:
+            best = prices[0] if opp_side == "ask" else prices[-1]
+            if (side == "bid" and best > price) or (side == "ask" and best < price):
+                # There is no more price overlap.
+                break
+            level = levels[best]
+            while quantity > 0 and level:
+                entry = level[0]
+                quantity_traded = min(quantity, entry.quantity)
+                quantity -= quantity_traded
+                entry.quantity -= quantity_traded
+                fills.append((entry, quantity_traded))
+                if entry.quantity == 0:
+                    level.popleft()
+                    del self.entries[entry.order_id]
+            if not level:
+                self.drop_level(opp_side, best)
+
+        return fills
+
+books = {}
+books_lock = threading.Lock()
+
+def find_order_book(asset_0: str, asset_1: str):
+    """
+    Returns the book object for a market without checking that it is current.
+    """
+    book = books.get((asset_0, asset_1))
+    if book is None:
+        with books_lock:
+            book = books.setdefault((asset_0, asset_1), Order_Book(asset_0, asset_1))
+    return book
+
+def get_order_book(asset_0: str, asset_1: str):
+    """
+    Returns the book for a market for reading, rebuilding it first if the market
+    has changed since we last saw it.
+    """
+    book = find_order_book(asset_0, asset_1)
+    with book.lock:
+        version = db.session.query(Market.version).filter_by(
+            asset_0 = asset_0, asset_1 = asset_1).scalar() or 0
+        if book.version != version:
+            book.load()
+            book.version = version
+    return book
+
+def claim_order_book(asset_0: str, asset_1: str):
+    """
+    Returns the book for a market which we are about to change. The market's
+    version is bumped inside the current transaction, this makes SQLite hand us
+    its write lock so no other process can change the market until we commit.
+    The caller should hold book.lock while it changes the book.
+
+    If the transaction is rolled back instead of committed then the book is
+    marked for a rebuild, see the session listeners below.
+    """
+    book = find_order_book(asset_0, asset_1)
+    with book.lock:
+        result = db.session.execute(
+            update(Market).where(Market.asset_0 == asset_0, Market.asset_1 == asset_1)
+            .values(version = Market.version + 1))
+        if result.rowcount == 0:
+            db.session.add(Market(asset_0 = asset_0, asset_1 = asset_1, version = 1))
+            db.session.flush()
+        version = db.session.query(Market.version).filter_by(
+            asset_0 = asset_0, asset_1 = asset_1).scalar()
+        if book.version != version - 1:
+            book.load()
+        book.version = version
+        db.session().info.setdefault("order_books", set()).add(book)
+    return book
+
+def load_order_books():
+    """
+    Builds the book of every market, this is called once when the app starts.
+    """
+    for asset_0, asset_1 in markets:
+        get_order_book(asset_0, asset_1)
+
+@event.listens_for(db.session, "after_commit")
+def order_books_committed(session):
+    session.info.pop("order_books", None)
+
+@event.listens_for(db.session, "after_transaction_end")
+def order_books_abandoned(session, transaction):
+    # Any book still listed here was changed in a transaction that did not
+    # commit, so its changes never reached the database.
+    if transaction.parent is None:
+        for book in session.info.pop("order_books", ()):
+            book.version = None
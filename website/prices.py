@@ -0,0 +1,183 @@
+# This file keeps the reference prices that the derivative market makers quote
+# around (see Deriviative_Market_Maker in bots.py). Rather than each bot asking
+# its source for a price every time that it runs, which put a network call on
+# the path of every user trade, the process keeps one cache of the latest price
+# of every source symbol. A background thread fetches all the symbols that the
+# bots have asked for in one batch every ttl seconds, so a bot reading the cache
+# never waits on the network.
+
+# A price whose last bar is older than max_age is too stale to quote on and the
+# cache gives the bot None instead. We go by the time of the bar rather than the
+# time that we fetched it, a source that has stopped updating (a closed market
+# or a stuck feed) keeps answering with its last close. Where the prices come
+# from is up to the provider, Yahoo Finance by default or a JSON file (set
+# PRICE_FILE in the app's config) for running the bots offline.
+
+import abc
+import json
+import threading
+import datetime as dt
+import decimal as de
+import flask as fl
+
+from website.util import utc_now
+from website import logger
+
+class Price_Provider(abc.ABC):
+    """
+    Where the cache gets its prices from. fetch() is given every symbol at once
+    and returns the prices of those that it found.
+    """
+    @abc.abstractmethod
+    def fetch(self, symbols: list):
+        """
+        Returns:
+            -> prices: dict, of {symbol: (time, de.Decimal)}, where time is
+               when the price's bar closed in UTC without a timezone (see
+               utc_now). Symbols without a price are left out.
+        """
+
+class Yahoo_Provider(Price_Provider):
+    """
+    Downloads the latest one minute close of every symbol from Yahoo Finance in
+    a single request.
+    """
+    def fetch(self, symbols: list):
+        import yfinance as yf # Only needed when we are online.
+
+        data = yf.download(symbols, period = "1d", interval = "1m", progress = False)
+        closes = data["Close"]
+        if closes.ndim == 1: # Older versions return a Series for one symbol.
+            closes = closes.to_frame(symbols[0])
+        prices = {}
+        for symbol in symbols:
+            if symbol not in closes:
+                continue
+            series = closes[symbol].dropna()
+            if series.empty:
+                continue
+            price = float(series.iloc[-1])
+            # A patch because our API normalises Yen in a weird way.
+            if symbol[:3] == "JPY" and price > 0.05:
+                price = price / 100
+            bar_time = series.index[-1].to_pydatetime()
+            if bar_time.tzinfo is not None:
+                bar_time = bar_time.astimezone(dt.timezone.utc).replace(tzinfo = None)
+            prices[symbol] = (bar_time, de.Decimal(str(price)))
+        return prices
+
+class File_Provider(Price_Provider):
+    """
+    Reads the prices from a JSON file of {symbol: price}, for running the bots
+    offline or in tests. The file is read on every fetch so the prices can be
+    changed while we run. A price can also be given as {"price": price, "time":
+    time} with the time of its bar in ISO format (UTC), a plain price is taken
+    to be current.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def fetch(self, symbols: list):
+        with open(self.path) as f:
+            data = json.load(f)
+        now = utc_now()
+        prices = {}
+        for symbol in symbols:
+            if symbol not in data:
+                continue
+            entry = data[symbol]
+            if isinstance(entry, dict):
+                bar_time = dt.datetime.fromisoformat(entry["time"])
+                if bar_time.tzinfo is not None:
+                    bar_time = bar_time.astimezone(dt.timezone.utc).replace(tzinfo = None)
+                prices[symbol] = (bar_time, de.Decimal(str(entry["price"])))
+            else:
+                prices[symbol] = (now, de.Decimal(str(entry)))
+        return prices
+
+class Price_Cache():
+    """
+    The latest price of each symbol with the time of its bar. Symbols are added
+    the first time that a bot asks for them and the background thread fetches
+    them straight away, then every ttl seconds.
+    """
+    def __init__(self, provider: Price_Provider, ttl: float = 60, max_age: float = 600):
+        self.provider = provider
+        self.ttl = ttl
+        self.max_age = max_age # Seconds since the price's bar.
+        self.prices = {} # {symbol: (time, price)}, time is the bar's, see fetch()
+        self.symbols = set()
+        self.pending = False # Whether there are symbols that we have never fetched.
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target = self.run, name = "prices", daemon = True)
+        self.thread.start()
+
+    def get(self, symbol: str):
+        """
+        Returns the latest price of a symbol, or None if we have no price for
+        it whose bar is younger than max_age. Never waits on the provider.
+        """
+        with self.condition:
+            if symbol not in self.symbols:
+                self.symbols.add(symbol)
+                self.pending = True
+                self.condition.notify()
+            entry = self.prices.get(symbol)
+        if entry is None or utc_now() - entry[0] > dt.timedelta(seconds = self.max_age):
+            return None
+        return entry[1]
+
+    def refresh(self, symbols: list = None):
+        """
+        Fetches the given symbols, or every symbol that we know of, in one batch
+        and waits for them. A provider that fails leaves the old prices in
+        place to age.
+
+        Returns:
+            -> prices: dict, of {symbol: de.Decimal} for the prices fetched.
+        """
+        with self.condition:
+            if symbols is None:
+                symbols = list(self.symbols)
+            else:
+                self.symbols.update(symbols)
+        if not symbols:
+            return {}
+        try:
+            prices = self.provider.fetch(symbols)
+        except Exception as e:
+            logger.error(f"Price fetch of {symbols} failed: {e!r}")
+            return {}
+        with self.condition:
+            self.prices.update(prices)
+        missing = set(symbols) - set(prices)
+        if missing:
+            logger.warning(f"No price for {sorted(missing)}")
+        return {symbol: price for symbol, (_, price) in prices.items()}
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending, timeout = self.ttl)
+                self.pending = False
+            self.refresh()
+
+price_cache = None # The price cache of this process, see get_price_cache().
+price_cache_lock = threading.Lock()
+
+def get_price_cache():
+    """
+    Returns the price cache of this process, starting it the first time it is
+    needed. Must be called inside an app context, the provider and the times
+    come from the app's config.
+    """
+    global price_cache
+    if price_cache is None:
+        with price_cache_lock:
+            if price_cache is None:
+                config = fl.current_app.config
+                path = config.get("PRICE_FILE")
+                provider = Yahoo_Provider() if path is None else File_Provider(path)
+                price_cache = Price_Cache(
+                    provider, config.get("PRICE_TTL", 60), config.get("PRICE_MAX_AGE", 600))
+    return price_cache
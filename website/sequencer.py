@@ -0,0 +1,124 @@
+# This file runs every change to a market's book through a single writer. Each
+# market gets a sequencer, which is one queue and one worker thread, so orders
+# and cancellations for a market are applied one at a time in the order that
+# they arrived no matter which request thread or bot sent them. Callers get a
+# future back and can wait on it for the result.
+
+# When the queue backs up the worker takes several jobs at once and commits
+# them in a single transaction.
+
+import queue
+import threading
+import flask as fl
+from concurrent.futures import Future
+
+from website import db, logger
+
+class Sequencer():
+    """
+    The single writer for one market.
+
+    Jobs sent with submit() are engine operations which must not commit, the
+    sequencer commits them in batches. Jobs sent with submit_alone() (such as a
+    bot run) are run on their own and are trusted to commit for themselves.
+    """
+    def __init__(self, app, asset_0: str, asset_1: str, batch_size: int = 50):
+        self.app = app
+        self.asset_0 = asset_0
+        self.asset_1 = asset_1
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(
+            target = self.run, name = f"sequencer-{asset_1}{asset_0}",
+            daemon = True)
+        self.thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues an engine operation such as enter_order(..., commit = False).
+
+        Returns:
+            -> future: concurrent.futures.Future, which will hold the value
+               returned by fn once its batch has committed.
+        """
+        return self.put(fn, args, kwargs, True)
+
+    def submit_alone(self, fn, *args, **kwargs):
+        """
+        Queues a job that is run outside of any batch and commits for itself.
+        """
+        return self.put(fn, args, kwargs, False)
+
+    def put(self, fn, args, kwargs, batch):
+        future = Future()
+        if threading.current_thread() is self.thread:
+            # We are already inside this market's worker (for example a bot
+            # run entering orders), waiting on the queue would deadlock.
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self.queue.put((fn, args, kwargs, batch, future))
+        return future
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                jobs = [self.queue.get()]
+                # Take as many waiting batch jobs as we can, a job that has to
+                # run alone waits for the next round.
+                while jobs[-1][3] and len(jobs) < self.batch_size:
+                    try:
+                        job = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if not job[3]:
+                        self.run_jobs(jobs)
+                        jobs = [job]
+                        break
+                    jobs.append(job)
+                self.run_jobs(jobs)
+
+    def run_jobs(self, jobs):
+        """
+        Runs a list of jobs in one transaction. If one of them fails then the
+        whole transaction is rolled back and each job is retried on its own so
+        that only the failing job reports an error.
+        """
+        results = []
+        try:
+            for fn, args, kwargs, batch, future in jobs:
+                results.append(fn(*args, **kwargs))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(jobs) > 1:
+                for job in jobs:
+                    self.run_jobs([job])
+            else:
+                logger.error(f"Sequencer {self.asset_1}/{self.asset_0} job {jobs[0][0].__name__} failed: {e!r}")
+                jobs[0][4].set_exception(e)
+            return
+        finally:
+            db.session.remove()
+
+        for job, result in zip(jobs, results):
+            job[4].set_result(result)
+
+sequencers = {}
+sequencers_lock = threading.Lock()
+
+def get_sequencer(asset_0: str, asset_1: str):
+    """
+    Returns the sequencer of a market, starting it the first time it is needed.
+    Must be called inside an app context.
+    """
+    sequencer = sequencers.get((asset_0, asset_1))
+    if sequencer is None:
+        with sequencers_lock:
+            sequencer = sequencers.get((asset_0, asset_1))
+            if sequencer is None:
+                sequencer = Sequencer(fl.current_app._get_current_object(), asset_0, asset_1)
+                sequencers[(asset_0, asset_1)] = sequencer
+    return sequencer
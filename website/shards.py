@@ -0,0 +1,248 @@
+# This file can run the matching engine of each market in its own worker
+# process (a shard), so that busy markets such as the bots' FX pairs use their
+# own CPU core instead of sharing one Python process with EUR/STN. The web
+# process keeps serving pages and sends each engine job down a pipe to the shard
+# that owns the market, the shard runs it through its own sequencer and sends
+# the result back.
+
+# Shards are switched on with create_app(shards = True). Every caller already
+# sends its engine work through get_sequencer(), so in shard mode we simply put
+# a Shard_Client in place of each market's Sequencer and nothing else changes.
+
+# A shard has no expiry scheduler of its own (see expiry.py). When a shard acks
+# a good till time order that rests in its book, the Shard_Client hands the
+# order's expiry to the web process's scheduler.
+
+# The fills and cancellations that a shard's engine publishes on its event bus
+# are forwarded to the web process's bus, where the bot triggers listen for
+# them (see bot_triggers.py).
+
+# A shard builds its own app, with the settings of the web app listed in
+# shard_config. A shard that dies fails the jobs that it was running with
+# Shard_Stopped and is started again for the next job in its market.
+
+# Balances are shared between shards through the database. Each job claims its
+# market first (see claim_order_book), which takes SQLite's write lock, and
+# only then reads the account's balance and reserved funds, so an account
+# trading in two markets at once cannot spend the same funds twice.
+
+import queue
+import itertools
+import threading
+import multiprocessing as mp
+from concurrent.futures import Future
+
+from website.order_book import markets
+from website.sequencer import sequencers, sequencers_lock
+from website.events import bus
+from website import logger
+
+# The settings of the web app that a shard needs as well, see create_app.
+shard_config = ["JOURNAL_PATH", "ARCHIVE_PATH", "PRICE_FILE", "PRICE_TTL", "PRICE_MAX_AGE"]
+
+class Shard_Stopped(RuntimeError):
+    """
+    The shard running a job died before it answered, so the job may or may
+    not have been committed.
+    """
+
+class Shard_Client():
+    """
+    Stands in for a market's Sequencer in the web process, it has the same
+    submit() and submit_alone() but the jobs run in the market's shard. The
+    functions and their arguments are pickled so they must be module level
+    functions such as enter_order or bot_6000000.
+    """
+    def __init__(self, shard, asset_0: str, asset_1: str):
+        self.shard = shard
+        self.asset_0 = asset_0
+        self.asset_1 = asset_1
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        future = self.get_shard().send(self.asset_0, self.asset_1, fn, args, kwargs, True)
+        return self.schedule_expiry(future, kwargs.get("expires"))
+
+    def submit_alone(self, fn, *args, **kwargs):
+        future = self.get_shard().send(self.asset_0, self.asset_1, fn, args, kwargs, False)
+        return self.schedule_expiry(future, kwargs.get("expires"))
+
+    def get_shard(self):
+        """
+        Returns our market's shard, starting a new one if it has died.
+        """
+        with self.lock:
+            if self.shard.stopped or not self.shard.process.is_alive():
+                logger.error(f"Restarting shard {self.shard.process.name}")
+                self.shard.connection.close()
+                self.shard = Shard(self.shard.database_uri, self.asset_0, self.asset_1, self.shard.config)
+            return self.shard
+
+    def schedule_expiry(self, future, expires):
+        if expires is not None:
+            future.add_done_callback(lambda f: self.add_expiry(f, expires))
+        return future
+
+    def add_expiry(self, future, expires):
+        """
+        Adds the orders that a job left resting with an expiry to our expiry
+        scheduler, the job returns an Order_Result or a list of them (see
+        enter_order and enter_orders_bulk).
+        """
+        from website import expiry
+        from website.matching_engine import Order_Result
+
+        if future.exception() is not None or expiry.scheduler is None:
+            return
+        results = future.result()
+        if not isinstance(results, list):
+            results = [results]
+        expiry.scheduler.add([
+            (expires, r.order_id, self.asset_0, self.asset_1) for r in results
+            if isinstance(r, Order_Result) and r.order_id is not None])
+
+class Shard():
+    """
+    One worker process and the pipe that we talk to it through. A thread reads
+    the replies and completes the future of each job.
+    """
+    def __init__(self, database_uri: str, asset_0: str, asset_1: str, config: dict = None):
+        self.database_uri = database_uri
+        self.config = config or {}
+        # We start the worker fresh rather than forking a process which already
+        # has threads and open database connections.
+        context = mp.get_context("spawn")
+        self.connection, child = context.Pipe()
+        self.process = context.Process(
+            target = run_shard, args = (child, database_uri, asset_0, asset_1, self.config),
+            name = f"shard-{asset_1}{asset_0}", daemon = True)
+        self.process.start()
+        child.close()
+
+        self.futures = {}
+        self.job_ids = itertools.count()
+        self.stopped = False # Whether the worker has gone, see receive().
+        self.lock = threading.Lock()
+        self.reader = threading.Thread(
+            target = self.receive, name = f"shard-{asset_1}{asset_0}-reader",
+            daemon = True)
+        self.reader.start()
+
+    def send(self, asset_0, asset_1, fn, args, kwargs, batch):
+        future = Future()
+        with self.lock:
+            if self.stopped:
+                future.set_exception(Shard_Stopped(f"{self.process.name} stopped"))
+                return future
+            job_id = next(self.job_ids)
+            self.futures[job_id] = future
+            try:
+                self.connection.send((job_id, asset_0, asset_1, fn, args, kwargs, batch))
+            except (EOFError, OSError):
+                # The reader will find the pipe closed and fail the job.
+                pass
+        return future
+
+    def receive(self):
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] is None:
+                # An event of the shard's engine, see forward_events.
+                _, topic, event = message
+                bus.publish(topic, event)
+                continue
+            job_id, ok, value = message
+            future = self.futures.pop(job_id)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+        # The worker has gone, nobody will answer the jobs still waiting.
+        logger.error(f"Shard {self.process.name} stopped")
+        with self.lock:
+            self.stopped = True
+            futures, self.futures = self.futures, {}
+        for future in futures.values():
+            future.set_exception(Shard_Stopped(f"{self.process.name} stopped"))
+
+def forward_events(connection, send_lock, topic: str):
+    """
+    Sends the events published on a topic of this shard's bus to the web
+    process, as (None, topic, event) so that they cannot be taken for a reply.
+    """
+    subscription = bus.subscribe(topic)
+    while True:
+        try:
+            event = subscription.get(timeout = 1)
+        except queue.Empty:
+            if subscription.closed:
+                subscription = bus.subscribe(topic)
+            continue
+        with send_lock:
+            try:
+                connection.send((None, topic, event))
+            except (EOFError, OSError):
+                return # The web process has gone.
+
+def run_shard(connection, database_uri: str, asset_0: str, asset_1: str, config: dict):
+    """
+    The main loop of a worker process. Jobs are handed to the market's
+    sequencer and the result is sent back once the sequencer has finished it.
+
+    Inputs:
+        -> config: dict, the web app's settings in shard_config.
+    """
+    from website import create_app
+    from website.sequencer import get_sequencer
+    from website.matching_engine import engine_topic
+
+    # The bots are run by the web process, on the events that we forward, and
+    # the web process saves the journal's snapshots.
+    app = create_app(database_uri, bots = False, snapshots = False, config = config)
+    send_lock = threading.Lock()
+    threading.Thread(
+        target = forward_events, args = (connection, send_lock, engine_topic(asset_0, asset_1)),
+        name = "shard-events", daemon = True).start()
+
+    def reply(job_id, future):
+        e = future.exception()
+        message = (job_id, True, future.result()) if e is None else (job_id, False, e)
+        with send_lock:
+            try:
+                connection.send(message)
+            except Exception:
+                # The exception could not be pickled, we send its text instead.
+                connection.send((job_id, False, RuntimeError(repr(e))))
+
+    with app.app_context():
+        while True:
+            try:
+                job_id, asset_0, asset_1, fn, args, kwargs, batch = connection.recv()
+            except (EOFError, OSError):
+                return # The web process has gone.
+            sequencer = get_sequencer(asset_0, asset_1)
+            if batch:
+                future = sequencer.submit(fn, *args, **kwargs)
+            else:
+                future = sequencer.submit_alone(fn, *args, **kwargs)
+            future.add_done_callback(lambda f, job_id = job_id: reply(job_id, f))
+
+def start_shards(app):
+    """
+    Starts a shard for every market and sends the market's engine jobs to it
+    from now on.
+    """
+    if mp.current_process().name.startswith("shard-"):
+        # We are a shard ourselves. Starting a worker runs the main script
+        # (such as main.py) again, which would ask for shards of its own.
+        return
+    database_uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    config = {key: app.config[key] for key in shard_config if key in app.config}
+    with sequencers_lock:
+        for asset_0, asset_1 in markets:
+            shard = Shard(database_uri, asset_0, asset_1, config)
+            sequencers[(asset_0, asset_1)] = Shard_Client(shard, asset_0, asset_1)
@@ -0,0 +1,113 @@
+// This script keeps the book and the recent trades of a market page up to date.
+// It listens to the market's stream, starts from the snapshot that the stream
+// sends first and then applies each change to the book and each new trade. If
+// a message goes missing (its sequence number is not the next one) we start
+// again from a new snapshot.
+
+let stream_url = document.currentScript.dataset.stream;
+let book_body = document.getElementById("book");
+let trades_body = document.getElementById("trades");
+let row_count = book_body !== null ? book_body.rows.length : 0;
+let trade_count = 7;
+
+let levels = {bid: new Map(), ask: new Map()};
+let trades = [];
+let seq = null;
+let source = null;
+
+function connect() {
+    if (source !== null) {
+        source.close();
+    }
+    source = new EventSource(stream_url);
+    source.addEventListener("snapshot", function(event) {
+        let message = JSON.parse(event.data);
+        levels = {bid: new Map(message.bids), ask: new Map(message.asks)};
+        trades = message.trades;
+        seq = message.seq;
+        draw_book();
+        draw_trades();
+    });
+    source.addEventListener("book", function(event) {
+        let message = JSON.parse(event.data);
+        if (!next(message)) return;
+        apply_changes(levels.bid, message.bids);
+        apply_changes(levels.ask, message.asks);
+        draw_book();
+    });
+    source.addEventListener("trades", function(event) {
+        let message = JSON.parse(event.data);
+        if (!next(message)) return;
+        trades = message.trades.concat(trades).slice(0, trade_count);
+        draw_trades();
+    });
+}
+
+function next(message) {
+    // Returns true if this is the message we expected next, otherwise we
+    // reconnect for a new snapshot.
+    if (seq === null || message.seq <= seq) return false;
+    if (message.seq !== seq + 1) {
+        seq = null;
+        connect();
+        return false;
+    }
+    seq = message.seq;
+    return true;
+}
+
+function apply_changes(side, changes) {
+    for (let [price, quantity] of changes) {
+        if (Number(quantity) === 0) {
+            side.delete(price);
+        } else {
+            side.set(price, quantity);
+        }
+    }
+}
+
+function cell(text, colour, shade) {
+    let td = document.createElement("td");
+    td.textContent = ` ${text} `;
+    td.style.color = colour;
+    if (shade) {
+        td.style.backgroundColor = colour === "darkgreen" ? "rgb(207, 238, 207)" : "rgb(238, 207, 207)";
+    }
+    return td;
+}
+
+function draw_book() {
+    // The best bids are the highest prices and the best asks the lowest.
+    let bids = [...levels.bid].sort((a, b) => Number(b[0]) - Number(a[0]));
+    let asks = [...levels.ask].sort((a, b) => Number(a[0]) - Number(b[0]));
+    let rows = [];
+    for (let i = 0; i < row_count; i++) {
+        let shade = i % 2 === 0;
+        let tr = document.createElement("tr");
+        let bid = bids[i] || ["-", "-"];
+        let ask = asks[i] || ["-", "-"];
+        tr.append(
+            cell(bid[1], "darkgreen", shade), cell(bid[0], "darkgreen", shade),
+            cell(ask[0], "darkred", shade), cell(ask[1], "darkred", shade));
+        rows.push(tr);
+    }
+    book_body.replaceChildren(...rows);
+}
+
+function draw_trades() {
+    let rows = [];
+    for (let trade of trades) {
+        let tr = document.createElement("tr");
+        for (let value of trade) {
+            let td = document.createElement("td");
+            td.textContent = ` ${value} `;
+            tr.append(td);
+        }
+        rows.push(tr);
+    }
+    trades_body.replaceChildren(...rows);
+}
+
+if (book_body !== null && trades_body !== null && window.EventSource) {
+    connect();
+}
@@ -7,22 +7,32 @@
 # import hashlib as hl
 import decimal as de
 import datetime as dt
+import itertools
 from sqlalchemy.sql import func, or_
 from sqlalchemy import or_, text
 
-from website.models import Account, Payment, Flow, Order, Trade, Instrument
+from website.models import Account, Payment, Flow, Order, Trade, Instrument, Market
 # from website.flows import make_flow, get_flow_table, cancel_orders
 # from website.matching_engine import enter_order
 # from website.bots import bot_6000000, bot_6010000
 from website.util import format_de, check_IBAN, sanitise
+from website.units import Minor_Units
+from website.archive import query_archives
 # from website.tables import get_book
 from website import db, logger
 
 
+# The last book that we built for each (asset_0, asset_1, row_count) together
+# with the version of the market that it was built from. Every change to a book
+# bumps the market's version (see claim_order_book) so a cached book is good
+# for as long as the version stays the same.
+book_cache = {}
+
 def get_book(asset_0: str, asset_1: str, row_count: int = 7):
     """
     Formats the current orders into a book so that they can be displayed on the
-    market page.
+    market page. The book is only rebuilt when the market has changed since the
+    last time that we built it.
 
     Inputs:
         -> asset_0: str, name of the asset being used as a currency, initially
@@ -34,6 +44,15 @@ def get_book(asset_0: str, asset_1: str, row_count: int = 7):
         -> book: list, of lists where each sub list has 4 entries corresponding
            to the 4 columns of the book.
     """
+    # We read the version before the orders, if the market changes in between
+    # then the book we cache is newer than its version says and the next call
+    # simply builds it again.
+    version = db.session.query(Market.version).filter_by(
+        asset_0 = asset_0, asset_1 = asset_1).scalar() or 0
+    cached = book_cache.get((asset_0, asset_1, row_count))
+    if cached is not None and cached[0] == version:
+        return [row[:] for row in cached[1]]
+
     book_data = db.session.query(
         Order.price, 
         func.sum(Order.quantity).label("quantity")
@@ -61,7 +80,8 @@ def get_book(asset_0: str, asset_1: str, row_count: int = 7):
         if i == row_count:
             break
 
-    return book
+    book_cache[(asset_0, asset_1, row_count)] = (version, book)
+    return [row[:] for row in book]
 
 def get_market_trades(asset_0: str, asset_1: str, row_limit: int = 7, filterwashing: bool = True, status: int = 1):
     """
@@ -76,11 +96,16 @@ def get_market_trades(asset_0: str, asset_1: str, row_limit: int = 7, filterwash
     """
     if not (sanitise(asset_0, str) and sanitise(asset_1, str) and sanitise(filterwashing, bool) and sanitise(status, int)):
         return []
-    trade_data = db.session.execute(text(f"""
+    sql = f"""
         SELECT *
         FROM Trade
         WHERE asset_0="{asset_0}" AND asset_1="{asset_1}" {"AND buyer!=seller" if filterwashing else ""} AND status={status}
-        ORDER BY time DESC"""))
+        ORDER BY time DESC"""
+    # The amounts are stored in minor units, the column types turn them back
+    # into Decimals. Older trades are in the archives, which are only read if
+    # the hot table runs out before row_limit.
+    query = text(sql).columns(quantity = Minor_Units(), price = Minor_Units())
+    trade_data = itertools.chain(db.session.execute(query), query_archives(query))
     
     trades, i = [], 0
     for o in trade_data:
@@ -114,11 +139,14 @@ def get_my_trades(account_id: int, row_limit: int = 0, long: bool = False):
     """
     if not sanitise(account_id, int):
         return []
-    trade_data = db.session.execute(text(f"""
+    sql = f"""
         SELECT *
         FROM Trade
         WHERE buyer={account_id} OR seller={account_id}
-        ORDER BY time DESC"""))
+        ORDER BY time DESC"""
+    # Followed by the user's trades in the archives, newest month first.
+    query = text(sql).columns(quantity = Minor_Units(), price = Minor_Units())
+    trade_data = itertools.chain(db.session.execute(query), query_archives(query))
     
     trades, i = [], 0
     for o in trade_data:
@@ -197,7 +225,7 @@ def get_transfers(account_id: int, row_limit: int = 0, long: bool = False):
                 status,
                 message
             FROM Payment
-            ORDER BY time DESC"""))
+            ORDER BY time DESC""").columns(quantity = Minor_Units()))
     else:
         transfer_data = db.session.execute(text(f"""
             SELECT 
@@ -225,7 +253,7 @@ def get_transfers(account_id: int, row_limit: int = 0, long: bool = False):
                 message
             FROM Payment
             WHERE paid_from_id={account_id} OR paid_to_id={account_id}
-            ORDER BY time DESC"""))
+            ORDER BY time DESC""").columns(quantity = Minor_Units()))
     
     lables_long = ["Pagamento", "Retirada", "Depósito"]
     lables_short = ["P", "R", "D"]
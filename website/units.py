@@ -0,0 +1,76 @@
+# This file holds the fixed point arithmetic of our money. Prices, quantities
+# and balances are stored as whole numbers of minor units, hundredths, so 26.90
+# is stored as 2690. SQLite keeps these as exact integers where it used to keep
+# our Numeric columns as floating point numbers, and the matching engine
+# compares and adds plain ints rather than Decimals.
+
+# The rest of the site still sees Decimals. Minor_Units converts on the way in
+# and out of the database, and the engine converts with to_minor and from_minor
+# where it meets its callers.
+
+import decimal as de
+from sqlalchemy.types import TypeDecorator, BigInteger
+
+# Every amount is stored in hundredths, prices are quoted to the cent.
+PLACES = 2
+
+# The decimal places of each currency's minor unit, which is the smallest
+# amount of it that can be deposited, withdrawn or sent. Yen have no minor
+# unit. Order quantities are always whole units of the asset, so the cost of
+# an order is a whole number of cents of the currency that pays for it.
+scales = {
+    "STN": 2, "EUR": 2, "USD": 2, "GBP": 2, "JPY": 0, "CAD": 2, "AUD": 2,
+    "CHF": 2, "AOA": 2, "SAVE_EUR": 2, "RAVE_EUR": 2
+}
+
+def to_minor(value, places: int = PLACES):
+    """
+    Returns an amount as a whole number of minor units, rounding half to even
+    anything smaller than a minor unit.
+    """
+    return int(de.Decimal(value).scaleb(places).to_integral_value(rounding = de.ROUND_HALF_EVEN))
+
+def from_minor(units: int, places: int = PLACES):
+    """
+    Returns a whole number of minor units as a Decimal, 2690 is 26.90.
+    """
+    return de.Decimal(units).scaleb(- places)
+
+def has_places(value: de.Decimal, places: int):
+    """
+    Returns True if an amount has no more than this many decimal places, such
+    as an amount of a currency entered into a form.
+    """
+    try:
+        return value == value.quantize(de.Decimal(1).scaleb(- places), rounding = de.ROUND_DOWN)
+    except de.InvalidOperation:
+        return False # Too many digits, or infinite, so not an amount we hold.
+
+def order_cost(quantity: int, price: int):
+    """
+    Returns the cost in minor units of asset_0 of a quantity bought at a price,
+    both in minor units. Whole quantities always cost a whole number of minor
+    units, anything smaller is rounded half to even.
+    """
+    cost, remainder = divmod(quantity * price, 10 ** PLACES)
+    if 2 * remainder > 10 ** PLACES or (2 * remainder == 10 ** PLACES and cost % 2):
+        cost += 1
+    return cost
+
+class Minor_Units(TypeDecorator):
+    """
+    A column of Decimal amounts which is stored as an integer number of minor
+    units.
+    """
+    impl = BigInteger
+    cache_ok = True
+
+    def __init__(self, places: int = PLACES):
+        super().__init__()
+        self.places = places
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else to_minor(value, self.places)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else from_minor(value, self.places)
@@ -0,0 +1,112 @@
+# This file loads the user of each request for flask_login. Every request from
+# someone who is logged in asks for their user, including the live feeds and
+# small endpoints such as /ping, so rather than loading the whole Account row
+# (with its bank details and balances) we keep a small User with only what
+# logging in and the navigation need, and cache it for a short while.
+
+# Pages that show or change the rest of the account (balances, bank details,
+# the profile) load the full row with load_account().
+
+import time
+import threading
+import collections
+import flask as fl
+import flask_login as fo
+from sqlalchemy import event
+
+from website.models import Account
+from website import db
+
+class User(fo.UserMixin):
+    """
+    The identity of a logged in user. The id is Account.id, which is what
+    flask_login keeps in the session cookie.
+    """
+    def __init__(self, id: int, account_id: int, name: str, hash: str):
+        self.id = id
+        self.account_id = account_id
+        self.name = name
+        self.hash = hash
+
+class User_Cache():
+    """
+    Keeps the most recently used Users for up to ttl seconds, dropping the
+    least recently used once there are more than max_size. Changes to an
+    Account row committed in this process drop its User straight away, the ttl
+    covers changes made by other processes.
+    """
+    def __init__(self, ttl: float = 60, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.users = collections.OrderedDict() # {id: (expires, user)}
+        self.lock = threading.Lock()
+
+    def get(self, id: int):
+        with self.lock:
+            entry = self.users.get(id)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.users[id]
+                return None
+            self.users.move_to_end(id)
+            return entry[1]
+
+    def put(self, user: User):
+        with self.lock:
+            self.users[user.id] = (time.monotonic() + self.ttl, user)
+            self.users.move_to_end(user.id)
+            while len(self.users) > self.max_size:
+                self.users.popitem(last = False)
+
+    def invalidate(self, ids):
+        with self.lock:
+            for id in ids:
+                self.users.pop(id, None)
+
+user_cache = User_Cache()
+
+def load_user(id: int):
+    """
+    The user_loader of flask_login, returns None if the account no longer
+    exists.
+    """
+    user = user_cache.get(id)
+    if user is None:
+        row = db.session.query(
+            Account.id, Account.account_id, Account.name, Account.hash
+            ).filter_by(id = id).first()
+        if row is None:
+            return None
+        user = User(row.id, row.account_id, row.name, row.hash)
+        user_cache.put(user)
+    return user
+
+def load_account():
+    """
+    Returns the full Account row of the user who is logged in, loaded once per
+    request, or None if nobody is logged in.
+    """
+    if not fo.current_user.is_authenticated:
+        return None
+    if "account" not in fl.g:
+        fl.g.account = db.session.get(Account, fo.current_user.id)
+    return fl.g.account
+
+@event.listens_for(db.session, "after_flush")
+def accounts_flushed(session, flush_context):
+    ids = session.info.setdefault("changed_accounts", set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Account):
+            ids.add(obj.id)
+
+@event.listens_for(db.session, "after_commit")
+def accounts_committed(session):
+    ids = session.info.pop("changed_accounts", None)
+    if ids:
+        user_cache.invalidate(ids)
+
+@event.listens_for(db.session, "after_transaction_end")
+def accounts_abandoned(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("changed_accounts", None)
@@ -1,3 +1,5 @@
+import datetime as dt
+
 def format_de(number):
     """
     In this function we format decimals so that they can be displayed properly
@@ -85,3 +87,10 @@ def sanitise(value, type):
         return all(char in allowed_chars for char in value)
     else:
         return False
+
+def utc_now():
+    """
+    Returns the time in UTC without a timezone, which is how SQLite's func.now()
+    stores the times in our tables.
+    """
+    return dt.datetime.now(dt.timezone.utc).replace(tzinfo = None)
@@ -1,6 +1,8 @@
 # This page has received basic logging.
 
 import os
+import json
+import queue
 import flask as fl
 import flask_login as fo
 import hashlib as hl
@@ -11,20 +13,34 @@ from sqlalchemy import or_, text
 
 from website.models import Account, Payment, Flow, Order, Trade, Instrument
 from website.flows import make_flow, get_flow_table, cancel_orders
-from website.matching_engine import enter_order
-from website.bots import bot_6000000, bot_6010000
-from website.util import format_de, check_IBAN, sanitise
+from website.matching_engine import enter_order_checked, time_in_force_options
+from website.sequencer import get_sequencer
+from website.shards import Shard_Stopped
+from website.order_book import markets
+from website.market_feed import get_market_feed
+from website.candles import intervals, get_candles
+from website.events import bus
+from website.ledger import get_available
+from website.users import load_account
+from website.units import PLACES, scales, has_places, Minor_Units
+from website.util import format_de, check_IBAN, sanitise, utc_now
 from website.tables import get_book, get_market_trades, get_my_trades, get_transfers
 from website import db, logger, executor
 
 views = fl.Blueprint("views", __name__)
 
-def check_order(user, side: str, quantity: de.Decimal, price: de.Decimal, asset_0: str, asset_1: str):
+# The expiries that the market pages offer, in hours from now.
+expiry_options = ["1", "24", "168"]
+
+def check_order(user, side: str, quantity: de.Decimal, price: de.Decimal, asset_0: str, asset_1: str, time_in_force: str = "GTC", expires: dt.datetime = None):
     """
     Inputs:
         -> side: str,
         -> quantity: de.Decimal
         -> price: de.Decimal
+        -> time_in_force: str, one of time_in_force_options, see enter_order.
+        -> expires: dt.datetime, in UTC, when the order leaves the book if it
+           has not traded, None keeps it until it is cancelled.
     """
     # We will begin with some basic checks of the order.
     if quantity <= de.Decimal("0"):
@@ -35,50 +51,55 @@ def check_order(user, side: str, quantity: de.Decimal, price: de.Decimal, asset_
         # All prices must be postitive.
         fl.flash("Preço deve ser positivo", category = "e")
         return
+    elif not has_places(quantity, 0):
+        # Orders are for whole units of the asset, see units.py.
+        fl.flash("Quantidade deve ser um número inteiro", category = "e")
+        return
+    elif not has_places(price, PLACES):
+        fl.flash("Preço deve ser em cêntimos", category = "e")
+        return
+    elif time_in_force not in time_in_force_options:
+        fl.flash("Validade do pedido desconhecida", category = "e")
+        return
     
     # Next, we will check that the user has enough funds to submit this new
-    # order even after considering any orders that they already have.
+    # order even after considering the funds reserved by the orders that they
+    # already have.
     if side == "bid": # Bid order
-        balance_available = getattr(user, asset_0)
-        
-        my_bid_orders = Order.query.filter_by(
-            account_id = user.account_id, asset_0 = asset_0, side = "bid", 
-            active = True)
-        my_ask_orders = Order.query.filter_by(
-            account_id = user.account_id, asset_1 = asset_0, side = "ask", 
-            active = True)
-        
-        balance_used = price * quantity # balance used by current order
-        for o in my_bid_orders:
-            balance_used += o.quantity * o.price
-        for o in my_ask_orders:
-            balance_used += o.quantity
-        
-        if balance_used > balance_available:
+        if price * quantity > get_available(user.account_id, asset_0):
             fl.flash(f"Saldo insufficent, não tens {asset_0} bastante.", category = "e")
             return
     
     else: # Ask order
-        balance_available = getattr(user, asset_1)
-
-        my_bid_orders = Order.query.filter_by(
-            account_id = user.account_id, asset_0 = asset_1, side = "bid", 
-            active = True)
-        my_ask_orders = Order.query.filter_by(
-            account_id = user.account_id, asset_1 = asset_1, side = "ask", 
-            active = True)
-        
-        balance_used = quantity # balance used by current order
-        for o in my_bid_orders:
-            balance_used += o.quantity * o.price
-        for o in my_ask_orders:
-            balance_used += o.quantity
-
-        if balance_used > balance_available:
+        if quantity > get_available(user.account_id, asset_1):
             fl.flash(f"Saldo insufficent, não tens {asset_1} bastante.", category = "e")
             return
     
-    enter_order(user, side, quantity, price, asset_0, asset_1, True)
+    # The order is entered by the market's sequencer, which runs in its own
+    # thread (or process, see shards.py) and so cannot flash messages for us.
+    # The funds are checked again there in case another market has used them
+    # since.
+    try:
+        result = get_sequencer(asset_0, asset_1).submit(
+            enter_order_checked, user.account_id, side, quantity, price, asset_0,
+            asset_1, commit = False, time_in_force = time_in_force,
+            expires = expires).result()
+    except Shard_Stopped:
+        # The market's shard died with our order, which may or may not have
+        # been entered. A new shard takes the next order, see shards.py.
+        fl.flash("Erro no mercado, verifique os seus pedidos", category = "e")
+        return
+    if result is None:
+        currency = asset_0 if side == "bid" else asset_1
+        fl.flash(f"Saldo insufficent, não tens {currency} bastante.", category = "e")
+        return
+    if result.trades > 0:
+        fl.flash("Pedido negociado", category = "s")
+    if result.order_id is None and result.trades == 0:
+        # An IOC, FOK or post only order that was turned away.
+        fl.flash("Pedido cancelado sem negociar", category = "e")
+    else:
+        fl.flash("Pedido enviado", category = "s")
 
 # TAB: MERCADOS
 
@@ -102,23 +123,27 @@ def market(asset_1, asset_0):
         side = data.get("side")
         quantity = de.Decimal(data.get("quantity"))
         price = de.Decimal(data.get("price"))
-        check_order(fo.current_user, side, quantity, price, asset_0, asset_1)
-
-        # Running our bots in response
-        if asset_0 == "STN":
-            bot_6000000()
-        else:
-            @fl.copy_current_request_context
-            def run_bot():
-                bot_6010000()
-            print("Starting bot 6010000")
-            executor.submit(run_bot)
+        time_in_force = data.get("time_in_force", "GTC")
+        # The form offers expiries as a number of hours from now.
+        expires_in = data.get("expires_in", "")
+        expires = None
+        if expires_in in expiry_options:
+            expires = utc_now() + dt.timedelta(hours = int(expires_in))
+        elif expires_in:
+            fl.flash("Prazo do pedido desconhecido", category = "e")
+            return fl.redirect(f"/markets/{asset_1}{asset_0}")
+        check_order(fo.current_user, side, quantity, price, asset_0, asset_1, time_in_force, expires)
+
+        # The market's bot requotes on any fill after the order commits, in
+        # its own thread rather than in this request, see bot_triggers.py.
         return fl.redirect(f"/markets/{asset_1}{asset_0}")
 
+    # The page shows the user's balances, so it needs the whole account.
+    user = load_account()
     book = get_book(asset_0, asset_1)
     trades = get_market_trades(asset_0, asset_1)
-    orders = Order.query.filter_by(account_id = fo.current_user.account_id, asset_0 = asset_0, asset_1 = asset_1)
-    return fl.render_template(f"markets/{asset_1}{asset_0}.html", user = fo.current_user, book = book, trades = trades, orders = orders)
+    orders = Order.query.filter_by(account_id = user.account_id, asset_0 = asset_0, asset_1 = asset_1, active = True)
+    return fl.render_template(f"markets/{asset_1}{asset_0}.html", user = user, book = book, trades = trades, orders = orders)
 
 @views.route("/markets/EURSTN", methods = ["GET", "POST"])
 def EURSTN():
@@ -152,6 +177,66 @@ def CHFEUR():
 def AOAEUR():
     return market("AOA", "EUR")
 
+@views.route("/markets/<string:market_name>/stream")
+def market_stream(market_name):
+    """
+    Streams a market's book and trades to its page as Server-Sent Events. The
+    page first gets a "snapshot" and then "book" and "trades" messages, each
+    with the next sequence number, see market_feed.py and static/js/market.js.
+
+    Inputs:
+        -> market_name: str, such as EURSTN, the asset followed by the currency.
+    """
+    asset_1, asset_0 = market_name[:3], market_name[3:]
+    if (asset_0, asset_1) not in markets:
+        fl.abort(404)
+    subscription, snapshot = get_market_feed().subscribe(asset_0, asset_1)
+
+    def stream():
+        try:
+            yield f"id: {snapshot['seq']}\nevent: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+            while not subscription.closed:
+                try:
+                    message = subscription.get(timeout = 15)
+                except queue.Empty:
+                    # A comment line keeps proxies from closing a quiet stream
+                    # and tells us when the browser has gone.
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"id: {message['seq']}\nevent: {message['type']}\ndata: {json.dumps(message)}\n\n"
+        finally:
+            bus.unsubscribe(subscription)
+
+    return fl.Response(stream(), mimetype = "text/event-stream", headers = {
+        "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@views.route("/markets/<string:market_name>/candles")
+def market_candles(market_name):
+    """
+    Returns a market's candles as JSON for charts, for example
+    /markets/EURSTN/candles?interval=1h&start=2024-05-01T00:00:00
+
+    Inputs (query string):
+        -> interval: str, "1m", "1h" or "1d", defaults to "1h".
+        -> start, end: str, optional ISO times in UTC, without a start we
+           return the latest candles.
+        -> limit: int, the most candles to return, at most 1000.
+    """
+    asset_1, asset_0 = market_name[:3], market_name[3:]
+    args = fl.request.args
+    interval = args.get("interval", "1h")
+    if (asset_0, asset_1) not in markets or interval not in intervals:
+        fl.abort(404)
+    try:
+        start = dt.datetime.fromisoformat(args["start"]) if "start" in args else None
+        end = dt.datetime.fromisoformat(args["end"]) if "end" in args else None
+        limit = min(int(args.get("limit", 500)), 1000)
+    except ValueError:
+        fl.abort(400)
+    return fl.jsonify({
+        "market": market_name, "interval": interval,
+        "candles": get_candles(asset_0, asset_1, interval, start, end, limit)})
+
 # TAB: COMO FUNCIONA
 
 @views.route("/how_it_works")
@@ -167,16 +252,17 @@ def my_account():
     This function prepares a backend for the 'my account' page where the users
     can see a dashboard summary of their assets.
     """
-    trades = get_my_trades(fo.current_user.account_id, 7)
-    transfers = get_transfers(fo.current_user.account_id, 7)
+    user = load_account()
+    trades = get_my_trades(user.account_id, 7)
+    transfers = get_transfers(user.account_id, 7)
     image_path = fl.current_app.root_path + \
-        f"/static/images/{fo.current_user.account_id}.{fo.current_user.photo}"
+        f"/static/images/{user.account_id}.{user.photo}"
     if os.path.exists(image_path):
-        image_name = f"{fo.current_user.account_id}.{fo.current_user.photo}"
+        image_name = f"{user.account_id}.{user.photo}"
     else:
         image_name = "default.png"
     image_path = fl.url_for("static", filename = f"images/{image_name}")
-    return fl.render_template("my_account/main.html", user = fo.current_user, trades = trades, transfers = transfers, image_path = image_path)
+    return fl.render_template("my_account/main.html", user = user, trades = trades, transfers = transfers, image_path = image_path)
 
 @fo.login_required
 @views.route("/my_account/change_email", methods = ["GET", "POST"])
@@ -185,22 +271,23 @@ def change_email():
     This function prepares a backend for the 'change email' page where the users
     can change their email.
     """
+    user = load_account()
     if fl.request.method == "POST":
         data = fl.request.form
         email = data.get("email")
         password = data.get("password")
 
-        if hl.sha256(password.encode()).hexdigest() != fo.current_user.hash:
+        if hl.sha256(password.encode()).hexdigest() != user.hash:
             # Incorrect password
             fl.flash("Senha incorreta", category = "e")
         else:
-            fo.current_user.email = email
+            user.email = email
             db.session.commit()
             fl.flash("E-mail mudou", category = "s")
-            logger.info(f"AA account_id = {fo.current_user.account_id}, email = {email}")
+            logger.info(f"AA account_id = {user.account_id}, email = {email}")
             return fl.redirect(f"/my_account")
 
-    return fl.render_template("my_account/change_email.html", user = fo.current_user)
+    return fl.render_template("my_account/change_email.html", user = user)
 
 @fo.login_required
 @views.route("/my_account/change_password", methods = ["GET", "POST"])
@@ -209,26 +296,27 @@ def change_password():
     This function prepares a backend for the 'change password' page where the 
     users can change their password.
     """
+    user = load_account()
     if fl.request.method == "POST":
         data = fl.request.form
         password_1 = data.get("password_1")
         password_2 = data.get("password_2")
         password = data.get("password")
 
-        if hl.sha256(password.encode()).hexdigest() != fo.current_user.hash:
+        if hl.sha256(password.encode()).hexdigest() != user.hash:
             # Incorrect password
             fl.flash("Senha incorreta", category = "e")
         elif password_1 != password_2:
             fl.flash("Novas senhas não são iguais", category = "e")
         else:
-            fo.current_user.password = password_1
-            fo.current_user.hash = hl.sha256(password_1.encode()).hexdigest()
+            user.password = password_1
+            user.hash = hl.sha256(password_1.encode()).hexdigest()
             db.session.commit()
             fl.flash("Senhas mudou", category = "s")
-            logger.info(f"AA account_id = {fo.current_user.account_id}, password = CHANGED")
+            logger.info(f"AA account_id = {user.account_id}, password = CHANGED")
             return fl.redirect(f"/my_account")
 
-    return fl.render_template("my_account/change_password.html", user = fo.current_user)
+    return fl.render_template("my_account/change_password.html", user = user)
 
 @fo.login_required
 @views.route("/my_account/change_name", methods = ["GET", "POST"])
@@ -237,22 +325,23 @@ def change_name():
     This function prepares a backend for the 'change name' page where the users
     can change their name.
     """
+    user = load_account()
     if fl.request.method == "POST":
         data = fl.request.form
         name = data.get("name")
         password = data.get("password")
 
-        if hl.sha256(password.encode()).hexdigest() != fo.current_user.hash:
+        if hl.sha256(password.encode()).hexdigest() != user.hash:
             # Incorrect password
             fl.flash("Senha incorreta", category = "e")
         else:
-            fo.current_user.name = name
+            user.name = name
             db.session.commit()
             fl.flash("Nome mudou", category = "s")
-            logger.info(f"AA account_id = {fo.current_user.account_id}, name = {name}")
+            logger.info(f"AA account_id = {user.account_id}, name = {name}")
             return fl.redirect(f"/my_account")
 
-    return fl.render_template("my_account/change_name.html", user = fo.current_user)
+    return fl.render_template("my_account/change_name.html", user = user)
 
 @fo.login_required
 @views.route("/my_account/change_phone", methods = ["GET", "POST"])
@@ -261,22 +350,23 @@ def change_phone():
     This function prepares a backend for the 'change phone' page where the users
     can change their phone.
     """
+    user = load_account()
     if fl.request.method == "POST":
         data = fl.request.form
         phone = data.get("phone")
         password = data.get("password")
 
-        if hl.sha256(password.encode()).hexdigest() != fo.current_user.hash:
+        if hl.sha256(password.encode()).hexdigest() != user.hash:
             # Incorrect password
             fl.flash("Senha incorreta", category = "e")
         else:
-            fo.current_user.phone = phone
+            user.phone = phone
             db.session.commit()
             fl.flash("Telefone mudou", category = "s")
-            logger.info(f"AA account_id = {fo.current_user.account_id}, phone = {phone}")
+            logger.info(f"AA account_id = {user.account_id}, phone = {phone}")
             return fl.redirect(f"/my_account")
 
-    return fl.render_template("my_account/change_phone.html", user = fo.current_user)
+    return fl.render_template("my_account/change_phone.html", user = user)
 
 @fo.login_required
 @views.route("/my_account/change_photo", methods = ["GET", "POST"])
@@ -285,25 +375,26 @@ def change_photo():
     This function prepares a backend for the 'change photo' page where the users
     can change their profile photo.
     """
+    user = load_account()
     if fl.request.method == "POST":
         # data = fl.request.form
         file = fl.request.files["photo"]
         if file:
             filetype = file.filename.split(".")[-1].lower()
             if filetype in ["png", "jpeg", "jpg"]:
-                image_path = fl.current_app.root_path + f"/static/images/{fo.current_user.account_id}.{filetype}"
+                image_path = fl.current_app.root_path + f"/static/images/{user.account_id}.{filetype}"
                 file.save(image_path)
-                fo.current_user.photo = filetype
+                user.photo = filetype
                 db.session.commit()
                 fl.flash("Foto mudou", category = "s")
-                logger.info(f"AA account_id = {fo.current_user.account_id}, photo = {filetype}")
+                logger.info(f"AA account_id = {user.account_id}, photo = {filetype}")
                 return fl.redirect(f"/my_account")
             else:
                 fl.flash("A foto deve ser '.png', '.jpeg' ou '.jpg'", category = "e")
         else:
             fl.flash("Escolhe uma foto", category = "e")
 
-    return fl.render_template("my_account/change_photo.html", user = fo.current_user)
+    return fl.render_template("my_account/change_photo.html", user = user)
 
 @fo.login_required
 @views.route("/my_account/bank_details")
@@ -380,10 +471,11 @@ def withdrawal(currency):
         -> Since STN is not connected to bank accounts the STN withdrawals page
            does not redirect here.
     """
+    user = load_account()
     currency = currency.upper()
     
     if currency == "STN":
-        return fl.render_template("withdrawals/STN.html", user = fo.current_user)
+        return fl.render_template("withdrawals/STN.html", user = user)
     
     elif currency in ["EUR", "USD", "GBP", "JPY", "CAD", "AUD", "CHF"]:
         if fl.request.method == "POST":
@@ -395,32 +487,32 @@ def withdrawal(currency):
 
             if data.get("name"):
                 name = data.get("name")
-                setattr(fo.current_user, f"name_{currency}", name)
-                logger.info(f"AA account_id = {fo.current_user.account_id}, name_{currency} = {name}")
+                setattr(user, f"name_{currency}", name)
+                logger.info(f"AA account_id = {user.account_id}, name_{currency} = {name}")
                 db.session.commit()
                 logger.info(f"Database Commit")
-            elif not getattr(fo.current_user, f"name_{currency}"): # no account name on file:
+            elif not getattr(user, f"name_{currency}"): # no account name on file:
                 fl.flash(f"Precisamos de um nome de conta para enviar seu dinheiro.", category = "e")
                 submit_withdrawal = False
 
             if data.get("iban"):
                 IBAN = data.get("iban")
                 if check_IBAN(IBAN):
-                    setattr(fo.current_user, f"IBAN_{currency}", IBAN)
-                    logger.info(f"AA account_id = {fo.current_user.account_id}, IBAN_{currency} = {IBAN}")
+                    setattr(user, f"IBAN_{currency}", IBAN)
+                    logger.info(f"AA account_id = {user.account_id}, IBAN_{currency} = {IBAN}")
                     db.session.commit()
                     logger.info(f"Database Commit")
                 else:
                     fl.flash(f"{IBAN} não é um IBAN válido.", category = "e")
                     submit_withdrawal = False
-            elif not getattr(fo.current_user, f"IBAN_{currency}"): # no iban on file:
+            elif not getattr(user, f"IBAN_{currency}"): # no iban on file:
                 fl.flash(f"Precisamos de um IBAN para enviar seu dinheiro.", category = "e")
                 submit_withdrawal = False
 
             if submit_withdrawal:
-                make_flow(False, currency, quantity, fo.current_user.account_id, password, message)
+                make_flow(False, currency, quantity, user.account_id, password, message)
 
-        return fl.render_template(f"withdrawals/{currency}.html", user = fo.current_user)
+        return fl.render_template(f"withdrawals/{currency}.html", user = user)
 
     if currency == "AOA":
         if fl.request.method == "POST":
@@ -432,45 +524,45 @@ def withdrawal(currency):
 
             if data.get("name"):
                 name = data.get("name")
-                setattr(fo.current_user, f"name_{currency}", name)
-                logger.info(f"AA account_id = {fo.current_user.account_id}, name_{currency} = {name}")
+                setattr(user, f"name_{currency}", name)
+                logger.info(f"AA account_id = {user.account_id}, name_{currency} = {name}")
                 db.session.commit()
                 logger.info(f"Database Commit")
-            elif not getattr(fo.current_user, f"name_{currency}"): # no account name on file:
+            elif not getattr(user, f"name_{currency}"): # no account name on file:
                 fl.flash(f"Precisamos de um nome de conta para enviar seu dinheiro.", category = "e")
                 submit_withdrawal = False
 
             if data.get("iban"):
                 IBAN = data.get("iban")
                 if check_IBAN(IBAN):
-                    setattr(fo.current_user, f"IBAN_{currency}", IBAN)
-                    logger.info(f"AA account_id = {fo.current_user.account_id}, IBAN_{currency} = {IBAN}")
+                    setattr(user, f"IBAN_{currency}", IBAN)
+                    logger.info(f"AA account_id = {user.account_id}, IBAN_{currency} = {IBAN}")
                     db.session.commit()
                     logger.info(f"Database Commit")
                 else:
                     fl.flash(f"{IBAN} não é um IBAN válido.", category = "e")
                     submit_withdrawal = False
-            elif not getattr(fo.current_user, f"IBAN_{currency}") and not data.get("account"): # no iban on file:
+            elif not getattr(user, f"IBAN_{currency}") and not data.get("account"): # no iban on file:
                 fl.flash(f"Precisamos de um IBAN para enviar seu dinheiro.", category = "e")
                 submit_withdrawal = False
 
             elif data.get("bank") and data.get("account"):
                 bank = data.get("bank")
-                setattr(fo.current_user, f"bank_{currency}", bank)
-                logger.info(f"AA account_id = {fo.current_user.account_id}, bank_{currency} = {bank}")
+                setattr(user, f"bank_{currency}", bank)
+                logger.info(f"AA account_id = {user.account_id}, bank_{currency} = {bank}")
                 account = data.get("account")
-                setattr(fo.current_user, f"account_{currency}", account)
-                logger.info(f"AA account_id = {fo.current_user.account_id}, account_{currency} = {account}")
+                setattr(user, f"account_{currency}", account)
+                logger.info(f"AA account_id = {user.account_id}, account_{currency} = {account}")
                 db.session.commit()
                 logger.info(f"Database Commit")
-            elif not getattr(fo.current_user, f"account_{currency}"): # no account name on file:
+            elif not getattr(user, f"account_{currency}"): # no account name on file:
                 fl.flash(f"Precisamos de uma conta para enviar seu dinheiro.", category = "e")
                 submit_withdrawal = False
 
             if submit_withdrawal:
-                make_flow(False, currency, quantity, fo.current_user.account_id, password, message)
+                make_flow(False, currency, quantity, user.account_id, password, message)
 
-        return fl.render_template(f"withdrawals/{currency}.html", user = fo.current_user)
+        return fl.render_template(f"withdrawals/{currency}.html", user = user)
     
     else: # If the user inserts a currency like "COW"
         fl.abort(404)
@@ -487,13 +579,16 @@ def send_funds(data):
     password = data.get("password")
 
     paid_to = Account.query.filter_by(account_id = paid_to_id).first()
-    paid_from = fo.current_user
+    paid_from = load_account()
 
     # Now we will preform all the checks on the payment which the user might 
     # want to avoid.
     if quantity <= de.Decimal("0"):
         # Can't take money from other people's accounts
         fl.flash("O valor deve ser positivo", category = "e")
+    elif not has_places(quantity, scales.get(currency, PLACES)):
+        # Nothing smaller than the currency's minor unit, see units.py.
+        fl.flash(f"O valor de {currency} tem casas decimais demais", category = "e")
     elif quantity > getattr(paid_from, currency):
         # The person is trying to send more money than they have
         fl.flash(f"Saldo de {currency} insufficent", category = "e")
@@ -575,6 +670,7 @@ def confirm_send():
 @fo.login_required
 @views.route("/saving", methods = ["GET", "POST"])
 def saving():
+    user = load_account()
     if fl.request.method == "POST":
         data = fl.request.form
         quantity = de.Decimal(data.get("quantity"))
@@ -584,33 +680,33 @@ def saving():
         if currency == "EUR":
             if quantity < 0:
                 fl.flash(f"Não pode ser negativo.", category = "e")
-            if side == "add" and quantity > fo.current_user.EUR:
+            if side == "add" and quantity > user.EUR:
                 fl.flash(f"Não tem saldo bastante.", category = "e")
-            elif side == "subtract" and quantity > fo.current_user.SAVE_EUR - fo.current_user.RAVE_EUR:
+            elif side == "subtract" and quantity > user.SAVE_EUR - user.RAVE_EUR:
                 fl.flash(f"Não podes tirar mais dinheiro que está na propança.", category = "e")
             else:
                 if side == "add":
-                    fo.current_user.SAVE_EUR += quantity
-                    fo.current_user.EUR -= quantity
+                    user.SAVE_EUR += quantity
+                    user.EUR -= quantity
                     db.session.add(Trade(
                         asset_0 = "EUR", asset_1 = "SAVE_EUR", 
                         quantity = quantity, price = de.Decimal("1"), 
-                        buyer = fo.current_user.account_id, seller = 1234567, 
+                        buyer = user.account_id, seller = 1234567, 
                         status = 1
                     ))
-                    logger.info(f"TC asset_0 = EUR, asset_1 = SAVE_EUR, quantity = {quantity}, price = 1.0, buyer = {fo.current_user.account_id}, seller = 1234567")
+                    logger.info(f"TC asset_0 = EUR, asset_1 = SAVE_EUR, quantity = {quantity}, price = 1.0, buyer = {user.account_id}, seller = 1234567")
                     db.session.commit()
                     logger.info(f"Database Commit")
                     fl.flash(f"Dinheiro colocado na caixa.", category = "s")
                 else:
-                    fo.current_user.RAVE_EUR += quantity
+                    user.RAVE_EUR += quantity
                     db.session.add(Trade(
                         asset_0 = "EUR", asset_1 = "SAVE_EUR", 
                         quantity = quantity, price = de.Decimal("1"), 
                         buyer = 1234567, 
-                        seller = fo.current_user.account_id, status = 0
+                        seller = user.account_id, status = 0
                     ))
-                    logger.info(f"TC asset_0 = EUR, asset_1 = SAVE_EUR, quantity = {- quantity}, price = 1.0, buyer = 1234567, seller = {fo.current_user.account_id}")
+                    logger.info(f"TC asset_0 = EUR, asset_1 = SAVE_EUR, quantity = {- quantity}, price = 1.0, buyer = 1234567, seller = {user.account_id}")
                     db.session.commit()
                     logger.info(f"Database Commit")
                     fl.flash(f"Dinheiro tirado na caixa.", category = "s")
@@ -621,7 +717,7 @@ def saving():
         EUR_i_next = "Ainda não foi anunciado"
     else:
         EUR_i_next = format_de(100 * EUR_saving.interest_next) + "%"
-    return fl.render_template("saving.html", user = fo.current_user, EUR_i = EUR_i, EUR_i_next = EUR_i_next)
+    return fl.render_template("saving.html", user = user, EUR_i = EUR_i, EUR_i_next = EUR_i_next)
 
 # TAB: ADMIN
 
@@ -685,7 +781,8 @@ def accounts():
             de.Decimal(0), de.Decimal(0), de.Decimal(0), de.Decimal(0),
             de.Decimal(0)]
         accounts = [[]] # the second brakets will be filled by the totals.
-        for a in Account.query:
+        # The balances of every account in one more query.
+        for a in Account.query.options(db.selectinload(Account.balances)):
             accounts.append([
                 a.account_id, a.name, a.password, a.hash, format_de(a.EUR), 
                 format_de(a.STN), format_de(a.USD), format_de(a.GBP), 
@@ -771,7 +868,7 @@ def review_interest():
             SELECT *
             FROM Trade
             WHERE status=0
-            ORDER BY time DESC"""))
+            ORDER BY time DESC""").columns(quantity = Minor_Units()))
     
         table = []
         for o in trade_data: